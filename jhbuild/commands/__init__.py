@@ -121,10 +121,13 @@ def print_help():
     import os
     thisdir = os.path.abspath(os.path.dirname(__file__))
 
-    # import all available commands
+    # import the modules of the commands missing from the index
+    indexed_modules = set([module for module, doc in _lazy_commands.values()])
     for fname in os.listdir(os.path.join(thisdir)):
         name, ext = os.path.splitext(fname)
-        if not ext == '.py':
+        if not ext == '.py' or name == '__init__':
+            continue
+        if 'jhbuild.commands.%s' % name in indexed_modules:
             continue
         try:
             __import__('jhbuild.commands.%s' % name)
@@ -132,7 +135,11 @@ def print_help():
             pass
 
     uprint(_('JHBuild commands are:'))
-    commands = [(x.name, x.doc) for x in get_commands().values()]
+    # the lazily registered commands are listed from their index entry,
+    # without importing their module
+    commands = [(name, _(doc)) for name, (module, doc)
+                in _lazy_commands.items() if not name in _commands]
+    commands += [(x.name, x.doc) for x in get_commands().values()]
     commands.sort()
     for name, description in commands:
         uprint('  %-15s %s' % (name, description))
@@ -144,6 +151,13 @@ _commands = {}
 def register_command(command_class):
     _commands[command_class.name] = command_class
 
+_lazy_commands = {}
+def register_lazy_command(name, module, doc):
+    '''Registers the command @name, implemented in @module, which is only
+    imported when the command is run.  @doc is the description of the
+    command listed by print_help().'''
+    _lazy_commands[name] = (module, doc)
+
 # special help command, never run
 class cmd_help(Command):
     doc = N_('Information about available JHBuild commands')
@@ -161,14 +175,25 @@ register_command(cmd_help)
 def get_commands():
     return _commands
 
-def run(command, config, args, help):
+def get_command_class(command):
+    '''Returns the class of the command @command, importing its module if
+    needed, or None if there is no such command.'''
+    if command not in _commands and command in _lazy_commands:
+        module = _lazy_commands[command][0]
+        __import__(module)
+        assert command in _commands, (
+            '%s did not register the %s command' % (module, command))
     # if the command hasn't been registered, load a module by the same name
     if command not in _commands:
         try:
             __import__('jhbuild.commands.%s' % command)
         except ImportError:
             pass
-    if command not in _commands:
+    return _commands.get(command)
+
+def run(command, config, args, help):
+    command_class = get_command_class(command)
+    if command_class is None:
         import jhbuild.moduleset
         module_set = jhbuild.moduleset.load(config)
         try:
@@ -177,10 +202,67 @@ def run(command, config, args, help):
         except KeyError:
             raise FatalError(_('no such command (did you mean "jhbuild run %s"?)' % command))
 
-    command_class = _commands[command]
-
     cmd = command_class()
     return cmd.execute(config, args, help)
 
 
-from jhbuild.commands import base
+# the commands shipped with JHBuild; the descriptions must match the doc
+# attributes of the commands
+register_lazy_command('autobuild', 'jhbuild.commands.autobuild',
+                      N_('Build modules non-interactively and upload results to JhAutobuild'))
+register_lazy_command('bootstrap', 'jhbuild.commands.bootstrap',
+                      N_('Build support tools'))
+register_lazy_command('bot', 'jhbuild.commands.bot',
+                      N_('Control buildbot'))
+register_lazy_command('build', 'jhbuild.commands.base',
+                      N_('Update and compile all modules (the default)'))
+register_lazy_command('buildone', 'jhbuild.commands.base',
+                      N_('Update and compile one or more modules'))
+register_lazy_command('checkbranches', 'jhbuild.commands.checkbranches',
+                      N_('Check modules in GNOME Git repository have the correct branch definition'))
+register_lazy_command('checkmodulesets', 'jhbuild.commands.checkmodulesets',
+                      N_('Check if modules in JHBuild have the correct definition'))
+register_lazy_command('clean', 'jhbuild.commands.clean',
+                      N_('Clean all modules'))
+register_lazy_command('cleanone', 'jhbuild.commands.base',
+                      N_('Clean one or more modules'))
+register_lazy_command('dot', 'jhbuild.commands.base',
+                      N_('Output a Graphviz dependency graph for one or more modules'))
+register_lazy_command('extdeps', 'jhbuild.commands.extdeps',
+                      N_('Report details on GNOME external dependencies'))
+register_lazy_command('goalreport', 'jhbuild.commands.goalreport',
+                      N_('Report GNOME modules status wrt various goals'))
+register_lazy_command('gui', 'jhbuild.commands.gui',
+                      N_('Build targets from a GUI app'))
+register_lazy_command('info', 'jhbuild.commands.info',
+                      N_('Display information about one or more modules'))
+register_lazy_command('list', 'jhbuild.commands.base',
+                      N_('List the modules that would be built'))
+register_lazy_command('make', 'jhbuild.commands.make',
+                      N_('Compile and install the module for the current directory'))
+register_lazy_command('postinst', 'jhbuild.commands.base',
+                      N_('Run post-install triggers for named modules (or all)'))
+register_lazy_command('rdepends', 'jhbuild.commands.rdepends',
+                      N_('Display reverse-dependencies of a module'))
+register_lazy_command('repackmirrors', 'jhbuild.commands.repackmirrors',
+                      N_('Repack the object store shared by the git mirrors'))
+register_lazy_command('run', 'jhbuild.commands.base',
+                      N_('Run a command under the JHBuild environment'))
+register_lazy_command('sanitycheck', 'jhbuild.commands.sanitycheck',
+                      N_('Check that required support tools are available'))
+register_lazy_command('shell', 'jhbuild.commands.base',
+                      N_('Start a shell under the JHBuild environment'))
+register_lazy_command('snapshot', 'jhbuild.commands.snapshot',
+                      N_('Print out a moduleset for the exact versions that are checked out'))
+register_lazy_command('sysdeps', 'jhbuild.commands.sysdeps',
+                      N_('Check and install tarball dependencies using system packages'))
+register_lazy_command('tinderbox', 'jhbuild.commands.tinderbox',
+                      N_('Build modules non-interactively and store build logs'))
+register_lazy_command('twoninetynine', 'jhbuild.commands.twoninetynine',
+                      N_('Report GNOME modules status wrt 3.0 goals'))
+register_lazy_command('uninstall', 'jhbuild.commands.uninstall',
+                      N_('Uninstall all modules'))
+register_lazy_command('update', 'jhbuild.commands.base',
+                      N_('Update all modules from version control'))
+register_lazy_command('updateone', 'jhbuild.commands.base',
+                      N_('Update one or more modules from version control'))
@@ -21,6 +21,7 @@ from optparse import make_option
 
 from jhbuild.errors import UsageError
 from jhbuild.commands.base import Command, register_command
+import jhbuild.moduleset
 import jhbuild.frontends
 import optparse
 
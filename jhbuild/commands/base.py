@@ -26,7 +26,6 @@ import time
 from optparse import make_option
 import logging
 
-import jhbuild.moduleset
 import jhbuild.frontends
 from jhbuild.errors import UsageError, FatalError, CommandError
 from jhbuild.commands import Command, BuildCommand, register_command
@@ -60,6 +59,7 @@ class cmd_update(Command):
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         config.set_from_cmdline_options(options)
         module_set = jhbuild.moduleset.load(config)
         module_list = module_set.get_module_list(args or config.modules,
@@ -96,6 +96,7 @@ class cmd_updateone(Command):
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         config.set_from_cmdline_options(options)
         module_set = jhbuild.moduleset.load(config)
         try:
@@ -133,6 +134,7 @@ class cmd_cleanone(Command):
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         if options.honour_config is False:
             config.makeclean = True
         module_set = jhbuild.moduleset.load(config)
@@ -227,9 +229,22 @@ class cmd_build(BuildCommand):
             make_option('--nodeps',
                         action='store_false', dest='check_sysdeps', default=None,
                         help=_('ignore missing system dependencies')),
+            make_option('--events', metavar='FILE',
+                        action='store', dest='events_file', default=None,
+                        help=_('append the build events to FILE, as JSON')),
+            make_option('--trace', metavar='FILE',
+                        action='store', dest='trace_file', default=None,
+                        help=_('write a timeline of the build to FILE')),
+            make_option('--serve', metavar='PORT',
+                        action='store', type='int', dest='serve_port',
+                        default=None,
+                        help=_('serve the live status of the build on '
+                               'the local port PORT (the commands then '
+                               'write to pipes, not to the terminal)')),
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         config.set_from_cmdline_options(options)
 
         module_set = jhbuild.moduleset.load(config)
@@ -317,6 +332,7 @@ class cmd_buildone(BuildCommand):
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         config.set_from_cmdline_options(options)
 
         module_set = jhbuild.moduleset.load(config)
@@ -376,6 +392,7 @@ class cmd_run(Command):
     def run(self, config, options, args, help=None):
         module_name = options.in_builddir or options.in_checkoutdir
         if module_name:
+            import jhbuild.moduleset
             module_set = jhbuild.moduleset.load(config)
             try:
                 module = module_set.get_module(module_name, ignore_case = True)
@@ -453,6 +470,7 @@ class cmd_list(Command):
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         config.set_from_cmdline_options(options)
         module_set = jhbuild.moduleset.load(config)
         if options.startat and options.list_all_modules:
@@ -504,6 +522,7 @@ class cmd_dot(Command):
             ])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         module_set = jhbuild.moduleset.load(config)
         if args:
             modules = args
@@ -530,6 +549,7 @@ class cmd_postinst(Command):
         Command.__init__(self, [])
 
     def run(self, config, options, args, help=None):
+        import jhbuild.moduleset
         config.set_from_cmdline_options(options)
 
         module_set = jhbuild.moduleset.load(config)
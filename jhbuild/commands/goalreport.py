@@ -19,6 +19,7 @@
 
 import os
 import re
+import signal
 import socket
 import sys
 import subprocess
@@ -26,6 +27,8 @@ import time
 import types
 import cPickle
 import logging
+import multiprocessing
+import sqlite3
 from optparse import make_option
 try:
     from cStringIO import StringIO
@@ -45,6 +48,7 @@ except ImportError:
 from jhbuild.errors import FatalError
 import jhbuild.moduleset
 from jhbuild.commands import Command, register_command
+from jhbuild.utils import fileutils
 from jhbuild.utils import httpcache
 from jhbuild.modtypes import MetaModule
 
@@ -145,6 +149,11 @@ class Check:
         pass
     create_from_args = classmethod(create_from_args)
 
+    def prepare(cls, config):
+        '''Called once before the checks of the modules are run.'''
+        pass
+    prepare = classmethod(prepare)
+
 
 class ShellCheck(Check):
     cmd = None
@@ -183,22 +192,217 @@ class ShellCheck(Check):
 
 
 FIND_C = "find -name '*.[ch]' -or -name '*.cpp' -or -name '*.cc'"
+C_EXTENSIONS = ('.c', '.h', '.cpp', '.cc')
+
+
+def get_regex_literal(regex):
+    '''Returns the longest string contained in every match of regex, or
+    None if there is none that can be simply determined.'''
+    # alternatives, groups, classes and counted repetitions are not handled
+    if [x for x in '|([{' if x in regex]:
+        return None
+    literals = []
+    current = ''
+    i = 0
+    while i < len(regex):
+        char = regex[i]
+        i += 1
+        if char == '\\':
+            if i < len(regex) and not regex[i].isalnum():
+                current += regex[i]
+                i += 1
+                continue
+            i += 1
+        elif char in '*?':
+            # the previous character is optional
+            current = current[:-1]
+        elif not char in '.^$+':
+            current += char
+            continue
+        literals.append(current)
+        current = ''
+    literals.append(current)
+    literal = max(literals, key=len)
+    return literal or None
+
+
+class SourceScanner:
+    '''Scans a source tree once for the patterns of several checks, and
+    indexes the identifiers used in the sources.
+
+    Patterns are (extensions, regex, exclude) tuples; a line of a file with
+    one of the extensions matches if it matches the regex, and the exclude
+    regex, if any, does not match its "path:line" form, as with
+    "grep regex | egrep -v exclude".
+
+    Each file is read once; the patterns whose literal part it does not
+    contain are skipped, and the remaining ones are combined in a single
+    regex, each pattern then only being tried on the lines matching it.'''
+
+    ignored_dirs = ('.git', '.svn', '.bzr', '.hg', 'CVS', '_darcs')
+    identifier_regex = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+    def __init__(self):
+        self.patterns = []
+        self.file_patterns = {}
+        self.combined_regexes = {}
+        self.identifier_extensions = set()
+        self.matches = {}
+        self.identifiers = set()
+
+    def add(self, key, patterns):
+        '''Adds patterns whose matching lines will be reported under key.'''
+        for extensions, regex, exclude in patterns:
+            if exclude:
+                exclude = re.compile(exclude)
+            self.patterns.append((key, tuple(extensions), regex,
+                                  re.compile(regex, re.MULTILINE),
+                                  get_regex_literal(regex), exclude))
+        self.file_patterns = {}
+
+    def index_identifiers(self, extensions):
+        '''Adds the identifiers used in the files with the extensions to
+        the identifiers set.'''
+        self.identifier_extensions.update(extensions)
+
+    def get_file_patterns(self, extension):
+        if not extension in self.file_patterns:
+            self.file_patterns[extension] = [x for x in self.patterns
+                                             if extension in x[1]]
+        return self.file_patterns[extension]
+
+    def get_combined_regex(self, patterns):
+        regexes = tuple([x[2] for x in patterns])
+        if not regexes in self.combined_regexes:
+            self.combined_regexes[regexes] = re.compile(
+                    '|'.join(['(?:%s)' % x for x in regexes]), re.MULTILINE)
+        return self.combined_regexes[regexes]
+
+    def scan(self, srcdir):
+        '''Fills identifiers, and returns matches, a dictionary mapping the
+        keys to the list of the (path, line) matches of their patterns.'''
+        self.matches = {}
+        self.identifiers = set()
+        for pattern in self.patterns:
+            self.matches[pattern[0]] = []
+        if not self.patterns and not self.identifier_extensions:
+            return self.matches
+        for base, dirnames, filenames in os.walk(srcdir):
+            dirnames[:] = [x for x in dirnames if not x in self.ignored_dirs]
+            for filename in filenames:
+                extension = os.path.splitext(filename)[-1]
+                patterns = self.get_file_patterns(extension)
+                index = extension in self.identifier_extensions
+                if not patterns and not index:
+                    continue
+                path = os.path.join(base, filename)
+                try:
+                    data = file(path).read()
+                except IOError:
+                    continue
+                if index:
+                    self.identifiers.update(self.identifier_regex.findall(data))
+                if patterns:
+                    self.scan_data(path[len(srcdir):].lstrip(os.sep), data,
+                                   patterns)
+        return self.matches
+
+    def scan_data(self, relpath, data, patterns):
+        patterns = [x for x in patterns if x[4] is None or x[4] in data]
+        if not patterns:
+            return
+        combined_regex = self.get_combined_regex(patterns)
+        pos = 0
+        while True:
+            match = combined_regex.search(data, pos)
+            if not match:
+                break
+            start = data.rfind('\n', 0, match.start()) + 1
+            end = data.find('\n', match.end())
+            if end == -1:
+                end = len(data)
+            line = data[start:end]
+            for key, extensions, regex, compiled_regex, literal, exclude in patterns:
+                if not compiled_regex.search(line):
+                    continue
+                if exclude and exclude.search('%s:%s' % (relpath, line)):
+                    continue
+                self.matches[key].append((relpath, line))
+            pos = end + 1
+
 
+class SourceCheck(Check):
+    '''Base class for the checks working on the results of a scan of the
+    sources; the sources of a module are scanned once for all its checks.'''
 
-class SymbolsCheck(Check):
     def run(self):
-        symbol_regex = re.compile(r'[\s\(\){}\+\|&-](%s)[\s\(\){}\+\|&-]' % '|'.join(self.symbols))
-        deprecated_and_used = {}
-        try:
-            for base, dirnames, filenames in os.walk(self.module.branch.srcdir):
-                filenames = [x for x in filenames if \
-                             os.path.splitext(x)[-1] in ('.c', '.cc', '.cpp', '.h', '.glade')]
-                for filename in filenames:
-                    for s in symbol_regex.findall(file(os.path.join(base, filename)).read()):
-                        deprecated_and_used[s] = True
-        except UnicodeDecodeError:
-            raise ExcludedModuleException()
-        self.bad_symbols = deprecated_and_used.keys()
+        scanner = SourceScanner()
+        self.prepare_scan(scanner)
+        scanner.scan(self.module.branch.srcdir)
+        self.process_scan(scanner)
+
+    def prepare_scan(self, scanner):
+        pass
+
+    def process_scan(self, scanner):
+        pass
+
+
+class ScanCheck(SourceCheck):
+    '''Counts the lines of the sources matching patterns, a list of
+    (extensions, regex, exclude) tuples as handled by SourceScanner.'''
+
+    patterns = ()
+
+    def get_patterns(self):
+        return self.patterns
+
+    def prepare_scan(self, scanner):
+        scanner.add(self, self.get_patterns())
+
+    def process_scan(self, scanner):
+        self.process_matches(scanner.matches[self])
+
+    def process_matches(self, matches):
+        nb_lines = len(matches)
+        if nb_lines == 0:
+            self.status = 'ok'
+        elif nb_lines <= 5:
+            self.status = 'todo'
+            self.complexity = 'low'
+        elif nb_lines <= 20:
+            self.status = 'todo'
+            self.complexity = 'average'
+        else:
+            self.status = 'todo'
+            self.complexity = 'complex'
+
+    def create_from_args(cls, *args):
+        new_class = types.ClassType('ScanCheck (%s)' % ', '.join(args),
+                (cls,), {'patterns': [(C_EXTENSIONS, x, None) for x in args]})
+        return new_class
+    create_from_args = classmethod(create_from_args)
+
+
+SYMBOLS_EXTENSIONS = C_EXTENSIONS + ('.glade',)
+
+
+class SymbolsCheck(SourceCheck):
+    def prepare_scan(self, scanner):
+        # symbols are looked up in the identifiers used in the sources,
+        # other names are searched as they are
+        scanner.index_identifiers(SYMBOLS_EXTENSIONS)
+        for symbol in self.symbols:
+            if not re.match(r'[A-Za-z_]\w*$', symbol):
+                scanner.add((self, symbol),
+                            [(SYMBOLS_EXTENSIONS, re.escape(symbol), None)])
+
+    def process_scan(self, scanner):
+        bad_symbols = set(self.symbols) & scanner.identifiers
+        for symbol in self.symbols:
+            if scanner.matches.get((self, symbol)):
+                bad_symbols.add(symbol)
+        self.bad_symbols = list(bad_symbols)
         self.compute_status()
 
     def compute_status(self):
@@ -239,18 +443,12 @@ class SymbolsCheck(Check):
     create_from_args = classmethod(create_from_args)
 
 
-class GrepCheck(Check):
-    def run(self):
-        self.nb_occurences = 0
-        try:
-            for base, dirnames, filenames in os.walk(self.module.branch.srcdir):
-                filenames = [x for x in filenames if \
-                             os.path.splitext(x)[-1] in ('.c', '.cc', '.cpp', '.h', '.glade')]
-                for filename in filenames:
-                    if self.grep in file(os.path.join(base, filename)).read():
-                        self.nb_occurences += 1
-        except UnicodeDecodeError:
-            raise ExcludedModuleException()
+class GrepCheck(ScanCheck):
+    def get_patterns(self):
+        return [(SYMBOLS_EXTENSIONS, re.escape(self.grep), None)]
+
+    def process_matches(self, matches):
+        self.nb_occurences = len(set([path for path, line in matches]))
         self.compute_status()
 
     def compute_status(self):
@@ -301,27 +499,195 @@ class FilenamesCheck(Check):
     create_from_args = classmethod(create_from_args)
 
 
-class DeprecatedSymbolsCheck(SymbolsCheck):
-    cached_symbols = {}
-
-    def load_deprecated_symbols(self):
-        if self.cached_symbols.get(self.devhelp_filenames):
-            return self.cached_symbols.get(self.devhelp_filenames)
-        symbols = []
-        for devhelp_filename in self.devhelp_filenames:
+def load_deprecated_symbols(config, devhelp_paths):
+    '''Returns the deprecated symbols listed in devhelp files.
+
+    The symbols of each file are kept in a cache for as long as the file
+    is not modified.'''
+    cachefile = os.path.join(config.xdg_cache_home, 'jhbuild',
+                             'devhelp-symbols.cache')
+    try:
+        cache = cPickle.load(open(cachefile, 'rb'))
+    except Exception:
+        cache = {}
+    modified = False
+    symbols = []
+    for devhelp_path in devhelp_paths:
+        try:
+            st = os.stat(devhelp_path)
+        except OSError:
+            raise CouldNotPerformCheckException()
+        key = (st.st_mtime, st.st_size)
+        if not devhelp_path in cache or cache[devhelp_path][0] != key:
             try:
-                devhelp_path = os.path.join(self.config.devhelp_dirname, devhelp_filename)
                 tree = ET.parse(devhelp_path)
             except:
                 raise CouldNotPerformCheckException()
-            for keyword in tree.findall('//{http://www.devhelp.net/book}keyword'):
+            file_symbols = []
+            for keyword in tree.findall('.//{http://www.devhelp.net/book}keyword'):
                 if not keyword.attrib.has_key('deprecated'):
                     continue
                 name = keyword.attrib.get('name').replace('enum ', '').replace('()', '').strip()
-                symbols.append(name)
-        DeprecatedSymbolsCheck.cached_symbols[self.devhelp_filenames] = symbols
-        return symbols
-    symbols = property(load_deprecated_symbols)
+                file_symbols.append(name)
+            cache[devhelp_path] = (key, file_symbols)
+            modified = True
+        symbols.extend(cache[devhelp_path][1])
+    if modified:
+        try:
+            fileutils.mkdir_with_parents(os.path.dirname(cachefile))
+            writer = fileutils.SafeWriter(cachefile)
+            cPickle.dump(cache, writer.fp, cPickle.HIGHEST_PROTOCOL)
+            writer.commit()
+        except EnvironmentError, e:
+            logging.debug('failed to write %s: %s' % (cachefile, e))
+    return symbols
+
+
+class DeprecatedSymbolsCheck(SymbolsCheck):
+    cached_symbols = {}
+
+    def get_devhelp_paths(cls, config):
+        return tuple([os.path.join(config.devhelp_dirname or '', x)
+                      for x in cls.devhelp_filenames])
+    get_devhelp_paths = classmethod(get_devhelp_paths)
+
+    def prepare(cls, config):
+        # load the symbols before the workers are forked
+        devhelp_paths = cls.get_devhelp_paths(config)
+        if devhelp_paths in cls.cached_symbols:
+            return
+        try:
+            symbols = load_deprecated_symbols(config, devhelp_paths)
+        except CouldNotPerformCheckException:
+            symbols = None
+        DeprecatedSymbolsCheck.cached_symbols[devhelp_paths] = symbols
+    prepare = classmethod(prepare)
+
+    def get_symbols(self):
+        devhelp_paths = self.get_devhelp_paths(self.config)
+        if not devhelp_paths in self.cached_symbols:
+            self.prepare(self.config)
+        if self.cached_symbols[devhelp_paths] is None:
+            raise CouldNotPerformCheckException()
+        return self.cached_symbols[devhelp_paths]
+    symbols = property(get_symbols)
+
+
+class ResultStore:
+    '''Stores the results of the checks in a SQLite database, keyed by
+    module, check and tree id; results are committed as soon as they are
+    known so an interrupted report resumes where it stopped.
+
+    A result is either a [status, complexity, comment] list, or None when
+    the module is excluded from the check.'''
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = ':memory:'
+        try:
+            self.db = self.open(filename)
+        except sqlite3.DatabaseError, e:
+            # most probably a cache file from a previous version; it is
+            # moved aside rather than removed as it may be any file given
+            # by the user
+            logging.warning(_('ignoring invalid cache file %(file)s (moved '
+                              'to %(file)s.old): %(error)s')
+                            % {'file': filename, 'error': e})
+            os.rename(filename, filename + '.old')
+            self.db = self.open(filename)
+
+    def open(self, filename):
+        db = sqlite3.connect(filename)
+        # comment has no type affinity, checks store numbers as well as
+        # strings in it
+        db.execute('''CREATE TABLE IF NOT EXISTS results (
+                          module TEXT, check_name TEXT, tree_id TEXT,
+                          excluded INTEGER, status TEXT, complexity TEXT,
+                          comment,
+                          PRIMARY KEY (module, check_name))''')
+        return db
+
+    def get_results(self):
+        '''Returns the stored results, as a dictionary mapping module names
+        to dictionaries mapping check names to (tree id, result) tuples.'''
+        results = {}
+        for row in self.db.execute('''SELECT module, check_name, tree_id,
+                                      excluded, status, complexity, comment
+                                      FROM results'''):
+            module, check_name, tree_id, excluded = row[:4]
+            if excluded:
+                result = None
+            else:
+                result = list(row[4:])
+            results.setdefault(module, {})[check_name] = (tree_id, result)
+        return results
+
+    def set_result(self, module, check_name, tree_id, result):
+        if result is None:
+            values = (module, check_name, tree_id, 1, None, None, None)
+        else:
+            values = (module, check_name, tree_id, 0) + tuple(result)
+        self.db.execute('''INSERT OR REPLACE INTO results
+                           VALUES (?, ?, ?, ?, ?, ?, ?)''', values)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# context of the checks, set before the pool of workers is forked
+_check_context = None
+
+def init_worker():
+    # interruptions are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_checks(task):
+    '''Runs checks on a module, possibly in a worker process; the sources
+    are scanned once for all the SourceCheck checks.
+
+    Returns the module number along with the list of the check numbers
+    and results to store: a [status, complexity, comment] list, None when
+    the module is excluded from the check, or False when the check could
+    not be performed.'''
+    module_num, check_nums = task
+    config, module_list, checks, false_positives = _check_context
+    mod = module_list[module_num]
+    results = []
+    instances = []
+    scanner = SourceScanner()
+    for check_num in check_nums:
+        try:
+            c = checks[check_num](config, mod)
+            if isinstance(c, SourceCheck):
+                c.prepare_scan(scanner)
+        except ExcludedModuleException:
+            results.append((check_num, None))
+            continue
+        except CouldNotPerformCheckException:
+            results.append((check_num, False))
+            continue
+        instances.append((check_num, c))
+    scanner.scan(mod.branch.srcdir)
+
+    for check_num, c in instances:
+        try:
+            if isinstance(c, SourceCheck):
+                c.process_scan(scanner)
+            else:
+                c.run()
+            c.fix_false_positive(false_positives.get(
+                    (mod.name, checks[check_num].__name__)))
+        except ExcludedModuleException:
+            results.append((check_num, None))
+        except CouldNotPerformCheckException:
+            results.append((check_num, False))
+        else:
+            results.append((check_num,
+                            [c.status, c.complexity, c.result_comment]))
+    return module_num, results
 
 
 class cmd_goalreport(Command):
@@ -388,21 +754,32 @@ class cmd_goalreport(Command):
         else:
             self.module_list = module_set.get_module_list(args or config.modules, config.skip)
 
-        results = {}
         try:
             cachedir = os.path.join(os.environ['XDG_CACHE_HOME'], 'jhbuild')
         except KeyError:
             cachedir = os.path.join(os.environ['HOME'], '.cache','jhbuild')
         if options.cache:
-            try:
-                results = cPickle.load(file(os.path.join(cachedir, options.cache)))
-            except:
-                pass
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            store = ResultStore(os.path.join(cachedir, options.cache))
+        else:
+            store = ResultStore()
 
         self.repeat_row_header = 0
         if len(self.checks) > 4:
             self.repeat_row_header = 1
 
+        # results of modules not part of this report are kept, as the
+        # previous versions of the cache did
+        stored_results = store.get_results()
+        results = {}
+        for module_name, stored in stored_results.items():
+            results[module_name] = {'results': dict(
+                    [(check_name, result) for check_name, (tree_id, result)
+                     in stored.items() if result])}
+
+        tasks = []
+        tree_ids = {}
         for module_num, mod in enumerate(self.module_list):
             if mod.type in ('meta', 'tarball'):
                 continue
@@ -415,45 +792,59 @@ class cmd_goalreport(Command):
                 continue
 
             tree_id = mod.branch.tree_id()
-            valid_cache = (tree_id and results.get(mod.name, {}).get('tree-id') == tree_id)
-
-            if not mod.name in results:
-                results[mod.name] = {
-                    'results': {}
-                }
-            results[mod.name]['tree-id'] = tree_id
+            tree_ids[mod.name] = tree_id
+            stored = stored_results.get(mod.name, {})
+            results[mod.name] = {
+                'tree-id': tree_id,
+                'results': {}
+            }
             r = results[mod.name]['results']
-            for check in self.checks:
-                if valid_cache and check.__name__ in r:
-                    continue
-                try:
-                    c = check(config, mod)
-                except ExcludedModuleException:
-                    continue
-
-                if output != sys.stdout and config.progress_bar:
-                    progress_percent = 1.0 * (module_num-1) / len(self.module_list)
-                    msg = '%s: %s' % (mod.name, check.__name__)
-                    self.display_status_line(progress_percent, module_num, msg)
-
-                try:
-                    c.run()
-                except CouldNotPerformCheckException:
-                    continue
-                except ExcludedModuleException:
-                    continue
-
-                try:
-                    c.fix_false_positive(self.false_positives.get((mod.name, check.__name__)))
-                except ExcludedModuleException:
+            check_nums = []
+            for check_num, check in enumerate(self.checks):
+                if tree_id and check.__name__ in stored and \
+                        stored[check.__name__][0] == tree_id:
+                    if stored[check.__name__][1]:
+                        r[check.__name__] = stored[check.__name__][1]
                     continue
+                check_nums.append(check_num)
+            if check_nums:
+                tasks.append((module_num, check_nums))
 
-                r[check.__name__] = [c.status, c.complexity, c.result_comment]
+        for check in self.checks:
+            check.prepare(config)
+
+        global _check_context
+        _check_context = (config, self.module_list, self.checks,
+                          self.false_positives)
+        pool = None
+        if config.jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(config.jobs, len(tasks)),
+                                        initializer=init_worker)
+            task_results = pool.imap_unordered(run_checks, tasks)
+        else:
+            task_results = (run_checks(x) for x in tasks)
 
-        if not os.path.exists(cachedir):
-            os.makedirs(cachedir)
-        if options.cache:
-            cPickle.dump(results, file(os.path.join(cachedir, options.cache), 'w'))
+        try:
+            for task_num, (module_num, check_results) in enumerate(task_results):
+                mod = self.module_list[module_num]
+                if output != sys.stdout and config.progress_bar:
+                    progress_percent = 1.0 * (task_num+1) / len(tasks)
+                    self.display_status_line(progress_percent, module_num, mod.name)
+                for check_num, result in check_results:
+                    check = self.checks[check_num]
+                    if result is False:
+                        continue
+                    store.set_result(mod.name, check.__name__,
+                                     tree_ids[mod.name], result)
+                    if result:
+                        results[mod.name]['results'][check.__name__] = result
+                store.commit()
+        finally:
+            _check_context = None
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            store.close()
 
         print >> output, HTML_AT_TOP % {'title': self.title}
         if self.page_intro:
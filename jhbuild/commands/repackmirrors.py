@@ -0,0 +1,103 @@
+# jhbuild - a tool to ease building collections of source packages
+# Copyright (C) 2001-2006  James Henstridge
+#
+#   repackmirrors.py: maintenance of the git mirrors shared object store
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import logging
+import subprocess
+from optparse import make_option
+
+from jhbuild.errors import FatalError
+from jhbuild.commands import Command, register_command
+from jhbuild.utils import cmds
+from jhbuild.versioncontrol.git import get_git_shared_store, \
+         get_git_alternates, get_git_extra_env
+
+
+class cmd_repackmirrors(Command):
+    doc = N_('Repack the object store shared by the git mirrors')
+
+    name = 'repackmirrors'
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('--foreground',
+                        action='store_true', dest='foreground', default=False,
+                        help=_('do not run in the background')),
+            ])
+
+    def run(self, config, options, args, help=None):
+        if not config.dvcs_mirror_dir:
+            raise FatalError(_('%s is not set') % 'dvcs_mirror_dir')
+        shared_store = get_git_shared_store(config.dvcs_mirror_dir)
+        if not os.path.exists(shared_store):
+            raise FatalError(_('no shared object store in %s') %
+                             config.dvcs_mirror_dir)
+
+        if options.foreground:
+            return self.repack(config, shared_store)
+
+        pid = os.fork()
+        if pid:
+            uprint(_('Repacking the git mirrors in the background (pid %d)')
+                   % pid)
+            return 0
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        rc = 1
+        try:
+            rc = self.repack(config, shared_store)
+        finally:
+            os._exit(rc)
+
+    def repack(self, config, shared_store):
+        nice_args = []
+        if cmds.has_command('nice'):
+            nice_args = ['nice']
+        env = os.environ.copy()
+        for key, value in get_git_extra_env().items():
+            if value is not None:
+                env[key] = value
+
+        # the checkouts may still use objects that upstream dropped after a
+        # forced push or a branch removal, never delete them
+        rc = subprocess.call(nice_args + ['git', 'repack', '-a', '-d', '-q',
+                                          '--keep-unreachable'],
+                             cwd=shared_store, env=env)
+        if rc != 0:
+            logging.error(_('failed to repack %s') % shared_store)
+            return 1
+
+        objects_dir = os.path.join(os.path.realpath(shared_store), 'objects')
+        for name in sorted(os.listdir(config.dvcs_mirror_dir)):
+            mirror_dir = os.path.join(config.dvcs_mirror_dir, name)
+            if mirror_dir == shared_store:
+                continue
+            if not objects_dir in get_git_alternates(mirror_dir):
+                continue
+            # -l leaves out the objects borrowed from the shared store
+            if subprocess.call(nice_args + ['git', 'repack', '-a', '-d',
+                                            '-l', '-q', '--keep-unreachable'],
+                               cwd=mirror_dir, env=env) != 0:
+                logging.error(_('failed to repack %s') % mirror_dir)
+                rc = 1
+        return rc
+
+register_command(cmd_repackmirrors)
@@ -187,7 +187,7 @@ class cmd_sysdeps(cmd_build):
                 print _('    (none)')
 
         if options.install:
-            installer = SystemInstall.find_best()
+            installer = SystemInstall.find_best(config)
             if installer is None:
                 # FIXME: This should be implemented per Colin's design:
                 # https://bugzilla.gnome.org/show_bug.cgi?id=682104#c3
@@ -21,6 +21,7 @@ from optparse import make_option
 
 from jhbuild.errors import UsageError, FatalError
 from jhbuild.commands import Command, BuildCommand, register_command
+import jhbuild.moduleset
 import jhbuild.frontends
 import optparse
 
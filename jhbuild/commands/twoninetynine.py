@@ -24,90 +24,92 @@ import re
 from jhbuild.commands import Command, register_command
 
 from goalreport import cmd_goalreport, ExcludedModuleException, \
-         Check, ShellCheck, DeprecatedSymbolsCheck, FIND_C
-
-class LibBonobo(ShellCheck):
-    cmds = (
-        FIND_C + " | grep -v .dead.c | xargs grep '^#include <libbonobo'",
-        FIND_C + " | grep -v .dead.c | xargs grep '^#include <bonobo'",
-        FIND_C + " | grep -v .dead.c | xargs grep 'BonoboObject'",
-        FIND_C + " | grep -v .dead.c | xargs grep 'BonoboApplication'",
-        "find -name '*.py' | xargs grep 'import .*bonobo'",
+         Check, ScanCheck, DeprecatedSymbolsCheck, C_EXTENSIONS
+
+class LibBonobo(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libbonobo', r'\.dead\.c:'),
+        (C_EXTENSIONS, '^#include <bonobo', r'\.dead\.c:'),
+        (C_EXTENSIONS, 'BonoboObject', r'\.dead\.c:'),
+        (C_EXTENSIONS, 'BonoboApplication', r'\.dead\.c:'),
+        (('.py',), 'import .*bonobo', None),
     )
 
-class LibGnome(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <libgnome/' | "\
-                        "egrep -v 'gnome-desktop-item.h|gnome-desktop-utils.h'",
+class LibGnome(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libgnome/',
+                        'gnome-desktop-item.h|gnome-desktop-utils.h'),
                         # gnome-desktop installs stuff under libgnome/
-        FIND_C + " | xargs grep '^#include <gnome.h>'",
-        "find -name '*.cs' | xargs grep 'Gnome.Url.'", # as 'using ...' is not mandatory
-        "find -name '*.cs' | xargs grep 'Gnome.Program.'",
+        (C_EXTENSIONS, '^#include <gnome.h>', None),
+        (('.cs',), 'Gnome.Url.', None), # as 'using ...' is not mandatory
+        (('.cs',), 'Gnome.Program.', None),
     )
 
-class LibGnomeUi(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <libgnomeui/' | egrep -v '"\
-                    "gnome-rr.h|"\
-                    "gnome-rr-config.h|"\
-                    "gnome-rr-labeler.h|"\
-                    "gnome-desktop-thumbnail.h|"\
-                    "gnome-bg-crossfade.h|"\
-                    "gnome-bg.h'", # gnome-desktop installs stuff under libgnomeui/
-        "find -name '*.py' | xargs grep 'import .*gnome\.ui'",
+class LibGnomeUi(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libgnomeui/',
+                    'gnome-rr.h|'\
+                    'gnome-rr-config.h|'\
+                    'gnome-rr-labeler.h|'\
+                    'gnome-desktop-thumbnail.h|'\
+                    'gnome-bg-crossfade.h|'\
+                    'gnome-bg.h'), # gnome-desktop installs stuff under libgnomeui/
+        (('.py',), r'import .*gnome\.ui', None),
     )
 
-class LibGnomeCanvas(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <libgnomecanvas/'",
-        "find -name '*.py' | xargs grep 'import .*gnomecanvas'",
+class LibGnomeCanvas(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libgnomecanvas/', None),
+        (('.py',), 'import .*gnomecanvas', None),
     )
 
-class LibArtLgpl(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <libart_lgpl/'",
-        "find -name '*.cs' | xargs grep '^using Art;'",
+class LibArtLgpl(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libart_lgpl/', None),
+        (('.cs',), '^using Art;', None),
     )
 
-class LibGnomeVfs(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <libgnomevfs/'",
-        "find -name '*.py' | xargs grep 'import .*gnomevfs'",
-        "find -name '*.cs' | xargs grep '^using Gnome.Vfs'",
-        "find -name '*.cs' | xargs grep 'Gnome.Vfs.Initialize'",
+class LibGnomeVfs(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libgnomevfs/', None),
+        (('.py',), 'import .*gnomevfs', None),
+        (('.cs',), '^using Gnome.Vfs', None),
+        (('.cs',), 'Gnome.Vfs.Initialize', None),
     )
 
-class LibGnomePrint(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <libgnomeprint'",
-        "find -name '*.py' | xargs grep 'import .*gnomeprint'",
+class LibGnomePrint(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <libgnomeprint', None),
+        (('.py',), 'import .*gnomeprint', None),
     )
 
 
-class Esound(ShellCheck):
-    cmd = FIND_C + " | xargs grep '^#include <esd.h>'"
+class Esound(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <esd.h>', None),
+    )
 
-class Orbit(ShellCheck):
-    cmds = (
-        FIND_C + " | xargs grep '^#include <orbit'",
-        "find -name '*.py' | xargs grep 'import .*bonobo'",
+class Orbit(ScanCheck):
+    patterns = (
+        (C_EXTENSIONS, '^#include <orbit', None),
+        (('.py',), 'import .*bonobo', None),
     )
 
-class LibGlade(ShellCheck):
+class LibGlade(ScanCheck):
     excluded_modules = ('libglade',)
-    cmds = (
-        FIND_C + " | xargs grep '^#include <glade/'",
-        FIND_C + " | xargs grep '^#include <libglademm.h>'",
-        "find -name '*.py' | xargs grep 'import .*glade'",
-        "find -name '*.cs' | xargs grep '^using Glade'",
+    patterns = (
+        (C_EXTENSIONS, '^#include <glade/', None),
+        (C_EXTENSIONS, '^#include <libglademm.h>', None),
+        (('.py',), 'import .*glade', None),
+        (('.cs',), '^using Glade', None),
     )
 
-class GConf(ShellCheck):
+class GConf(ScanCheck):
     excluded_modules = ('gconf',)
-    cmds = (
-        FIND_C + " | xargs grep '^#include <gconf/'",
-        "find -name '*.py' | xargs grep 'import .*gconf'",
-        "find -name '*.cs' | xargs grep '^using GConf'",
+    patterns = (
+        (C_EXTENSIONS, '^#include <gconf/', None),
+        (('.py',), 'import .*gconf', None),
+        (('.cs',), '^using GConf', None),
     )
 
 class GlibDeprecatedSymbols(DeprecatedSymbolsCheck):
@@ -190,7 +192,7 @@ relative to the number of deprecated symbols in use (&lt;5/&lt;20/&gt;=20).
             ])
 
     def run(self, config, options, args, help=None):
-        options.cache = 'twoninetynine.pck'
+        options.cache = 'twoninetynine.sqlite'
         if options.nocache:
             options.cache = None
         options.bugfile = 'http://live.gnome.org/FredericPeters/Bugs299?action=raw'
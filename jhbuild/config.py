@@ -27,7 +27,12 @@ import traceback
 import time
 import types
 import logging
+import cPickle
 import __builtin__
+try:
+    import hashlib
+except ImportError:
+    import md5 as hashlib
 
 from jhbuild.environment import setup_env, setup_env_defaults, addpath
 from jhbuild.errors import FatalError
@@ -49,7 +54,8 @@ _known_keys = [ 'moduleset', 'modules', 'skip', 'tags', 'prefix',
                 'interact', 'buildscript', 'nonetwork', 'nobuild',
                 'alwaysautogen', 'noinstall', 'makeclean', 'makedistclean',
                 'makecheck', 'module_makecheck', 'system_libdirs',
-                'tinderbox_outputdir', 'sticky_date', 'tarballdir',
+                'tinderbox_outputdir', 'tinderbox_compress_logs',
+                'sticky_date', 'tarballdir',
                 'pretty_print', 'svn_program', 'makedist', 'makedistcheck',
                 'nonotify', 'notrayicon', 'cvs_program', 'checkout_mode',
                 'copy_dir', 'module_checkout_mode', 'build_policy',
@@ -61,12 +67,17 @@ _known_keys = [ 'moduleset', 'modules', 'skip', 'tags', 'prefix',
                 'jhbuildbot_dir', 'jhbuildbot_mastercfg',
                 'use_local_modulesets', 'ignore_suggests', 'modulesets_dir',
                 'mirror_policy', 'module_mirror_policy', 'dvcs_mirror_dir',
+                'dvcs_mirror_alternates', 'partial_clone',
+                'module_partial_clone', 'single_branch_clone',
+                'check_remote_heads',
                 'shallow_clone', 'build_targets', 'cmakeargs', 'module_cmakeargs',
                 'print_command_pattern', 'static_analyzer',
                 'module_static_analyzer', 'static_analyzer_template',
                 'static_analyzer_outputdir', 'check_sysdeps', 'system_prefix',
                 'help_website', 'conditions', 'extra_prefixes',
-                'disable_Werror', 'xdg_cache_home', 'exit_on_error'
+                'defer_triggers', 'disable_Werror', 'xdg_cache_home',
+                'exit_on_error', 'build_events_file', 'trace_file',
+                'resource_summary', 'serve_port', 'config_cache'
               ]
 
 env_prepends = {}
@@ -91,6 +102,20 @@ def modify_conditions(conditions, conditions_modifiers):
             else:
                 raise FatalError(_("Invalid condition set modifier: '%s'.  Must start with '+' or '-'.") % mod)
 
+# the variables changed by shells on most commands, ignored by the cache
+_cache_volatile_variables = ('PWD', 'OLDPWD', 'SHLVL', '_')
+
+def _get_files_state(filenames):
+    state = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            state.append((filename, None, None))
+        else:
+            state.append((filename, st.st_mtime, st.st_size))
+    return state
+
 class Config:
     _orig_environ = None
 
@@ -101,19 +126,15 @@ class Config:
             'prependpath':  prependpath,
             'include': self.include,
             }
+        self._included_files = []
 
         if not self._orig_environ:
             self.__dict__['_orig_environ'] = os.environ.copy()
+        cache_key = self.get_cache_key(conditions_modifiers)
+        start_environ = os.environ.copy()
         os.environ['UNMANGLED_LD_LIBRARY_PATH'] = os.environ.get('LD_LIBRARY_PATH', '')
         os.environ['UNMANGLED_PATH'] = os.environ.get('PATH', '')
 
-        env_prepends.clear()
-        try:
-            execfile(_defaults_file, self._config)
-        except:
-            traceback.print_exc()
-            raise FatalError(_('could not load config defaults'))
-
         old_config = os.path.join(os.path.expanduser('~'), '.jhbuildrc')
         new_config = os.path.join \
                          (os.environ.get \
@@ -140,15 +161,40 @@ class Config:
                 filename = old_config
 
         if filename:
-            self._config['__file__'] = filename
             self.filename = filename
         else:
-            self._config['__file__'] = new_config
             self.filename = new_config
 
         # we might need to redo this process on config reloads, so save these
         self.saved_conditions_modifiers = conditions_modifiers
 
+        # the cache only holds the evaluation of the configuration files, the
+        # environment of the prefixes depends on what is installed in them
+        cache_filename = self.get_cache_filename()
+        if not self.load_cache(cache_filename, cache_key):
+            self.load_config(filename, conditions_modifiers)
+            self.save_cache(cache_filename, cache_key, start_environ)
+
+        self.create_directories()
+
+        setup_env_defaults(self.system_libdirs)
+
+        for prefix in reversed(self.extra_prefixes):
+            setup_env(prefix)
+        setup_env(self.prefix)
+
+        self.apply_env_prepends()
+        self.update_build_targets()
+
+    def load_config(self, filename, conditions_modifiers):
+        env_prepends.clear()
+        try:
+            execfile(_defaults_file, self._config)
+        except:
+            traceback.print_exc()
+            raise FatalError(_('could not load config defaults'))
+        self._config['__file__'] = self.filename
+
         # We handle the conditions flags like so:
         #   - get the default set of conditions (determined by the OS)
         #   - modify it with the commandline arguments
@@ -166,16 +212,91 @@ class Config:
         self.load(filename)
         modify_conditions(self.conditions, conditions_modifiers)
 
-        self.create_directories()
-
-        setup_env_defaults(self.system_libdirs)
-
-        for prefix in reversed(self.extra_prefixes):
-            setup_env(prefix)
-        setup_env(self.prefix)
-
-        self.apply_env_prepends()
-        self.update_build_targets()
+    def get_cache_key(self, conditions_modifiers):
+        '''Returns a digest of what the evaluation of the configuration
+        depends on, besides the files: the environment, except for the
+        variables changed by every shell, and the command line.'''
+        environ = [(name, value) for name, value in os.environ.items()
+                   if not name in _cache_volatile_variables]
+        key = (sys.version, SRCDIR, PKGDATADIR, sorted(environ),
+               list(conditions_modifiers))
+        return hashlib.md5(repr(key)).hexdigest()
+
+    def get_cache_filename(self):
+        cache_home = os.environ.get('XDG_CACHE_HOME',
+                                    os.path.join(os.path.expanduser('~'),
+                                                 '.cache'))
+        return os.path.join(cache_home, 'jhbuild', 'config-%s' %
+                hashlib.md5(os.path.abspath(self.filename)).hexdigest())
+
+    def get_cache_files(self):
+        # the files whose changes invalidate the cache: the configuration
+        # files and the code evaluating them
+        code_files = [os.path.splitext(x.__file__)[0] + '.py'
+                      for x in (sys.modules[__name__],
+                                sys.modules[setup_env.__module__])]
+        return [_defaults_file, self.filename] + code_files + \
+               self._included_files
+
+    def load_cache(self, cache_filename, cache_key):
+        '''Restores the configuration and the changes to the environment
+        saved by save_cache(), if the configuration files and the environment
+        did not change.'''
+        try:
+            cache = cPickle.load(open(cache_filename, 'rb'))
+        except Exception:
+            return False
+        if cache.get('key') != cache_key:
+            return False
+        if _get_files_state([x[0] for x in cache['files']]) != cache['files']:
+            return False
+        # the variables the configuration changed
+        for name in cache['unset_environ']:
+            os.environ.pop(name, None)
+        os.environ.update(cache['environ'])
+        for name, value in cache['attributes'].items():
+            setattr(self, name, value)
+        env_prepends.clear()
+        env_prepends.update(cache['env_prepends'])
+        self._config['__file__'] = self.filename
+        return True
+
+    def save_cache(self, cache_filename, cache_key, start_environ):
+        '''Saves the evaluated configuration and the changes it made to the
+        environment, if the config_cache option is set.  The environment of
+        the prefixes is left out, as it depends on their contents.  The file
+        is only readable by the user, as the environment may contain
+        secrets.'''
+        if not self.config_cache:
+            if os.path.exists(cache_filename):
+                os.unlink(cache_filename)
+            return
+        from jhbuild.utils import fileutils
+        attributes = self.__dict__.copy()
+        del attributes['_config']
+        del attributes['_orig_environ']
+        environ = dict([(name, value) for name, value in os.environ.items()
+                        if start_environ.get(name) != value])
+        unset_environ = [name for name in start_environ
+                         if not name in os.environ]
+        try:
+            fileutils.mkdir_with_parents(os.path.dirname(cache_filename))
+            writer = fileutils.SafeWriter(cache_filename, mode=0600)
+            try:
+                cPickle.dump({'key': cache_key,
+                              'files': _get_files_state(self.get_cache_files()),
+                              'attributes': attributes,
+                              'environ': environ,
+                              'unset_environ': unset_environ,
+                              'env_prepends': env_prepends},
+                             writer.fp, cPickle.HIGHEST_PROTOCOL)
+            except (cPickle.PicklingError, TypeError), e:
+                writer.abandon()
+                logging.debug('could not cache the configuration: %s' % e)
+                return
+            writer.commit()
+        except EnvironmentError, e:
+            logging.debug('failed to write %s: %s' % (cache_filename, e))
 
     def reload(self):
         os.environ = self._orig_environ.copy()
@@ -184,6 +305,7 @@ class Config:
 
     def include(self, filename):
         '''Read configuration variables from a file.'''
+        self._included_files.append(os.path.abspath(filename))
         try:
             execfile(filename, self._config)
         except:
@@ -275,6 +397,14 @@ class Config:
         if seen_copy_mode and not self.copy_dir:
             raise FatalError(_('copy mode requires copy_dir to be set'))
 
+        # check possible partial_clone values
+        possible_partial_clones = (None, 'blobless', 'treeless')
+        if self.partial_clone not in possible_partial_clones:
+            raise FatalError(_('invalid partial clone'))
+        for module, partial_clone in self.module_partial_clone.items():
+            if partial_clone not in possible_partial_clones:
+                raise FatalError(_('invalid partial clone (module: %s)') % module)
+
         if not os.path.exists(self.modulesets_dir):
             if self.use_local_modulesets:
                 logging.warning(
@@ -386,6 +516,12 @@ class Config:
             self.nopoison = True
         if hasattr(options, 'quiet') and options.quiet:
             self.quiet_mode = True
+        if hasattr(options, 'events_file') and options.events_file:
+            self.build_events_file = options.events_file
+        if hasattr(options, 'trace_file') and options.trace_file:
+            self.trace_file = options.trace_file
+        if hasattr(options, 'serve_port') and options.serve_port:
+            self.serve_port = options.serve_port
         if hasattr(options, 'force_policy') and options.force_policy:
             self.build_policy = 'all'
         if hasattr(options, 'min_age') and options.min_age:
@@ -67,15 +67,16 @@ def addpath(envvar, path, prepend=True):
         else:
             parts.append(path)
         # remove duplicate entries:
-        i = 1
-        while i < len(parts):
-            if parts[i] in parts[:i]:
-                del parts[i]
-            elif envvar == 'PYTHONPATH' and parts[i] == "":
-                del parts[i]
-            else:
-                i += 1
-        envval = pathsep.join(parts)
+        seen = set(parts[:1])
+        unique_parts = parts[:1]
+        for part in parts[1:]:
+            if part in seen:
+                continue
+            if envvar == 'PYTHONPATH' and part == "":
+                continue
+            seen.add(part)
+            unique_parts.append(part)
+        envval = pathsep.join(unique_parts)
 
     os.environ[envvar] = envval
 
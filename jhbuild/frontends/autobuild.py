@@ -25,14 +25,23 @@ import locale
 import socket
 
 from jhbuild.utils import cmds
+from jhbuild.utils import sysid
 from jhbuild.errors import CommandError
 import buildscript
 
 import xmlrpclib
 import zlib
+import cPickle
+import httplib
+import logging
+import threading
+import Queue
+try:
+    import hashlib
+except ImportError:
+    import md5 as hashlib
 from cStringIO import StringIO
 
-from tinderbox import get_distro
 from terminal import TerminalBuildScript, trayicon, t_bold, t_reset
 import jhbuild.moduleset
 
@@ -56,9 +65,10 @@ def compress_data(data):
 
 class ServerProxy(xmlrpclib.ServerProxy):
     verbose_timeout = False
+    ITERS = 10
 
     def __request(self, methodname, params):
-        ITERS = 10
+        ITERS = self.ITERS
         for i in range(ITERS):
             try:
                 return xmlrpclib.ServerProxy.__request(self, methodname, params)
@@ -77,6 +87,115 @@ class ServerProxy(xmlrpclib.ServerProxy):
                 raise e
             
 
+class ReportQueue(object):
+    '''Sends calls to the report server from a separate thread, so the
+    build does not wait for the server.
+
+    The calls queued while a call is in progress are sent together with
+    system.multicall, when the server supports it.  Calls that can not be
+    delivered are appended to a spool file, and sent again, in order,
+    before the next calls, and at the next build.'''
+
+    max_batch = 50
+
+    def __init__(self, server, spool_filename):
+        self.server = server
+        self.spool_filename = spool_filename
+        self.multicall = True
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def call(self, methodname, *params):
+        self.queue.put((methodname, params))
+
+    def close(self):
+        '''Waits until all the calls are delivered or spooled.'''
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        # deliver what a previous build left behind first
+        self.send(self.read_spool())
+        done = False
+        while not done:
+            calls = [self.queue.get()]
+            while len(calls) < self.max_batch:
+                try:
+                    calls.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in calls:
+                calls = calls[:calls.index(None)]
+                done = True
+            self.send(self.read_spool() + calls)
+
+    def read_spool(self):
+        calls = []
+        if not os.path.exists(self.spool_filename):
+            return calls
+        fp = open(self.spool_filename, 'rb')
+        try:
+            while True:
+                try:
+                    calls.append(cPickle.load(fp))
+                except EOFError:
+                    break
+        finally:
+            fp.close()
+        os.unlink(self.spool_filename)
+        return calls
+
+    def spool(self, calls):
+        try:
+            if not os.path.exists(os.path.dirname(self.spool_filename)):
+                os.makedirs(os.path.dirname(self.spool_filename))
+            fp = open(self.spool_filename, 'ab')
+            for call in calls:
+                cPickle.dump(call, fp, cPickle.HIGHEST_PROTOCOL)
+            fp.close()
+        except EnvironmentError, e:
+            logging.error(_('failed to spool reports to %(file)s: %(error)s')
+                          % {'file': self.spool_filename, 'error': e})
+
+    def send(self, calls):
+        while calls:
+            try:
+                if self.multicall and len(calls) > 1:
+                    multicall = xmlrpclib.MultiCall(self.server)
+                    for methodname, params in calls:
+                        getattr(multicall, methodname)(*params)
+                    results = multicall()
+                    for i in range(len(calls)):
+                        try:
+                            results[i]
+                        except xmlrpclib.Fault, e:
+                            logging.error(_('report server error: %s') %
+                                          e.faultString)
+                else:
+                    methodname, params = calls[0]
+                    try:
+                        getattr(self.server, methodname)(*params)
+                    except xmlrpclib.Fault, e:
+                        logging.error(_('report server error: %s') %
+                                      e.faultString)
+                    calls = calls[1:]
+                    continue
+            except xmlrpclib.Fault:
+                # system.multicall is not supported by the server
+                self.multicall = False
+                continue
+            except (socket.error, httplib.HTTPException,
+                    xmlrpclib.ProtocolError):
+                self.spool(calls)
+                return
+            calls = []
+
+
 class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
     xmlrpc_report_url = None
     verbose = False
@@ -86,6 +205,7 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
         self.xmlrpc_report_url = config.autobuild_report_url
         self.verbose = config.verbose
         self.server = None
+        self.reports = None
         self.modulefp = None
         self.phasefp = None
         self.modules = {}
@@ -140,47 +260,58 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
         kws['stdin'] = subprocess.PIPE
         kws['stdout'] = subprocess.PIPE
         kws['stderr'] = subprocess.PIPE
+        def join_lines(lines):
+            text = ''.join(lines)
+            if text.endswith('\n'):
+                text = text[:-1]
+            return text
         if hint in ('cvs', 'svn', 'hg-update.py'):
-            def format_line(line, error_output, fp=self.phasefp):
-                if line[-1] == '\n': line = line[:-1]
+            def format_lines(lines, error_output, fp=self.phasefp):
+                text = join_lines(lines)
                 if self.verbose:
-                    print line
-                if line.startswith('C '):
-                    fp.write('<span class="conflict">%s</span>\n'
-                                        % escape(line))
-                else:
-                    fp.write('%s\n' % escape(line))
+                    print text
+                output = []
+                for line in escape(text).split('\n'):
+                    if line.startswith('C '):
+                        output.append('<span class="conflict">%s</span>\n'
+                                      % line)
+                    else:
+                        output.append('%s\n' % line)
+                fp.write(''.join(output))
             kws['stderr'] = subprocess.STDOUT
         else:
-            def format_line(line, error_output, fp=self.phasefp):
-                if line[-1] == '\n': line = line[:-1]
+            def format_lines(lines, error_output, fp=self.phasefp):
+                text = join_lines(lines)
                 if self.verbose:
                     if error_output:
-                        print >> sys.stderr, line
+                        print >> sys.stderr, text
                     else:
-                        print line
+                        print text
                 if error_output:
-                    fp.write('<span class="error">%s</span>\n'
-                                        % escape(line))
+                    fp.write(''.join(['<span class="error">%s</span>\n' % line
+                                      for line in escape(text).split('\n')]))
                 else:
-                    fp.write('%s\n' % escape(line))
+                    fp.write('%s\n' % escape(text))
 
         if cwd is not None:
             kws['cwd'] = cwd
 
         if extra_env is not None:
-            kws['env'] = os.environ.copy()
-            kws['env'].update(extra_env)
+            kws['env'] = cmds.get_environ(extra_env)
 
+        self.notify_observers('start_command', command, cwd or os.getcwd())
         command = self._prepare_execute(command)
 
         try:
-            p = subprocess.Popen(command, **kws)
+            p = cmds.Popen(command, **kws)
         except OSError, e:
+            self.notify_observers('end_command', None, None, None)
             self.phasefp.write('<span class="error">' + _('Error: %s') % escape(str(e)) + '</span>\n')
             raise CommandError(str(e))
 
-        cmds.pprint_output(p, format_line)
+        cmds.pump_output(p, self._observe_output(format_lines))
+        self.notify_observers('end_command', p.returncode, p.rusage,
+                              p.output_bytes)
         if p.returncode != 0:
             raise CommandError(_('Error running %s') % command, p.returncode)
 
@@ -199,7 +330,7 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
         info['build_host'] = socket.gethostname()
         info['architecture'] = (un[0], un[2], un[4])
 
-        distro = get_distro()
+        distro = sysid.get_pretty_name()
         if distro:
             info['distribution'] = distro
 
@@ -214,6 +345,10 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
             raise
 
         
+        self.reports = ReportQueue(self.server, os.path.join(
+                self.config.xdg_cache_home, 'jhbuild', 'autobuild-spool-%s'
+                % hashlib.md5(self.xmlrpc_report_url).hexdigest()))
+
         if self.verbose:
             s = _('Starting Build #%s') % self.build_id
             print s
@@ -222,7 +357,8 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
 
 
     def end_build(self, failures):
-        self.server.end_build(self.build_id, failures)
+        self.reports.call('end_build', self.build_id, failures)
+        self.reports.close()
         if self.verbose:
             TerminalBuildScript.end_build(self, failures)
 
@@ -230,7 +366,7 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
     def start_module(self, module):
         if self.verbose:
             print '\n%s' % t_bold + _('**** Starting module %s ****' % module) + t_reset
-        self.server.start_module(self.build_id, module)
+        self.reports.call('start_module', self.build_id, module)
         self.current_module = module
         self.modulefp = StringIO()
         
@@ -238,10 +374,11 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
     def end_module(self, module, failed):
         log = fix_encoding(self.modulefp.getvalue())
         self.modulefp = None
-        self.server.end_module(self.build_id, module, compress_data(log), failed)
+        self.reports.call('end_module', self.build_id, module,
+                          compress_data(log), failed)
 
     def start_phase(self, module, phase):
-        self.server.start_phase(self.build_id, module, phase)
+        self.reports.call('start_phase', self.build_id, module, phase)
         if self.verbose:
             TerminalBuildScript.start_phase(self, module, phase)
         self.phasefp = StringIO()
@@ -261,7 +398,8 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
 
         if isinstance(error, Exception):
             error = unicode(error)
-        self.server.end_phase(self.build_id, module, phase, compress_data(log), error)
+        self.reports.call('end_phase', self.build_id, module, phase,
+                          compress_data(log), error)
 
     def handle_error(self, module, phase, nextphase, error, altphases):
         '''handle error during build'''
@@ -281,8 +419,8 @@ class AutobuildBuildScript(buildscript.BuildScript, TerminalBuildScript):
     def _upload_logfile (self, module, logfile, mimetype):
         log = open (logfile, 'r')
         basename = os.path.basename (logfile)
-        self.server.attach_file (self.build_id, module, 'test', basename,
-                                 compress_data(log.read()), mimetype)
+        self.reports.call('attach_file', self.build_id, module, 'test',
+                          basename, compress_data(log.read()), mimetype)
         log.close()
 
 BUILD_SCRIPT = AutobuildBuildScript
@@ -25,9 +25,14 @@ import sys
 
 from jhbuild.utils import trigger
 from jhbuild.utils import cmds
+from jhbuild.utils import buildevents
+from jhbuild.versioncontrol.git import check_remote_heads
 from jhbuild.errors import FatalError, CommandError, SkipToPhase, SkipToEnd
 
 class BuildScript:
+    # set when an observer wants the output of the commands
+    observe_output = False
+
     def __init__(self, config, module_list=None, module_set=None):
         if self.__class__ is BuildScript:
             raise NotImplementedError('BuildScript is an abstract base class')
@@ -38,6 +43,24 @@ class BuildScript:
 
         self.config = config
 
+        self._triggers = {}
+        self._deferred_triggers = []
+
+        self.observers = []
+        if self.config.build_events_file:
+            self.add_observer(buildevents.EventStream(
+                    self.config.build_events_file))
+        if self.config.trace_file:
+            self.add_observer(buildevents.TraceFile(self.config.trace_file))
+        self.resource_summary = None
+        if self.config.resource_summary:
+            self.resource_summary = buildevents.ResourceSummary()
+            self.add_observer(self.resource_summary)
+        if self.config.serve_port:
+            from jhbuild.utils.statusserver import StatusServer
+            self.add_observer(StatusServer(self.config.serve_port,
+                                           self.modulelist or []))
+
         # the existence of self.config.prefix is checked in config.py
         if not os.access(self.config.prefix, os.R_OK|os.W_OK|os.X_OK):
             raise FatalError(_('install prefix (%s) must be writable') % self.config.prefix)
@@ -79,6 +102,50 @@ class BuildScript:
                 if subproc.returncode == 0 and len(stderr_val) == 0:
                     self.subprocess_nice_args.extend(ionice_args)
 
+    def add_observer(self, observer):
+        '''Adds a buildevents.BuildObserver to notify of the progress of
+        the build.'''
+        self.observers.append(observer)
+        if observer.wants_output:
+            self.observe_output = True
+
+    def _call_observer(self, observer, method, *args):
+        # observers only report on the build, a failing one (a full disk,
+        # a closed connection) must not abort it, and is dropped instead
+        try:
+            getattr(observer, method)(*args)
+        except Exception, e:
+            logging.warning(_('Build observer %(observer)s failed, '
+                              'detaching it: %(error)s') %
+                            {'observer': observer.__class__.__name__,
+                             'error': e})
+            self.observers.remove(observer)
+            self.observe_output = bool([x for x in self.observers
+                                        if x.wants_output])
+
+    def notify_observers(self, method, *args):
+        for observer in self.observers[:]:
+            self._call_observer(observer, method, *args)
+
+    def notify_output(self, lines, error_output=False):
+        '''Passes lines of the output of the current command to the
+        observers wanting it.  Implementations of execute() capture the
+        output and call this when observe_output is set.'''
+        for observer in self.observers[:]:
+            if observer.wants_output:
+                self._call_observer(observer, 'command_output', lines,
+                                    error_output)
+
+    def _observe_output(self, format_lines):
+        '''Wraps a format_lines callback of cmds.pump_output() to also pass
+        the output to the observers wanting it.'''
+        if not self.observe_output:
+            return format_lines
+        def observed_format_lines(lines, error_output):
+            format_lines(lines, error_output)
+            self.notify_output(lines, error_output)
+        return observed_format_lines
+
     def _prepare_execute(self, command):
         if self.subprocess_nice_args:
             if isinstance(command, (str, unicode)):
@@ -92,13 +159,30 @@ class BuildScript:
 
         If an error occurs, CommandError is raised.  The hint argument
         gives a hint about the type of output to expect.
+
+        Implementations notify the observers with start_command and
+        end_command around the execution of the command.
         '''
         raise NotImplementedError
 
     def build(self, phases=None):
         '''start the build of the current configuration'''
+        try:
+            return self._build_modules(phases)
+        finally:
+            # also when exiting on an error or interrupted, so the
+            # observers write out what they recorded
+            self.notify_observers('close')
+
+    def _build_modules(self, phases):
         self.start_build()
-        
+        self.notify_observers('start_build')
+
+        if (self.config.check_remote_heads and not self.config.nonetwork
+                and (not phases or 'checkout' in phases)):
+            check_remote_heads([getattr(module, 'branch', None)
+                                for module in self.modulelist])
+
         failures = [] # list of modules that couldn't be built
         successes = []
         self.module_num = 0
@@ -112,6 +196,7 @@ class BuildScript:
                     continue
 
             self.start_module(module.name)
+            self.notify_observers('start_module', module.name)
             failed = False
             for dep in module.dependencies:
                 if dep in failures:
@@ -126,6 +211,7 @@ class BuildScript:
             if failed:
                 failures.append(module.name)
                 self.end_module(module.name, failed)
+                self.notify_observers('end_module', module.name, failed)
                 continue
 
             if not phases:
@@ -157,6 +243,7 @@ class BuildScript:
                     continue
 
                 self.start_phase(module.name, phase)
+                self.notify_observers('start_phase', module.name, phase)
                 error = None
                 try:
                     try:
@@ -174,6 +261,10 @@ class BuildScript:
 
                 if error:
                     if self.config.exit_on_error:
+                        failures.append(module.name)
+                        self.notify_observers('end_module', module.name, True)
+                        self._run_deferred_triggers()
+                        self.notify_observers('end_build', failures)
                         sys.exit(1)
 
                     try:
@@ -217,12 +308,22 @@ class BuildScript:
                     num_phase += 1
 
             self.end_module(module.name, failed)
+            self.notify_observers('end_module', module.name, failed)
+
+        self._run_deferred_triggers()
 
         self.end_build(failures)
+        self.notify_observers('end_build', failures)
         if failures:
             return 1
         return 0
 
+    def _run_deferred_triggers(self):
+        if self._deferred_triggers:
+            modules = self._deferred_triggers
+            self._deferred_triggers = []
+            self.run_triggers(modules)
+
     def run_triggers(self, modules):
         """See triggers/README."""
         assert 'JHBUILD_PREFIX' in os.environ
@@ -232,7 +333,10 @@ class BuildScript:
             trigger_path = os.path.join(PKGDATADIR, 'triggers')
         else:
             trigger_path = os.path.join(SRCDIR, 'triggers')
-        all_triggers = trigger.load_all(trigger_path)
+        if not trigger_path in self._triggers:
+            self._triggers[trigger_path] = trigger.TriggerMatcher(
+                    trigger.load_all(trigger_path))
+        matcher = self._triggers[trigger_path]
 
         triggers_to_run = set()
 
@@ -250,12 +354,10 @@ class BuildScript:
             if pkg.manifest is None:
                 continue
 
-            for trig in all_triggers:
-                if trig.matches(pkg.manifest):
-                    triggers_to_run.add(trig)
+            triggers_to_run.update(matcher.matches(pkg.manifest))
 
         if not modules:
-            triggers_to_run = set(all_triggers)
+            triggers_to_run = set(matcher.triggers)
 
         for trig in triggers_to_run:
             logging.info(_('Running post-installation trigger script: %r') % (trig.name, ))
@@ -310,6 +412,12 @@ class BuildScript:
         '''Hook to perform actions at end of build.
         The argument is a list of modules that were not buildable.'''
         pass
+    def get_resource_summary(self):
+        '''Returns the lines of the resource usage summary of the build,
+        if the resource_summary option is set.'''
+        if self.resource_summary is None:
+            return []
+        return self.resource_summary.get_summary(self.config.resource_summary)
     def start_module(self, module):
         '''Hook to perform actions before starting a build of a module.'''
         pass
@@ -327,8 +435,13 @@ class BuildScript:
         pass
     def _end_phase_internal(self, module, phase, error):
         if error is None and phase == 'install':
-            self.run_triggers([module])
+            if self.config.defer_triggers:
+                if not module in self._deferred_triggers:
+                    self._deferred_triggers.append(module)
+            else:
+                self.run_triggers([module])
         self.end_phase(module, phase, error)
+        self.notify_observers('end_phase', module, phase, error)
 
     def message(self, msg, module_num=-1):
         '''Display a message to the user'''
@@ -41,6 +41,7 @@ import buildscript
 import jhbuild.moduleset
 from jhbuild.modtypes import MetaModule
 from jhbuild.errors import CommandError
+from jhbuild.utils import cmds
 from jhbuild.utils import notify
 
 from terminal import t_bold, t_reset
@@ -451,6 +452,8 @@ class AppWindow(gtk.Window, buildscript.BuildScript):
         else:
             short_command = command[0]
 
+        self.notify_observers('start_command', command, cwd or os.getcwd())
+        rusage = None
         if vte is None:
             textbuffer = self.terminal.get_buffer()
 
@@ -475,14 +478,14 @@ class AppWindow(gtk.Window, buildscript.BuildScript):
                 kws['cwd'] = cwd
 
             if extra_env is not None:
-                kws['env'] = os.environ.copy()
-                kws['env'].update(extra_env)
+                kws['env'] = cmds.get_environ(extra_env)
 
             command = self._prepare_execute(command)
 
             try:
-                p = subprocess.Popen(command, **kws)
+                p = cmds.Popen(command, **kws)
             except OSError, e:
+                self.notify_observers('end_command', None, None, None)
                 raise CommandError(str(e))
             self.child_pid = p.pid
 
@@ -552,6 +555,7 @@ class AppWindow(gtk.Window, buildscript.BuildScript):
                 time.sleep(0.05)
 
             rc = p.wait()
+            rusage = p.rusage
             self.child_pid = None
         else:
             # use the vte widget
@@ -563,9 +567,8 @@ class AppWindow(gtk.Window, buildscript.BuildScript):
 
             kws = {}
             if extra_env is not None:
-                env = os.environ.copy()
-                env.update(extra_env)
-                kws['envv'] = ['%s=%s' % x for x in env.items()]
+                kws['envv'] = ['%s=%s' % x for x in
+                               cmds.get_environ(extra_env).items()]
 
             if cwd:
                 kws['directory'] = cwd
@@ -588,10 +591,12 @@ class AppWindow(gtk.Window, buildscript.BuildScript):
             if os.WIFEXITED(self.vte_child_exit_status):
                 rc = os.WEXITSTATUS(self.vte_child_exit_status)
             elif os.WIFSIGNALED(self.vte_child_exit_status):
+                self.notify_observers('end_command', None, None, None)
                 raise CommandError(_('%(command)s died with signal %(rc)s') % {
                         'command': short_command,
                         'rc': os.WTERMSIG(self.vte_child_exit_status)})
 
+        self.notify_observers('end_command', rc, rusage, None)
         if rc:
             raise CommandError(_('%(command)s returned with an error code (%(rc)s)') % {
                     'command': short_command, 'rc': rc})
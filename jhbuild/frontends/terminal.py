@@ -194,25 +194,33 @@ class TerminalBuildScript(buildscript.BuildScript):
         if self.config.quiet_mode:
             kws['stdout'] = subprocess.PIPE
             kws['stderr'] = subprocess.STDOUT
+        elif self.observe_output and kws['stdout'] is None:
+            # the output is copied to the terminal as it is read; the
+            # commands no longer see a terminal (documented with --serve)
+            kws['stdout'] = subprocess.PIPE
+            kws['stderr'] = subprocess.PIPE
 
         if cwd is not None:
             kws['cwd'] = cwd
 
         if extra_env is not None:
-            kws['env'] = os.environ.copy()
-            kws['env'].update(extra_env)
+            kws['env'] = cmds.get_environ(extra_env)
 
+        self.notify_observers('start_command', command, print_args['cwd'])
         command = self._prepare_execute(command)
 
         try:
-            p = subprocess.Popen(command, **kws)
+            p = cmds.Popen(command, **kws)
         except OSError, e:
+            self.notify_observers('end_command', None, None, None)
             raise CommandError(str(e))
 
         output = []
         if hint in ('cvs', 'svn', 'hg-update.py'):
             conflicts = []
             def format_line(line, error_output, conflicts = conflicts, output = output):
+                if self.observe_output:
+                    self.notify_output([line], error_output)
                 if line.startswith('C '):
                     conflicts.append(line)
 
@@ -240,9 +248,25 @@ class TerminalBuildScript(buildscript.BuildScript):
                 # make sure conflicts fail
                 if p.returncode == 0 and hint == 'cvs': p.returncode = 1
         elif self.config.quiet_mode:
-            def format_line(line, error_output, output = output):
-                output.append(line)
-            cmds.pprint_output(p, format_line)
+            def format_lines(lines, error_output, output = output):
+                output.extend(lines)
+            cmds.pump_output(p, self._observe_output(format_lines))
+        elif self.observe_output:
+            def format_lines(lines, error_output):
+                if error_output:
+                    fp = sys.stderr
+                else:
+                    fp = sys.stdout
+                fp.write(''.join(lines))
+                fp.flush()
+            try:
+                cmds.pump_output(p, self._observe_output(format_lines))
+            except KeyboardInterrupt:
+                try:
+                    os.kill(p.pid, signal.SIGINT)
+                except OSError:
+                    # process might already be dead.
+                    pass
         else:
             try:
                 p.communicate()
@@ -253,15 +277,19 @@ class TerminalBuildScript(buildscript.BuildScript):
                     # process might already be dead.
                     pass
         try:
-            if p.wait() != 0:
-                if self.config.quiet_mode:
-                    print ''.join(output)
-                raise CommandError(_('########## Error running %s')
-                                   % print_args['command'], p.returncode)
+            p.wait()
         except OSError:
             # it could happen on a really badly-timed ctrl-c (see bug 551641)
+            self.notify_observers('end_command', None, None, p.output_bytes)
             raise CommandError(_('########## Error running %s')
                                % print_args['command'])
+        self.notify_observers('end_command', p.returncode, p.rusage,
+                              p.output_bytes)
+        if p.returncode != 0:
+            if self.config.quiet_mode:
+                print ''.join(output)
+            raise CommandError(_('########## Error running %s')
+                               % print_args['command'], p.returncode)
 
     def start_module(self, module):
         self.triedcheckout = None
@@ -280,6 +308,8 @@ class TerminalBuildScript(buildscript.BuildScript):
             for module in failures:
                 print module,
             print
+        for line in self.get_resource_summary():
+            uprint(line)
 
     def handle_error(self, module, phase, nextphase, error, altphases):
         '''handle error during build'''
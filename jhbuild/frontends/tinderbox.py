@@ -27,6 +27,7 @@ import sys
 
 from jhbuild.main import _encoding
 from jhbuild.utils import cmds
+from jhbuild.utils import logstore
 from jhbuild.utils import sysid
 from jhbuild.errors import CommandError, FatalError
 import buildscript
@@ -142,6 +143,14 @@ def escape(string):
             '\t','&nbsp;&nbsp;&nbsp;&nbsp;')
     return string
 
+def escape_lines(lines):
+    '''Escapes a list of lines at once, returns them without line breaks.'''
+    text = ''.join(lines)
+    if text.endswith('\n'):
+        text = text[:-1]
+    # line breaks are the only source of <br/> in the escaped text
+    return escape(text).split('<br/>')
+
 class LoggingFormatter(logging.Formatter):
     def __init__(self):
         logging.Formatter.__init__(self, '<div class="%(levelname)s">'
@@ -154,6 +163,8 @@ class TinderboxBuildScript(buildscript.BuildScript):
         buildscript.BuildScript.__init__(self, config, module_list, module_set=module_set)
         self.indexfp = None
         self.modulefp = None
+        self.modulelog = None
+        self.phasefilename = None
 
         for handle in logging.getLogger().handlers:
             handle.setFormatter(LoggingFormatter())
@@ -201,13 +212,16 @@ class TinderboxBuildScript(buildscript.BuildScript):
         else:
             print_args['cwd'] = os.getcwd()
 
-        self.modulefp.write('<pre>')
         if isinstance(command, (str, unicode)):
             kws['shell'] = True
             print_args['command'] = command
         else:
             print_args['command'] = ' '.join(command)
 
+        if self.modulelog:
+            self.modulelog.mark_command(print_args['command'])
+        self.modulefp.write('<pre>')
+
         if self.config.print_command_pattern:
             try:
                 commandstr = self.config.print_command_pattern % print_args
@@ -226,39 +240,45 @@ class TinderboxBuildScript(buildscript.BuildScript):
         kws['stdout'] = subprocess.PIPE
         kws['stderr'] = subprocess.PIPE
         if hint == 'cvs':
-            def format_line(line, error_output, fp=self.modulefp):
-                if line[-1] == '\n': line = line[:-1]
-                if line.startswith('C '):
-                    fp.write('<span class="conflict">%s</span>\n'
-                                        % escape(line))
-                else:
-                    fp.write('%s\n' % escape(line))
+            def format_lines(lines, error_output, fp=self.modulefp):
+                output = []
+                for line in escape_lines(lines):
+                    if line.startswith('C '):
+                        output.append('<span class="conflict">%s</span>\n'
+                                      % line)
+                    else:
+                        output.append('%s\n' % line)
+                fp.write(''.join(output))
             kws['stderr'] = subprocess.STDOUT
         else:
-            def format_line(line, error_output, fp=self.modulefp):
-                if line[-1] == '\n': line = line[:-1]
+            def format_lines(lines, error_output, fp=self.modulefp):
                 if error_output:
-                    fp.write('<span class="error">%s</span>\n'
-                                        % escape(line))
+                    fp.write(''.join(['<span class="error">%s</span>\n' % line
+                                      for line in escape_lines(lines)]))
                 else:
-                    fp.write('%s\n' % escape(line))
+                    fp.write('\n'.join(escape_lines(lines)) + '\n')
 
         if cwd is not None:
             kws['cwd'] = cwd
 
         if extra_env is not None:
-            kws['env'] = os.environ.copy()
-            kws['env'].update(extra_env)
+            kws['env'] = cmds.get_environ(extra_env)
 
+        self.notify_observers('start_command', command, print_args['cwd'])
         command = self._prepare_execute(command)
+        # show which command runs, in case it takes long or hangs
+        self.modulefp.flush()
 
         try:
-            p = subprocess.Popen(command, **kws)
+            p = cmds.Popen(command, **kws)
         except OSError, e:
+            self.notify_observers('end_command', None, None, None)
             self.modulefp.write('<span class="error">Error: %s</span>\n'
                                 % escape(str(e)))
             raise CommandError(str(e))
-        cmds.pprint_output(p, format_line)
+        cmds.pump_output(p, self._observe_output(format_lines))
+        self.notify_observers('end_command', p.returncode, p.rusage,
+                              p.output_bytes)
         self.modulefp.write('</pre>\n')
         self.modulefp.flush()
         if p.returncode != 0:
@@ -306,20 +326,33 @@ class TinderboxBuildScript(buildscript.BuildScript):
             info += '</blockquote>\n'
         else:
             info = ''
+        summary = self.get_resource_summary()
+        if summary:
+            info += '<pre>%s</pre>\n' % escape('\n'.join(summary))
         self.indexfp.write(index_footer % { 'failures': info })
         self.indexfp.close()
         self.indexfp = None
 
     def start_module(self, module):
-        self.modulefilename='%s.html' % module.replace('/','_')
+        self.modulebasename = module.replace('/','_')
+        self.modulefilename='%s.html' % self.modulebasename
+        if self.config.tinderbox_compress_logs:
+            self.modulefilename += '.gz'
         self.indexfp.write('<tr>'
                            '<td>%s</td>'
                            '<td><a href="%s">%s</a></td>'
                            '<td>\n' % (self.timestamp(), self.modulefilename,
                                        module))
-        self.modulefp = codecs.open(
-                os.path.join(self.outputdir, self.modulefilename), 'w',
-                encoding=self.charset, errors='xmlcharrefreplace')
+        filename = os.path.join(self.outputdir, self.modulefilename)
+        if self.config.tinderbox_compress_logs:
+            self.modulelog = logstore.LogStore(filename,
+                    os.path.join(self.outputdir,
+                                 '%s.idx' % self.modulebasename))
+            self.modulefp = codecs.getwriter(self.charset)(
+                    self.modulelog, errors='xmlcharrefreplace')
+        else:
+            self.modulefp = codecs.open(filename, 'w',
+                    encoding=self.charset, errors='xmlcharrefreplace')
 
         for handle in logging.getLogger().handlers:
             if isinstance(handle, logging.StreamHandler):
@@ -335,6 +368,7 @@ class TinderboxBuildScript(buildscript.BuildScript):
         self.modulefp.write(buildlog_footer)
         self.modulefp.close()
         self.modulefp = None
+        self.modulelog = None
         self.indexfp.write('</td>\n')
         if failed:
             help_html = ''
@@ -359,14 +393,32 @@ class TinderboxBuildScript(buildscript.BuildScript):
         self.indexfp.flush()
 
     def start_phase(self, module, phase):
-        self.modulefp.write('<a name="%s"></a>\n' % phase)
+        if not self.modulelog:
+            self.modulefp.write('<a name="%s"></a>\n' % phase)
+            return
+        # every phase of a compressed log has its own file, so it can be
+        # read without downloading the whole log
+        self.phasefilename = '%s-%d-%s.html.gz' % (
+                self.modulebasename, len(self.modulelog.sections), phase)
+        self.modulefp.write('<div><a name="%s" href="%s">%s</a></div>\n'
+                            % (phase, self.phasefilename, phase))
+        self.modulelog.start_section(phase,
+                os.path.join(self.outputdir, self.phasefilename))
+        self.modulefp.write(buildlog_header % { 'module': module,
+                                                'charset': self.charset })
     def end_phase(self, module, phase, error):
+        if self.modulelog:
+            self.modulefp.write(buildlog_footer)
+            self.modulelog.end_section()
+            href = self.phasefilename
+        else:
+            href = '%s#%s' % (self.modulefilename, phase)
         if error:
-            self.indexfp.write('<a class="failure" title="%s" href="%s#%s">%s</a>\n'
-                               % (error, self.modulefilename, phase, phase))
+            self.indexfp.write('<a class="failure" title="%s" href="%s">%s</a>\n'
+                               % (error, href, phase))
         else:
-            self.indexfp.write('<a class="success" href="%s#%s">%s</a>\n'
-                               % (self.modulefilename, phase, phase))
+            self.indexfp.write('<a class="success" href="%s">%s</a>\n'
+                               % (href, phase))
         self.indexfp.flush()
 
     def handle_error(self, module, phase, nextphase, error, altphases):
@@ -29,7 +29,6 @@ __all__ = [
 
 import os
 import re
-import shutil
 import logging
 
 from jhbuild.errors import FatalError, CommandError, BuildStateError, \
@@ -210,7 +209,8 @@ class Package:
         """Return a directory suitable for use as e.g. DESTDIR with "make install"."""
         destdir = self.get_destdir(buildscript)
         if os.path.exists(destdir):
-            shutil.rmtree(destdir)
+            fileutils.remove_tree_async(destdir,
+                    os.path.join(buildscript.config.top_builddir, 'trash'))
         os.makedirs(destdir)
         return destdir
 
@@ -347,7 +347,8 @@ them into the prefix."""
         if save_broken_tree:
             if os.path.exists(broken_name):
                 assert broken_name.startswith(buildscript.config.top_builddir)
-                shutil.rmtree(broken_name)
+                fileutils.remove_tree_async(broken_name,
+                        os.path.join(buildscript.config.top_builddir, 'trash'))
             fileutils.rename(destdir, broken_name)
         else:
             assert destdir.startswith(buildscript.config.prefix)
@@ -414,14 +415,19 @@ them into the prefix."""
         """
         method = getattr(self, 'do_' + phase)
         try:
-            method(buildscript)
-        except (CommandError, BuildStateError), e:
-            error_phases = []
-            if hasattr(method, 'error_phases'):
-                error_phases = method.error_phases
-            return (e, error_phases)
-        else:
-            return (None, None)
+            try:
+                method(buildscript)
+            except (CommandError, BuildStateError), e:
+                error_phases = []
+                if hasattr(method, 'error_phases'):
+                    error_phases = method.error_phases
+                return (e, error_phases)
+            else:
+                return (None, None)
+        finally:
+            # the commands of the phase may have changed the checkout
+            if self.branch is not None:
+                self.branch.invalidate_tree_id()
 
     def has_phase(self, phase):
         return hasattr(self, 'do_' + phase)
@@ -207,7 +207,12 @@ class ModuleSet:
 
     def get_module_state(self, modules):
         installed_pkgconfig = systeminstall.get_installed_pkgconfigs(self.config)
-        
+        resolver = systeminstall.SystemDependencyResolver(self.config)
+        sysdeps_met = resolver.check_modules(
+                [(module.name, module.systemdependencies) for module in modules
+                 if isinstance(module, SystemModule) and
+                    module.pkg_config is None])
+
         module_state = {}
         for module in modules:
             # only consider SystemModules or modules with <pkg-config>
@@ -229,9 +234,7 @@ class ModuleSet:
                             new_enough = compare_version(installed_version,
                                                          required_version)
                 elif systemmodule:
-                    new_enough = systeminstall.systemdependencies_met \
-                                     (module.name, module.systemdependencies,
-                                      self.config)
+                    new_enough = sysdeps_met[module.name]
                     if new_enough:
                         installed_version = 'unknown'
                 module_state[module] = (required_version, installed_version,
@@ -353,6 +356,7 @@ class ModuleSet:
 
 
 def load(config, uri=None):
+    warn_local_modulesets(config)
     if uri is not None:
         modulesets = [ uri ]
     elif type(config.moduleset) in (list, tuple):
@@ -562,9 +566,12 @@ def _parse_module_set(config, uri):
 
     return moduleset
 
+_warned_local_modulesets = False
 def warn_local_modulesets(config):
-    if config.use_local_modulesets:
+    global _warned_local_modulesets
+    if _warned_local_modulesets or config.use_local_modulesets:
         return
+    _warned_local_modulesets = True
 
     moduleset_local_path = os.path.join(SRCDIR, 'modulesets')
     if not os.path.exists(moduleset_local_path):
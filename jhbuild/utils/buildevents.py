@@ -0,0 +1,420 @@
+# jhbuild - a tool to ease building collections of source packages
+# Copyright (C) 2001-2006  James Henstridge
+#
+#   buildevents.py: observers of the progress of a build
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import atexit
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+
+from jhbuild.errors import FatalError
+
+__all__ = ['BuildObserver', 'EventStream', 'ResourceSummary', 'TraceFile',
+           'monotonic_time', 'rusage_to_dict']
+
+
+def _get_monotonic_clock():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    for libname in (None, ctypes.util.find_library('rt')):
+        try:
+            clock_gettime = ctypes.CDLL(libname).clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+    else:
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic_time():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            return time.time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic_time
+
+# time in seconds, from a clock unaffected by the changes of the system time
+# where one is available
+monotonic_time = _get_monotonic_clock() or time.time
+
+
+def rusage_to_dict(rusage):
+    '''Returns the interesting fields of a resource.struct_rusage.'''
+    if rusage is None:
+        return None
+    maxrss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes rather than kilobytes
+        maxrss = maxrss / 1024
+    return {'utime': rusage.ru_utime,
+            'stime': rusage.ru_stime,
+            'maxrss': maxrss, # in kilobytes
+            'inblock': rusage.ru_inblock,
+            'oublock': rusage.ru_oublock}
+
+
+def _decode_strings(value):
+    '''Returns @value with the byte strings it contains decoded from UTF-8,
+    invalid sequences being replaced, so it can always be serialised to
+    JSON; the command lines and error messages are not always UTF-8.'''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_decode_strings(x) for x in value]
+    if isinstance(value, dict):
+        return dict([(_decode_strings(k), _decode_strings(v))
+                     for k, v in value.items()])
+    return value
+
+
+def _error_to_string(error):
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return str(error)
+
+
+class BuildObserver(object):
+    '''Base class of the objects following the progress of a build.
+
+    Observers are added to a build script with add_observer() and receive
+    the same notifications as the build script hooks, plus the start and
+    end of every command the build script executes.  Observers setting
+    wants_output also receive the output of the commands.'''
+
+    wants_output = False
+
+    def start_build(self):
+        pass
+
+    def end_build(self, failures):
+        pass
+
+    def start_module(self, module):
+        pass
+
+    def end_module(self, module, failed):
+        pass
+
+    def start_phase(self, module, phase):
+        pass
+
+    def end_phase(self, module, phase, error):
+        pass
+
+    def start_command(self, command, cwd):
+        '''command is a string or a list of arguments, as passed to
+        execute().'''
+        pass
+
+    def end_command(self, returncode, rusage, output_bytes):
+        '''returncode is None if the command could not be run, rusage is a
+        resource.struct_rusage and output_bytes the size of the output of
+        the command, where they are known.'''
+        pass
+
+    def command_output(self, lines, error_output):
+        '''lines is a list of lines of the output of the current command,
+        with their line endings; error_output is set for the lines written
+        to stderr.'''
+        pass
+
+    def close(self):
+        '''Called once the build is over, whether it completed, stopped on
+        an error or was interrupted.'''
+        pass
+
+
+class EventStream(BuildObserver):
+    '''Appends the build events to a file, as one JSON object per line.
+
+    The events are serialised and written by a separate thread, so the
+    build is never held back by the file.'''
+
+    def __init__(self, filename):
+        try:
+            self.fp = open(filename, 'a')
+        except IOError, e:
+            raise FatalError(_('could not open %(filename)s: %(error)s') %
+                             {'filename': filename, 'error': e.strerror})
+        self.module = None
+        self.phase = None
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._write_events)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _write_events(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            try:
+                self.fp.write(json.dumps(_decode_strings(event)) + '\n')
+                if self.queue.empty():
+                    self.fp.flush()
+            except (IOError, TypeError, ValueError, UnicodeError):
+                pass
+        self.fp.close()
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def emit(self, event, **kwargs):
+        kwargs['event'] = event
+        kwargs['time'] = monotonic_time()
+        if self.module is not None:
+            kwargs.setdefault('module', self.module)
+        if self.phase is not None:
+            kwargs.setdefault('phase', self.phase)
+        self.queue.put(kwargs)
+
+    def start_build(self):
+        self.emit('start_build', wallclock=time.time(), pid=os.getpid())
+
+    def end_build(self, failures):
+        self.emit('end_build', failures=list(failures))
+
+    def start_module(self, module):
+        self.module = module
+        self.emit('start_module')
+
+    def end_module(self, module, failed):
+        self.emit('end_module', failed=bool(failed))
+        self.module = None
+
+    def start_phase(self, module, phase):
+        self.phase = phase
+        self.emit('start_phase')
+
+    def end_phase(self, module, phase, error):
+        if error is not None:
+            error = _error_to_string(error)
+        self.emit('end_phase', error=error)
+        self.phase = None
+
+    def start_command(self, command, cwd):
+        self.emit('start_command', command=command, cwd=cwd)
+
+    def end_command(self, returncode, rusage, output_bytes):
+        self.emit('end_command', returncode=returncode,
+                  rusage=rusage_to_dict(rusage), output_bytes=output_bytes)
+
+
+class TraceFile(BuildObserver):
+    '''Writes a timeline of the build in the trace event format, as read
+    by chrome://tracing and Perfetto.
+
+    Modules, phases and commands are complete events ("X"), nested on the
+    track of the thread that notified them.  Events are kept in memory
+    and only serialised at the end of the build.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.events = []
+        self.stacks = {}
+        self.written = False
+        atexit.register(self.close)
+
+    def get_track(self):
+        thread = threading.currentThread()
+        if not thread.ident in self.stacks:
+            self.stacks[thread.ident] = []
+            self.events.append({'name': 'thread_name', 'ph': 'M',
+                                'pid': os.getpid(), 'tid': thread.ident,
+                                'args': {'name': thread.getName()}})
+        return thread.ident, self.stacks[thread.ident]
+
+    def begin(self, name, category, args):
+        tid, stack = self.get_track()
+        stack.append((name, category, args, monotonic_time()))
+
+    def end(self, category, **kwargs):
+        end_time = monotonic_time()
+        tid, stack = self.get_track()
+        if not category in [x[1] for x in stack]:
+            return
+        # close the spans left open by an exception
+        while stack:
+            name, span_category, args, start_time = stack.pop()
+            if span_category == category:
+                args.update(kwargs)
+            self.events.append({'name': name, 'cat': span_category,
+                                'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                                'ts': int(start_time * 1000000),
+                                'dur': int((end_time - start_time) * 1000000),
+                                'args': args})
+            if span_category == category:
+                break
+
+    def start_build(self):
+        self.begin('build', 'build', {})
+
+    def end_build(self, failures):
+        self.end('build', failures=list(failures))
+        self.write()
+
+    def start_module(self, module):
+        self.begin(module, 'module', {})
+
+    def end_module(self, module, failed):
+        self.end('module', failed=bool(failed))
+
+    def start_phase(self, module, phase):
+        self.begin(phase, 'phase', {'module': module})
+
+    def end_phase(self, module, phase, error):
+        if error is not None:
+            error = _error_to_string(error)
+        self.end('phase', error=error)
+
+    def start_command(self, command, cwd):
+        if isinstance(command, (str, unicode)):
+            words = command.split(None, 1)
+        else:
+            words = command[:1]
+        name = os.path.basename((words or ['command'])[0])
+        self.begin(name, 'command', {'argv': command, 'cwd': cwd})
+
+    def end_command(self, returncode, rusage, output_bytes):
+        self.end('command', returncode=returncode,
+                 rusage=rusage_to_dict(rusage))
+
+    def close(self):
+        # close the spans left open by an interrupted build
+        self.end('build')
+        self.write()
+
+    def write(self):
+        if self.written:
+            return
+        self.written = True
+        try:
+            fp = open(self.filename, 'w')
+            json.dump({'traceEvents': _decode_strings(self.events),
+                       'displayTimeUnit': 'ms'}, fp)
+            fp.close()
+        except (IOError, TypeError, ValueError, UnicodeError), e:
+            logging.warning(_('could not write the trace to %(filename)s: '
+                              '%(error)s') % {'filename': self.filename,
+                                              'error': e})
+
+
+class ResourceUsage(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.utime = 0.0
+        self.stime = 0.0
+        self.maxrss = 0
+        self.inblock = 0
+        self.oublock = 0
+
+    def add(self, rusage):
+        self.utime += rusage['utime']
+        self.stime += rusage['stime']
+        self.maxrss = max(self.maxrss, rusage['maxrss'])
+        self.inblock += rusage['inblock']
+        self.oublock += rusage['oublock']
+
+
+class ResourceSummary(BuildObserver):
+    '''Accounts the wall time, processor time, peak memory and block I/O
+    of every command of the build, and of every module.'''
+
+    def __init__(self):
+        self.commands = []
+        self.modules = {}
+        self.module = None
+        self.command = None
+
+    def start_module(self, module):
+        self.module = self.modules.setdefault(module, ResourceUsage(module))
+        self.module_start = monotonic_time()
+
+    def end_module(self, module, failed):
+        if self.module is not None:
+            self.module.wall += monotonic_time() - self.module_start
+        self.module = None
+
+    def start_command(self, command, cwd):
+        if not isinstance(command, (str, unicode)):
+            command = ' '.join(command)
+        if self.module is not None:
+            command = '%s: %s' % (self.module.name, command)
+        self.command = ResourceUsage(command)
+        self.command_start = monotonic_time()
+
+    def end_command(self, returncode, rusage, output_bytes):
+        if self.command is None:
+            return
+        self.command.wall = monotonic_time() - self.command_start
+        rusage = rusage_to_dict(rusage)
+        if rusage is not None:
+            self.command.add(rusage)
+            if self.module is not None:
+                self.module.add(rusage)
+        self.commands.append(self.command)
+        self.command = None
+
+    def format_table(self, title, usages, limit):
+        lines = [title,
+                 '  %10s %10s %10s %9s %9s %9s  %s' % (
+                    _('wall (s)'), _('user (s)'), _('sys (s)'),
+                    _('RSS (MiB)'), _('blk in'), _('blk out'), _('name'))]
+        for usage in usages[:limit]:
+            name = usage.name
+            if len(name) > 60:
+                name = name[:57] + '...'
+            lines.append('  %10.1f %10.1f %10.1f %9d %9d %9d  %s' % (
+                    usage.wall, usage.utime, usage.stime,
+                    usage.maxrss / 1024, usage.inblock, usage.oublock, name))
+        return lines
+
+    def get_summary(self, limit):
+        '''Returns the lines of tables of the @limit longest commands, the
+        @limit commands using the most memory and the @limit longest
+        modules.'''
+        if not self.commands:
+            return []
+        lines = self.format_table(_('Longest commands:'),
+                sorted(self.commands, key=lambda x: -x.wall), limit)
+        lines += self.format_table(_('Commands using the most memory:'),
+                sorted(self.commands, key=lambda x: -x.maxrss), limit)
+        lines += self.format_table(_('Longest modules:'),
+                sorted(self.modules.values(), key=lambda x: -x.wall), limit)
+        return lines
@@ -17,6 +17,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import errno
 import os
 import re
 import select
@@ -25,6 +26,31 @@ import sys
 from signal import SIGINT
 from jhbuild.errors import CommandError
 
+class _SharedEnviron(dict):
+    '''An environment dictionary shared between the child processes.'''
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('shared environment, copy it to modify it')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+_environ_cache = {}
+def get_environ(extra_env):
+    '''Returns os.environ updated with the extra_env dictionary, as a read
+    only dictionary for the env argument of subprocess.Popen.
+
+    The dictionary is only computed again when extra_env or os.environ
+    change, rather than copied for every child process.'''
+    environ = getattr(os.environ, 'data', os.environ)
+    key = frozenset(extra_env.items())
+    cached = _environ_cache.get(key)
+    if cached is None or cached[0] != environ:
+        env = dict(environ)
+        env.update(extra_env)
+        cached = (dict(environ), _SharedEnviron(env))
+        _environ_cache[key] = cached
+    return cached[1]
+
 def get_output(cmd, cwd=None, extra_env=None, get_stderr = True):
     '''Return the output (stdout and stderr) from the command.
 
@@ -45,8 +71,7 @@ def get_output(cmd, cwd=None, extra_env=None, get_stderr = True):
     if cwd is not None:
         kws['cwd'] = cwd
     if extra_env is not None:
-        kws['env'] = os.environ.copy()
-        kws['env'].update(extra_env)
+        kws['env'] = get_environ(extra_env)
 
     if get_stderr:
         stderr_output = subprocess.STDOUT
@@ -151,6 +176,32 @@ class Pipeline(subprocess.Popen):
         self.returncode = returncode
         return self.returncode
 
+class Popen(subprocess.Popen):
+    '''A subprocess.Popen keeping the resource usage of the child once it
+    has been waited for, in the rusage attribute (a resource.struct_rusage,
+    or None where os.wait4() is not available).'''
+
+    rusage = None
+    output_bytes = None
+
+    def wait(self):
+        if not hasattr(os, 'wait4'):
+            return subprocess.Popen.wait(self)
+        while self.returncode is None:
+            try:
+                pid, sts, rusage = os.wait4(self.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # the child has been reaped somewhere else
+                pid, sts, rusage = self.pid, 0, None
+            if pid == self.pid:
+                self.rusage = rusage
+                self._handle_exitstatus(sts)
+        return self.returncode
+
 def spawn_child(command, use_pipe=False,
                 cwd=None, env=None,
                 stdin=None, stdout=None, stderr=None):
@@ -163,59 +214,109 @@ def spawn_child(command, use_pipe=False,
                              stdin=stdin, stdout=stdout, stderr=stderr)
     return p
 
-def pprint_output(pipe, format_line):
-    '''Process the output of the subprocess and pass lines to the
-    format_line function for formatting.  The first argument passed to
-    the format_line function is the line of text.  The second argument
-    is True if the line was read from the stderr stream.'''
-    read_set = []
+class OutputSplitter(object):
+    '''Splits the data read from a stream into lines.  The data following
+    the last line break is kept as a list of chunks, so long lines cost no
+    more than short ones.'''
+
+    def __init__(self):
+        self.pending = []
+
+    def feed(self, chunk):
+        '''Returns the list of the lines completed by @chunk.'''
+        pos = chunk.rfind('\n')
+        if pos == -1:
+            self.pending.append(chunk)
+            return []
+        self.pending.append(chunk[:pos])
+        lines = ''.join(self.pending).split('\n')
+        if pos + 1 < len(chunk):
+            self.pending = [chunk[pos+1:]]
+        else:
+            self.pending = []
+        return [line + '\n' for line in lines]
+
+    def flush(self):
+        '''Returns the data lacking a final line break, as a list.'''
+        data = ''.join(self.pending)
+        self.pending = []
+        if data:
+            return [data]
+        return []
+
+def pump_output(pipe, format_lines):
+    '''Process the output of the subprocess and pass it to the
+    format_lines function for formatting, in batches of lines.  The first
+    argument passed to the format_lines function is a list of lines of
+    text.  The second argument is True if the lines were read from the
+    stderr stream.  The number of bytes read is kept in the output_bytes
+    attribute of pipe.'''
+    streams = {}
     if pipe.stdout:
-        read_set.append(pipe.stdout)
+        streams[pipe.stdout.fileno()] = (pipe.stdout, False, OutputSplitter())
     if pipe.stderr:
-        read_set.append(pipe.stderr)
-    if not sys.stdin.closed:
-        read_set.append(sys.stdin)
+        streams[pipe.stderr.fileno()] = (pipe.stderr, True, OutputSplitter())
+    stdin_fd = None
+    # only a terminal is forwarded to the child, tinderbox closes stdin
+    if not sys.stdin.closed and sys.stdin.isatty():
+        stdin_fd = sys.stdin.fileno()
 
-    out_data = err_data = ''
+    # poll() does not handle terminals on Mac OS X
+    if hasattr(select, 'poll') and sys.platform != 'darwin':
+        poller = select.poll()
+        for fd in streams.keys() + [stdin_fd]:
+            if fd is not None:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+        def wait_for_input():
+            return [fd for fd, event in poller.poll()]
+        def forget(fd):
+            poller.unregister(fd)
+    else:
+        read_set = streams.keys()
+        if stdin_fd is not None:
+            read_set.append(stdin_fd)
+        def wait_for_input():
+            return select.select(read_set, [], [])[0]
+        def forget(fd):
+            read_set.remove(fd)
+
+    pipe.output_bytes = 0
     try:
-        while read_set:
-            rlist, wlist, xlist = select.select(read_set, [], [])
-
-            if pipe.stdout in rlist:
-                out_chunk = os.read(pipe.stdout.fileno(), 10000)
-                if out_chunk == '':
-                    pipe.stdout.close()
-                    read_set.remove(pipe.stdout)
-                    if sys.stdin in read_set:
-                        read_set.remove(sys.stdin)
-                out_data += out_chunk
-                while '\n' in out_data:
-                    pos = out_data.find('\n')
-                    format_line(out_data[:pos+1], False)
-                    out_data = out_data[pos+1:]
-
-            if pipe.stderr in rlist:
-                err_chunk = os.read(pipe.stderr.fileno(), 10000)
-                if err_chunk == '':
-                    pipe.stderr.close()
-                    read_set.remove(pipe.stderr)
-                err_data += err_chunk
-                while '\n' in err_data:
-                    pos = err_data.find('\n')
-                    format_line(err_data[:pos+1], True)
-                    err_data = err_data[pos+1:]
-
-            # safeguard against tinderbox that close stdin
-            if sys.stdin in rlist and sys.stdin.isatty():
-                in_chunk = os.read(sys.stdin.fileno(), 10000)
-                if pipe.stdin:
-                    os.write(pipe.stdin.fileno(), in_chunk)
-
-        # flush the remainder of stdout/stderr data lacking newlines
-        if out_data:
-            format_line(out_data, False)
-        if err_data:
-            format_line(err_data, True)
+        while streams:
+            try:
+                ready = wait_for_input()
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in ready:
+                if fd == stdin_fd:
+                    in_chunk = os.read(stdin_fd, 10000)
+                    if in_chunk == '':
+                        forget(stdin_fd)
+                        stdin_fd = None
+                    elif pipe.stdin:
+                        os.write(pipe.stdin.fileno(), in_chunk)
+                    continue
+
+                if not fd in streams:
+                    continue
+                stream, error_output, splitter = streams[fd]
+                chunk = os.read(fd, 65536)
+                if chunk == '':
+                    forget(fd)
+                    del streams[fd]
+                    stream.close()
+                    lines = splitter.flush()
+                    if stream is pipe.stdout and stdin_fd is not None:
+                        forget(stdin_fd)
+                        stdin_fd = None
+                else:
+                    pipe.output_bytes += len(chunk)
+                    lines = splitter.feed(chunk)
+                if lines:
+                    format_lines(lines, error_output)
 
     except KeyboardInterrupt:
         # interrupt received.  Send SIGINT to child process.
@@ -227,6 +328,17 @@ def pprint_output(pipe, format_line):
 
     return pipe.wait()
 
+def pprint_output(pipe, format_line):
+    '''Process the output of the subprocess and pass lines to the
+    format_line function for formatting.  The first argument passed to
+    the format_line function is the line of text.  The second argument
+    is True if the line was read from the stderr stream.  The number of
+    bytes read is kept in the output_bytes attribute of pipe.'''
+    def format_lines(lines, error_output):
+        for line in lines:
+            format_line(line, error_output)
+    return pump_output(pipe, format_lines)
+
 def has_command(cmd):
     for path in os.environ['PATH'].split(os.pathsep):
         prog = os.path.abspath(os.path.join(path, cmd))
@@ -20,8 +20,26 @@
 # Author: Colin Walters <walters@verbum.org>
 
 import os
+import re
 import sys
+import stat
 import errno
+import shutil
+import atexit
+import logging
+import tempfile
+import threading
+import Queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 def _accumulate_dirtree_contents_recurse(path, contents):
     names = os.listdir(path)
@@ -126,10 +144,17 @@ def mkdir_with_parents(filename):
             raise
 
 class SafeWriter(object):
-    def __init__(self, filename):
+    def __init__(self, filename, mode=None):
         self.filename = filename
         self.tmpname = filename + '.tmp'
-        self.fp = open(self.tmpname, 'w')
+        if mode is None:
+            self.fp = open(self.tmpname, 'w')
+        else:
+            fd = os.open(self.tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         mode)
+            # the file may have existed with other permissions
+            os.fchmod(fd, mode)
+            self.fp = os.fdopen(fd, 'w')
 
     def commit(self):
         self.fp.flush()
@@ -144,3 +169,240 @@ class SafeWriter(object):
     def abandon(self):
         self.fp.close()
         os.unlink(self.tmpname)
+
+# os.utime(), and so shutil.copystat(), sets timestamps with a microsecond
+# precision, and st_mtime is a float losing a fraction of a microsecond more;
+# a copy can thus differ from its source by up to this many seconds.
+MTIME_TOLERANCE = 2e-6
+
+# ioctl request asking the filesystem to share the extents of a file with
+# another one, see ioctl_ficlone(2).  Supported by btrfs, XFS and others.
+FICLONE = 0x40049409
+
+# (source device, destination device) pairs on which FICLONE failed
+_clone_unsupported = set()
+
+def _clone_file(src_path, dest_path, devices):
+    """Create DEST_PATH as a copy-on-write clone of SRC_PATH.
+
+Returns False if the filesystem (or platform) doesn't support it, which is
+then remembered for the DEVICES pair."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    if devices in _clone_unsupported:
+        return False
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, src_fd)
+        except (IOError, OSError):
+            os.close(dest_fd)
+            os.unlink(dest_path)
+            _clone_unsupported.add(devices)
+            return False
+        os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src_path, dest_path)
+    return True
+
+def _copy_file(src_path, dest_path, devices):
+    if _clone_file(src_path, dest_path, devices):
+        return
+    shutil.copy2(src_path, dest_path)
+
+def _make_writable(path):
+    path_stat = os.lstat(path)
+    if path_stat.st_mode & (stat.S_IWUSR | stat.S_IXUSR) != \
+            stat.S_IWUSR | stat.S_IXUSR:
+        os.chmod(path, path_stat.st_mode | stat.S_IWUSR | stat.S_IXUSR)
+
+def _remove_path(path, path_stat):
+    if stat.S_ISDIR(path_stat.st_mode):
+        def onerror(func, failed_path, exc_info):
+            # copies of read-only directories are read-only as well
+            if func not in (os.remove, os.unlink, os.rmdir):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            _make_writable(os.path.dirname(failed_path))
+            func(failed_path)
+        shutil.rmtree(path, onerror=onerror)
+    else:
+        os.unlink(path)
+
+def sync_tree(src_dir, dest_dir):
+    """Make DEST_DIR an identical copy of the directory tree at SRC_DIR.
+
+Entries of DEST_DIR that already match their source (same type, size and
+modification time) are left untouched, and entries that do not exist in
+SRC_DIR are removed, so only what changed since the previous call is copied.
+Files are cloned with FICLONE where the filesystem supports it, and copied
+otherwise."""
+    try:
+        dest_names = set(os.listdir(dest_dir))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        os.mkdir(dest_dir)
+        dest_names = set()
+    else:
+        # the previous copy of a read-only directory is read-only too
+        _make_writable(dest_dir)
+    devices = (os.stat(src_dir).st_dev, os.stat(dest_dir).st_dev)
+
+    for name in os.listdir(src_dir):
+        src_path = os.path.join(src_dir, name)
+        dest_path = os.path.join(dest_dir, name)
+        src_stat = os.lstat(src_path)
+        if name in dest_names:
+            dest_names.remove(name)
+            dest_stat = os.lstat(dest_path)
+            if stat.S_IFMT(dest_stat.st_mode) != stat.S_IFMT(src_stat.st_mode):
+                _remove_path(dest_path, dest_stat)
+            elif stat.S_ISDIR(src_stat.st_mode):
+                sync_tree(src_path, dest_path)
+                continue
+            elif stat.S_ISLNK(src_stat.st_mode):
+                if os.readlink(src_path) == os.readlink(dest_path):
+                    continue
+                os.unlink(dest_path)
+            elif (dest_stat.st_size == src_stat.st_size and
+                  abs(dest_stat.st_mtime - src_stat.st_mtime) <
+                      MTIME_TOLERANCE):
+                continue
+            else:
+                os.unlink(dest_path)
+
+        if stat.S_ISDIR(src_stat.st_mode):
+            sync_tree(src_path, dest_path)
+        elif stat.S_ISLNK(src_stat.st_mode):
+            os.symlink(os.readlink(src_path), dest_path)
+        elif stat.S_ISREG(src_stat.st_mode):
+            _copy_file(src_path, dest_path, devices)
+
+    for name in dest_names:
+        dest_path = os.path.join(dest_dir, name)
+        _remove_path(dest_path, os.lstat(dest_path))
+
+    # only once the entries are copied, as it may make DEST_DIR read-only
+    shutil.copymode(src_dir, dest_dir)
+
+def _rmtree(path):
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                _rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    else:
+        for name in os.listdir(path):
+            subpath = os.path.join(path, name)
+            if stat.S_ISDIR(os.lstat(subpath).st_mode):
+                _rmtree(subpath)
+            else:
+                os.unlink(subpath)
+    os.rmdir(path)
+
+def rmtree(path):
+    """Remove PATH, which may be a file or a directory tree.
+
+Unlike shutil.rmtree() each directory entry is only stat()ed once (none at
+all when the scandir module is available)."""
+    if stat.S_ISDIR(os.lstat(path).st_mode):
+        try:
+            _rmtree(path)
+        except OSError:
+            # maybe a read-only directory, let shutil sort it out
+            shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+class _TreeRemover(object):
+    """Deletes directory trees from a background thread."""
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            path = self.queue.get()
+            try:
+                rmtree(path)
+            except OSError, e:
+                logging.warning(_('Failed to remove %(path)r: %(msg)s') %
+                                {'path': path, 'msg': e.strerror})
+            except Exception, e:
+                # the thread must go on, the process waits for the queue
+                # to be done before exiting
+                logging.warning(_('Failed to remove %(path)r: %(msg)s') %
+                                {'path': path, 'msg': e})
+            finally:
+                self.queue.task_done()
+
+    def add(self, path):
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+                atexit.register(self.queue.join)
+        finally:
+            self.lock.release()
+        self.queue.put(path)
+
+    def wait(self):
+        if self.thread is not None:
+            self.queue.join()
+
+_tree_remover = _TreeRemover()
+_seen_trash_dirs = set()
+
+# holders created next to the paths, see remove_tree_async()
+_trash_holder_re = re.compile(r'\..+\.trash\.\w{6}$')
+
+def remove_tree_async(path, trash_dir):
+    """Make PATH disappear immediately, and delete it in the background.
+
+PATH is renamed into TRASH_DIR (or next to itself, if TRASH_DIR is on
+another filesystem) and removed by a worker thread; the process waits for
+pending removals before exiting.  Leftovers of an interrupted run found in
+TRASH_DIR, or next to PATH, are removed as well."""
+    if trash_dir not in _seen_trash_dirs:
+        _seen_trash_dirs.add(trash_dir)
+        if os.path.isdir(trash_dir):
+            for leftover in os.listdir(trash_dir):
+                _tree_remover.add(os.path.join(trash_dir, leftover))
+        else:
+            mkdir_with_parents(trash_dir)
+
+    parent_dir = os.path.dirname(path.rstrip(os.sep))
+    if parent_dir not in _seen_trash_dirs:
+        _seen_trash_dirs.add(parent_dir)
+        for leftover in os.listdir(parent_dir or os.curdir):
+            if _trash_holder_re.match(leftover):
+                _tree_remover.add(os.path.join(parent_dir, leftover))
+
+    name = os.path.basename(path.rstrip(os.sep))
+    try:
+        holder = tempfile.mkdtemp(prefix=name + '.', dir=trash_dir)
+        try:
+            os.rename(path, os.path.join(holder, name))
+        except OSError, e:
+            os.rmdir(holder)
+            if e.errno != errno.EXDEV:
+                raise
+            holder = tempfile.mkdtemp(prefix='.%s.trash.' % name,
+                                      dir=parent_dir)
+            os.rename(path, os.path.join(holder, name))
+    except OSError:
+        # no way to move it out of the way, delete it right away
+        rmtree(path)
+        return
+    _tree_remover.add(holder)
+
+def wait_for_removals():
+    """Wait for the removals started by remove_tree_async() to complete."""
+    _tree_remover.wait()
@@ -0,0 +1,101 @@
+# jhbuild - a tool to ease building collections of source packages
+# Copyright (C) 2001-2006  James Henstridge
+#
+#   logstore.py: compressed build logs, split in sections
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import gzip
+import json
+
+from jhbuild.utils import fileutils
+
+__all__ = ['LogStore']
+
+
+class LogStore(object):
+    '''A file-like object writing a build log as gzip files: the main log,
+    and a file for every section (the phases of a module) started with
+    start_section().  An index lists the sections, with the line where every
+    command starts in their file.
+
+    Served with a gzip Content-Encoding, the file of a section is downloaded
+    and decompressed on its own.  The files are flushed at the end of every
+    command and the index is rewritten at the end of every section, so the
+    log of a running build can be followed.'''
+
+    compresslevel = 6
+
+    def __init__(self, filename, index_filename):
+        self.index_filename = index_filename
+        self.main = self._open(filename)
+        self.fp = self.main
+        self.sections = [{'name': None, 'filename': os.path.basename(filename),
+                          'lines': 0, 'commands': []}]
+
+    def _open(self, filename):
+        return gzip.GzipFile(filename, 'wb', compresslevel=self.compresslevel)
+
+    def _write_index(self):
+        writer = fileutils.SafeWriter(self.index_filename)
+        json.dump({'sections': self.sections}, writer.fp)
+        writer.commit()
+
+    def start_section(self, name, filename):
+        '''Writes the log to @filename, a new file for the section @name,
+        until end_section() is called.'''
+        self.end_section()
+        self.main.flush()
+        self.fp = self._open(filename)
+        self.sections.append({'name': name,
+                              'filename': os.path.basename(filename),
+                              'lines': 0, 'commands': []})
+
+    def end_section(self):
+        '''Closes the file of the current section, and goes back to the main
+        log.'''
+        if self.fp is self.main:
+            return
+        self.fp.close()
+        self.fp = self.main
+        self._write_index()
+
+    def _current_section(self):
+        if self.fp is self.main:
+            return self.sections[0]
+        return self.sections[-1]
+
+    def mark_command(self, command):
+        '''Records that @command starts at the current line.'''
+        section = self._current_section()
+        section['commands'].append([command, section['lines']])
+
+    def write(self, data):
+        self.fp.write(data)
+        self._current_section()['lines'] += data.count('\n')
+
+    def flush(self):
+        # a sync flush makes all the data written so far readable, at the
+        # cost of a few bytes, and is only done at the end of commands
+        self.fp.flush()
+
+    def close(self):
+        if self.main is None:
+            return
+        self.end_section()
+        self.main.close()
+        self.main = self.fp = None
+        self._write_index()
@@ -0,0 +1,369 @@
+# jhbuild - a tool to ease building collections of source packages
+# Copyright (C) 2001-2006  James Henstridge
+#
+#   statusserver.py: live build status over HTTP
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import json
+import socket
+import threading
+import Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import deque
+
+from jhbuild.errors import FatalError
+from jhbuild.utils.buildevents import BuildObserver, monotonic_time
+
+__all__ = ['StatusServer']
+
+status_page = '''<html>
+  <head>
+    <meta http-equiv="Content-Type" content="text/html;charset=utf-8">
+    <title>JHBuild Status</title>
+    <style type="text/css">
+      .running { background-color: #ffa; }
+      .done { background-color: #afa; }
+      .failed { background-color: #faa; }
+      pre { white-space: pre-wrap; }
+    </style>
+  </head>
+  <body>
+    <h1>JHBuild Status</h1>
+    <p id="summary"></p>
+    <table id="modules"></table>
+    <pre id="log"></pre>
+    <script type="text/javascript">
+      var status = null;
+      var selected = null;
+      function text(s) { return document.createTextNode(s); }
+      function render() {
+        var table = document.getElementById('modules');
+        table.innerHTML = '';
+        status.modules.forEach(function(module) {
+          var row = table.insertRow(-1);
+          row.className = module.state;
+          row.insertCell(-1).appendChild(text(module.name));
+          row.insertCell(-1).appendChild(text(module.state));
+          row.insertCell(-1).appendChild(text(module.phase || ''));
+          row.onclick = function() { selected = module.name; render(); };
+        });
+        var summary = status.done + '/' + status.modules.length + ' modules';
+        if (status.eta !== null)
+          summary += ', about ' + Math.round(status.eta / 60) + ' min left';
+        if (status.finished)
+          summary += ', finished';
+        document.getElementById('summary').innerHTML = '';
+        document.getElementById('summary').appendChild(text(summary));
+        var name = selected || status.current;
+        var log = document.getElementById('log');
+        log.innerHTML = '';
+        if (name && status.tails[name])
+          log.appendChild(text(status.tails[name].join('')));
+      }
+      var source = new EventSource('events');
+      source.addEventListener('status', function(e) {
+        status = JSON.parse(e.data);
+        render();
+      });
+      source.addEventListener('module', function(e) {
+        var data = JSON.parse(e.data);
+        ['current', 'done', 'eta', 'finished'].forEach(function(key) {
+          status[key] = data[key];
+        });
+        if (data.module) {
+          var found = false;
+          status.modules.forEach(function(module, i) {
+            if (module.name == data.module.name) {
+              status.modules[i] = data.module;
+              found = true;
+            }
+          });
+          if (!found)
+            status.modules.push(data.module);
+          status.tails[data.module.name] = data.tail;
+        }
+        render();
+      });
+      source.addEventListener('output', function(e) {
+        var data = JSON.parse(e.data);
+        var tail = status.tails[data.module] || [];
+        status.tails[data.module] = tail.concat(data.lines).slice(-status.tail_lines);
+        render();
+      });
+    </script>
+  </body>
+</html>
+'''
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_content(self, content_type, data):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        status = self.server.status
+        if self.path == '/':
+            self.send_content('text/html; charset=utf-8', status_page)
+        elif self.path == '/status':
+            self.send_content('application/json',
+                              json.dumps(status.get_status()))
+        elif self.path == '/events':
+            self.send_events(status)
+        else:
+            self.send_error(404)
+
+    def send_events(self, status):
+        '''Streams the status and the output of the commands as
+        server-sent events.'''
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        queue = status.add_client()
+        try:
+            try:
+                self.wfile.write('event: status\ndata: %s\n\n'
+                                 % json.dumps(status.get_status()))
+                self.wfile.flush()
+                while True:
+                    try:
+                        event = queue.get(timeout=15)
+                    except Queue.Empty:
+                        # keep the connection alive
+                        self.wfile.write(':\n\n')
+                        self.wfile.flush()
+                        continue
+                    if event is None:
+                        break
+                    self.wfile.write('event: %s\ndata: %s\n\n' % event)
+                    self.wfile.flush()
+            except socket.error:
+                pass
+        finally:
+            status.remove_client(queue)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StatusServer(BuildObserver):
+    '''Serves the state of the build on a local HTTP port: a page showing
+    the state and phase of every module, an estimate of the remaining
+    time and the tail of the output of each module, kept up to date with
+    server-sent events.
+
+    The memory used is bounded: only the last tail_lines lines of output
+    are kept for each module, and clients too slow to follow the events
+    are disconnected.'''
+
+    wants_output = True
+    tail_lines = 200
+    max_line_length = 1000
+    max_pending_events = 1000
+
+    def __init__(self, port, modules):
+        try:
+            self.server = ThreadingHTTPServer(('localhost', port),
+                                              StatusRequestHandler)
+        except socket.error, e:
+            raise FatalError(_('could not serve the build status on port '
+                               '%(port)s: %(error)s') %
+                             {'port': port, 'error': e})
+        self.server.status = self
+        self.lock = threading.Lock()
+        self.clients = []
+        self.modules = [module.name for module in modules]
+        self.states = dict([(name, 'pending') for name in self.modules])
+        self.phases = {}
+        self.tails = {}
+        self.current = None
+        self.module_start = None
+        self.durations = []
+        self.finished = False
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def add_client(self):
+        queue = Queue.Queue(self.max_pending_events)
+        self.lock.acquire()
+        try:
+            self.clients.append(queue)
+        finally:
+            self.lock.release()
+        return queue
+
+    def remove_client(self, queue):
+        self.lock.acquire()
+        try:
+            if queue in self.clients:
+                self.clients.remove(queue)
+        finally:
+            self.lock.release()
+
+    def broadcast(self, event, data):
+        if not self.clients:
+            return
+        data = json.dumps(data)
+        self.lock.acquire()
+        try:
+            for queue in self.clients[:]:
+                try:
+                    queue.put_nowait((event, data))
+                except Queue.Full:
+                    # too slow, it will reconnect and get a new status
+                    self.clients.remove(queue)
+                    # the client thread may be in queue.get()
+                    queue.mutex.acquire()
+                    try:
+                        queue.queue.clear()
+                    finally:
+                        queue.mutex.release()
+                    queue.put_nowait(None)
+        finally:
+            self.lock.release()
+
+    def _get_summary(self):
+        done = len([x for x in self.states.values()
+                    if x in ('done', 'failed')])
+        eta = None
+        if self.durations and not self.finished:
+            average = sum(self.durations) / len(self.durations)
+            eta = average * (len(self.modules) - done)
+            if self.module_start is not None:
+                eta = max(0, eta - (monotonic_time() - self.module_start))
+        return {'current': self.current,
+                'done': done,
+                'eta': eta,
+                'finished': self.finished}
+
+    def _get_module(self, name):
+        return {'name': name,
+                'state': self.states.get(name, 'pending'),
+                'phase': self.phases.get(name)}
+
+    def get_status(self):
+        '''Returns the state of all the modules, with their tails.'''
+        self.lock.acquire()
+        try:
+            status = self._get_summary()
+            status['modules'] = [self._get_module(name)
+                                 for name in self.modules]
+            status['tail_lines'] = self.tail_lines
+            status['tails'] = dict([(name, list(tail))
+                                    for name, tail in self.tails.items()])
+            return status
+        finally:
+            self.lock.release()
+
+    def get_module_update(self, module):
+        '''Returns the state of @module, with its tail, and the summary of
+        the build.'''
+        self.lock.acquire()
+        try:
+            update = self._get_summary()
+            update['module'] = None
+            if module is not None:
+                update['module'] = self._get_module(module)
+                update['tail'] = list(self.tails.get(module, []))
+            return update
+        finally:
+            self.lock.release()
+
+    def update(self, func, module, *args):
+        self.lock.acquire()
+        try:
+            func(module, *args)
+        finally:
+            self.lock.release()
+        if self.clients:
+            self.broadcast('module', self.get_module_update(module))
+
+    def _start_module(self, module):
+        if not module in self.states:
+            self.modules.append(module)
+        self.states[module] = 'running'
+        self.current = module
+        self.module_start = monotonic_time()
+
+    def _end_module(self, module, failed):
+        if failed:
+            self.states[module] = 'failed'
+        else:
+            self.states[module] = 'done'
+        self.phases.pop(module, None)
+        if self.module_start is not None:
+            self.durations.append(monotonic_time() - self.module_start)
+        self.module_start = None
+
+    def _set_phase(self, module, phase):
+        self.phases[module] = phase
+
+    def _end_build(self, module):
+        self.finished = True
+        self.current = None
+
+    def start_module(self, module):
+        self.update(self._start_module, module)
+
+    def end_module(self, module, failed):
+        self.update(self._end_module, module, failed)
+
+    def start_phase(self, module, phase):
+        self.update(self._set_phase, module, phase)
+
+    def end_build(self, failures):
+        self.update(self._end_build, None)
+
+    def command_output(self, lines, error_output):
+        module = self.current
+        if module is None:
+            return
+        lines = lines[-self.tail_lines:]
+        # the output of the commands is not necessarily UTF-8
+        lines = [line[:self.max_line_length] for line in lines]
+        lines = [isinstance(line, unicode) and line or
+                 line.decode('utf-8', 'replace') for line in lines]
+        self.lock.acquire()
+        try:
+            if not module in self.tails:
+                self.tails[module] = deque(maxlen=self.tail_lines)
+            self.tails[module].extend(lines)
+        finally:
+            self.lock.release()
+        self.broadcast('output', {'module': module, 'lines': lines})
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for queue in self.clients:
+                queue.queue.clear()
+                queue.put_nowait(None)
+        finally:
+            self.lock.release()
+        self.server.shutdown()
+        self.server.server_close()
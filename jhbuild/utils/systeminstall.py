@@ -18,49 +18,165 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import os
+import re
 import sys 
 import logging
 import shlex
 import subprocess
 import pipes
 import imp
+import cPickle
 from StringIO import StringIO
 
 import cmds
+import fileutils
+
+def _find_program(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        prog = os.path.join(path, name)
+        if os.path.isfile(prog):
+            return prog
+    return None
+
+def _load_cache(config, name):
+    """Returns the dictionary saved by _save_cache(), or an empty one."""
+    try:
+        cache = cPickle.load(open(os.path.join(config.xdg_cache_home,
+                                               'jhbuild', name), 'rb'))
+    except Exception:
+        cache = {}
+    cache['modified'] = False
+    return cache
+
+def _save_cache(config, name, cache):
+    """Saves cache if its 'modified' key was set."""
+    if not cache.pop('modified', False):
+        return
+    cachefile = os.path.join(config.xdg_cache_home, 'jhbuild', name)
+    try:
+        fileutils.mkdir_with_parents(os.path.dirname(cachefile))
+        writer = fileutils.SafeWriter(cachefile)
+        cPickle.dump(cache, writer.fp, cPickle.HIGHEST_PROTOCOL)
+        writer.commit()
+    except EnvironmentError, e:
+        logging.debug('failed to write %s: %s' % (cachefile, e))
+
+def _get_pkgconfig_default_path(pkgconfig, cache):
+    """Returns the built-in search path of the pkg-config program, which is
+    remembered in cache for as long as the program is not replaced."""
+    key = (pkgconfig, os.stat(pkgconfig).st_mtime)
+    if cache.get('pc_path', (None, None))[0] != key:
+        proc = subprocess.Popen([pkgconfig, '--variable', 'pc_path',
+                                 'pkg-config'],
+                                stdout=subprocess.PIPE, close_fds=True)
+        pc_path = proc.communicate()[0].strip()
+        cache['pc_path'] = (key, pc_path)
+        cache['modified'] = True
+    return cache['pc_path'][1]
+
+def _expand_pkgconfig_variables(value, variables):
+    return re.sub(r'\$\{([^}]*)\}',
+                  lambda m: variables.get(m.group(1), ''), value)
+
+def _unescape_pkgconfig(m):
+    text = m.group(0)
+    if text.startswith('#'):
+        # comment
+        return ''
+    if text == '\\#':
+        return '#'
+    if text[1:] in ('\n', '\r\n'):
+        # line continuation
+        return ''
+    return text
+
+def parse_pkgconfig_version(filename):
+    """Returns the Version field of a .pc file, without running pkg-config."""
+    variables = {'pcfiledir': os.path.dirname(filename)}
+    try:
+        fp = open(filename)
+    except IOError:
+        return None
+    try:
+        data = fp.read()
+    finally:
+        fp.close()
+    # join the lines continued with a backslash and drop the comments, like
+    # pkg-config does
+    data = re.sub(r'\\(?:\r?\n|.)|#[^\n]*', _unescape_pkgconfig, data)
+    for line in data.splitlines():
+        m = re.match(r'([A-Za-z0-9_.]+)\s*([:=])\s*(.*)$', line.strip())
+        if not m:
+            continue
+        name, kind, value = m.groups()
+        value = _expand_pkgconfig_variables(value, variables)
+        if kind == '=':
+            variables[name] = value
+        elif name == 'Version':
+            return value.strip()
+    return ''
+
+def _scan_pkgconfig_dir(dirname, cache):
+    """Returns a dictionary mapping the names of the .pc files of dirname to
+    their versions, reading the files again only if one of them was added,
+    removed or modified."""
+    try:
+        filenames = os.listdir(dirname)
+    except OSError:
+        return {}
+    # the mtime of the directory does not change when a file is edited in
+    # place, the files are looked at instead
+    key = []
+    for filename in sorted(filenames):
+        if not filename.endswith('.pc') or \
+                filename.endswith('-uninstalled.pc'):
+            continue
+        try:
+            key.append((filename,
+                        os.stat(os.path.join(dirname, filename)).st_mtime))
+        except OSError:
+            continue
+    key = tuple(key)
+    cached = cache['dirs'].get(dirname)
+    if cached and cached[0] == key:
+        return cached[1]
+    pkgversions = {}
+    for filename, mtime in key:
+        version = parse_pkgconfig_version(os.path.join(dirname, filename))
+        if version is not None:
+            pkgversions[filename[:-len('.pc')]] = version
+    cache['dirs'][dirname] = (key, pkgversions)
+    cache['modified'] = True
+    return pkgversions
 
 def get_installed_pkgconfigs(config):
     """Returns a dictionary mapping pkg-config names to their current versions on the system."""
-    pkgversions = {}
-    try:
-        proc = subprocess.Popen(['pkg-config', '--list-all'], stdout=subprocess.PIPE, close_fds=True)
-        stdout = proc.communicate()[0]
-        proc.wait()
-        pkgs = []
-        for line in StringIO(stdout):
-            pkg, rest = line.split(None, 1)
-            pkgs.append(pkg)
-
-        # see if we can get the versions "the easy way"
+    pkgconfig = _find_program('pkg-config')
+    if pkgconfig is None: # pkg-config not installed
+        return {}
+
+    cache = _load_cache(config, 'pkgconfigs.cache')
+    cache.setdefault('dirs', {})
+
+    # search the directories in the same order as pkg-config does
+    dirs = os.environ.get('PKG_CONFIG_PATH', '').split(os.pathsep)
+    if 'PKG_CONFIG_LIBDIR' in os.environ:
+        dirs += os.environ['PKG_CONFIG_LIBDIR'].split(os.pathsep)
+    else:
         try:
-            stdout = subprocess.check_output(['pkg-config', '--modversion'] + pkgs)
-            versions = stdout.splitlines()
-            if len(versions) == len(pkgs):
-                return dict(zip(pkgs, versions))
+            dirs += _get_pkgconfig_default_path(pkgconfig, cache).split(
+                    os.pathsep)
         except OSError:
-            pass
-
-        # We have to rather inefficiently repeatedly fork to work around
-        # broken pkg-config installations - if any package has a missing
-        # dependency pkg-config will fail entirely.
-        for pkg in pkgs:
-            args = ['pkg-config', '--modversion']
-            args.append(pkg)
-            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
-            stdout = proc.communicate()[0]
-            proc.wait()
-            pkgversions[pkg] = stdout.strip()
-    except OSError: # pkg-config not installed
-        pass
+            return {}
+
+    pkgversions = {}
+    for dirname in dirs:
+        if not dirname:
+            continue
+        for pkg, version in _scan_pkgconfig_dir(dirname, cache).items():
+            pkgversions.setdefault(pkg, version)
+
+    _save_cache(config, 'pkgconfigs.cache', cache)
     return pkgversions
 
 def get_uninstalled_pkgconfigs_and_filenames(uninstalled):
@@ -77,109 +193,215 @@ def get_uninstalled_pkgconfigs_and_filenames(uninstalled):
 
     return uninstalled_pkgconfigs, uninstalled_filenames
 
-def systemdependencies_met(module_name, sysdeps, config):
-    '''Returns True of the system dependencies are met for module_name'''
-    def get_c_include_search_paths(config):
+def extract_path_from_cflags(args):
+    '''extract the C include paths (-I) from a list of arguments (args)
+    Returns a list of paths'''
+    itr = iter(args.split())
+    paths = []
+    if os.name == 'nt':
+        # shlex.split doesn't handle sep '\' on Windows
+        import string
+        shell_split = string.split
+    else:
+        shell_split = shlex.split
+    try:
+        while True:
+            arg = itr.next()
+            if arg.strip() in ['-I', '-isystem']:
+                # extract paths handling quotes and multiple paths
+                paths += shell_split(itr.next())[0].split(os.pathsep)
+            elif arg.startswith('-I'):
+                paths += shell_split(arg[2:])[0].split(os.pathsep)
+    except StopIteration:
+        pass
+    return paths
+
+class SystemDependencyResolver(object):
+    '''Checks the system dependencies of modules, looking each piece of
+    system information up only once.
+
+    The executables of each PATH directory are listed once, include files
+    and python modules are looked up once, and all the xml dependencies
+    are resolved with a single xmlcatalog call.  The gcc multiarch and the
+    xml catalog answers are kept between runs, as long as gcc and the xml
+    catalog do not change.'''
+
+    cache_name = 'sysdeps.cache'
+
+    def __init__(self, config):
+        self.config = config
+        self.cache = _load_cache(config, self.cache_name)
+        self.cache.setdefault('xml', {})
+        self._executables = {}
+        self._c_include_search_paths = None
+        self._files = {}
+        self._python_modules = {}
+
+    def _is_file(self, filename):
+        if filename not in self._files:
+            self._files[filename] = os.path.isfile(filename)
+        return self._files[filename]
+
+    def get_multiarch(self):
+        gcc = _find_program('gcc')
+        if gcc is None:
+            return None
+        key = (gcc, os.stat(gcc).st_mtime)
+        if self.cache.get('multiarch', (None, None))[0] != key:
+            try:
+                multiarch = subprocess.check_output(
+                        [gcc, '-print-multiarch']).strip()
+            except:
+                multiarch = None
+            self.cache['multiarch'] = (key, multiarch)
+            self.cache['modified'] = True
+        return self.cache['multiarch'][1]
+
+    def get_c_include_search_paths(self, module_name):
         '''returns a list of C include paths (-I) from the environment and the
         user's config'''
-        def extract_path_from_cflags(args):
-            '''extract the C include paths (-I) from a list of arguments (args)
-            Returns a list of paths'''
-            itr = iter(args.split())
-            paths = []
-            if os.name == 'nt':
-                # shlex.split doesn't handle sep '\' on Windows
-                import string
-                shell_split = string.split
-            else:
-                shell_split = shlex.split
-            try:
-                while True:
-                    arg = itr.next()
-                    if arg.strip() in ['-I', '-isystem']:
-                        # extract paths handling quotes and multiple paths
-                        paths += shell_split(itr.next())[0].split(os.pathsep)
-                    elif arg.startswith('-I'):
-                        paths += shell_split(arg[2:])[0].split(os.pathsep)
-            except StopIteration:
-                pass
-            return paths
-        try:
-            multiarch = subprocess.check_output(['gcc', '-print-multiarch']).strip()
-        except:
-            multiarch = None
-        # search /usr/include and its multiarch subdir (if any) by default
-        paths = [ os.path.join(os.sep, 'usr', 'include')]
-        if multiarch:
-            paths += [ os.path.join(paths[0], multiarch) ]
-        paths += extract_path_from_cflags(os.environ.get('CPPFLAGS', ''))
-        # check include paths incorrectly configured in CFLAGS, CXXFLAGS
-        paths += extract_path_from_cflags(os.environ.get('CFLAGS', ''))
-        paths += extract_path_from_cflags(os.environ.get('CXXFLAGS', ''))
-        # check include paths incorrectly configured in makeargs
-        paths += extract_path_from_cflags(config.makeargs)
-        paths += extract_path_from_cflags(config.module_autogenargs.get
+        if self._c_include_search_paths is None:
+            multiarch = self.get_multiarch()
+            # search /usr/include and its multiarch subdir (if any) by default
+            paths = [ os.path.join(os.sep, 'usr', 'include')]
+            if multiarch:
+                paths += [ os.path.join(paths[0], multiarch) ]
+            paths += extract_path_from_cflags(os.environ.get('CPPFLAGS', ''))
+            # check include paths incorrectly configured in CFLAGS, CXXFLAGS
+            paths += extract_path_from_cflags(os.environ.get('CFLAGS', ''))
+            paths += extract_path_from_cflags(os.environ.get('CXXFLAGS', ''))
+            # check include paths incorrectly configured in makeargs
+            paths += extract_path_from_cflags(self.config.makeargs)
+            paths += os.environ.get('C_INCLUDE_PATH', '').split(':')
+            paths += os.environ.get('CPLUS_INCLUDE_PATH', '').split(':')
+            self._c_include_search_paths = paths
+        paths = self._c_include_search_paths[:]
+        paths += extract_path_from_cflags(self.config.module_autogenargs.get
                                              (module_name, ''))
-        paths += extract_path_from_cflags(config.module_makeargs.get
+        paths += extract_path_from_cflags(self.config.module_makeargs.get
                                              (module_name, ''))
-        paths += os.environ.get('C_INCLUDE_PATH', '').split(':')
-        paths += os.environ.get('CPLUS_INCLUDE_PATH', '').split(':')
-        paths = list(set(paths)) # remove duplicates
-        return paths
-
-    c_include_search_paths = None
-    for dep_type, value in sysdeps:
-        if dep_type.lower() == 'path':
-            if os.path.split(value)[0]:
-                if not os.path.isfile(value) and not os.access(value, os.X_OK):
-                    return False
-            else:
-                pathdirs = set(os.environ.get('PATH', '').split(os.pathsep))
-                pathdirs.update(['/sbin', '/usr/sbin'])
-                for path in pathdirs:
-                    filename = os.path.join(path, value)
-                    if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                        break
-                else:
-                    return False
-        elif dep_type.lower() == 'c_include':
-            if c_include_search_paths is None:
-                c_include_search_paths = get_c_include_search_paths(config)
-            found = False
-            for path in c_include_search_paths:
+        return list(set(paths)) # remove duplicates
+
+    def has_executable(self, value):
+        if os.path.split(value)[0]:
+            return os.path.isfile(value) or os.access(value, os.X_OK)
+        pathdirs = set(os.environ.get('PATH', '').split(os.pathsep))
+        pathdirs.update(['/sbin', '/usr/sbin'])
+        for path in pathdirs:
+            if path not in self._executables:
+                try:
+                    self._executables[path] = set(os.listdir(path))
+                except OSError:
+                    self._executables[path] = set()
+            if value in self._executables[path]:
                 filename = os.path.join(path, value)
-                if os.path.isfile(filename):
-                    found = True
-                    break
-            if not found:
-                return False
-
-        elif dep_type == 'python2':
+                if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                    return True
+        return False
+
+    def has_c_include(self, module_name, value):
+        for path in self.get_c_include_search_paths(module_name):
+            if self._is_file(os.path.join(path, value)):
+                return True
+        return False
+
+    def has_python_module(self, value):
+        if value not in self._python_modules:
             try:
                 imp.find_module(value)
+                self._python_modules[value] = True
             except:
-                return False
+                self._python_modules[value] = False
+        return self._python_modules[value]
 
-        elif dep_type == 'xml':
-            xml_catalog = '/etc/xml/catalog'
+    def get_xml_catalog(self):
+        xml_catalog = '/etc/xml/catalog'
 
-            if not os.path.exists(xml_catalog):
-                for d in os.environ['XDG_DATA_DIRS'].split(':'):
-                    xml_catalog = os.path.join(d, 'xml', 'catalog')
-                    if os.path.exists(xml_catalog):
-                        break
-
-            try:
-                # no xmlcatalog installed will (correctly) fail the check
-                subprocess.check_output(['xmlcatalog', xml_catalog, value])
-
-            except:
-                return False
+        if not os.path.exists(xml_catalog):
+            for d in os.environ['XDG_DATA_DIRS'].split(':'):
+                xml_catalog = os.path.join(d, 'xml', 'catalog')
+                if os.path.exists(xml_catalog):
+                    break
+        return xml_catalog
 
-    return True
+    def resolve_xml(self, values):
+        '''Looks the given public, system or URI identifiers up in the xml
+        catalog, all at once.'''
+        xml_catalog = self.get_xml_catalog()
+        try:
+            key = (xml_catalog, os.stat(xml_catalog).st_mtime,
+                   os.stat(os.path.dirname(xml_catalog)).st_mtime)
+        except OSError:
+            key = None
+        cached = self.cache['xml']
+        if cached.get('key') != key:
+            cached.clear()
+            cached['key'] = key
+        pending = []
+        for value in values:
+            # modules often share identifiers, look each up once
+            if value not in cached and value not in pending:
+                pending.append(value)
+        values = pending
+        if not values:
+            return
+        self.cache['modified'] = True
+        try:
+            # no xmlcatalog installed will (correctly) fail the check
+            proc = subprocess.Popen(['xmlcatalog', xml_catalog] + values,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, close_fds=True)
+            stdout = proc.communicate()[0]
+        except OSError:
+            for value in values:
+                cached[value] = False
+            return
+        # xmlcatalog exits with 4 when an identifier is missing, and tells
+        # about it with a 'No entry for PUBLIC|URI <identifier>' line
+        missing = set()
+        for line in stdout.splitlines():
+            m = re.match(r'No entry for (?:PUBLIC|URI) (.*)$', line)
+            if m:
+                missing.add(m.group(1))
+        for value in values:
+            cached[value] = proc.returncode in (0, 4) and value not in missing
+
+    def dependencies_met(self, module_name, sysdeps):
+        '''Returns True of the system dependencies are met for module_name'''
+        for dep_type, value in sysdeps:
+            if dep_type.lower() == 'path':
+                if not self.has_executable(value):
+                    return False
+            elif dep_type.lower() == 'c_include':
+                if not self.has_c_include(module_name, value):
+                    return False
+            elif dep_type == 'python2':
+                if not self.has_python_module(value):
+                    return False
+            elif dep_type == 'xml':
+                self.resolve_xml([value])
+                if not self.cache['xml'][value]:
+                    return False
+        return True
+
+    def check_modules(self, modules):
+        '''Takes a list of (module name, system dependencies) pairs and
+        returns a dictionary telling whether each module's dependencies are
+        met.'''
+        self.resolve_xml([value for module_name, sysdeps in modules
+                          for dep_type, value in sysdeps if dep_type == 'xml'])
+        result = {}
+        for module_name, sysdeps in modules:
+            result[module_name] = self.dependencies_met(module_name, sysdeps)
+        self.save()
+        return result
+
+    def save(self):
+        _save_cache(self.config, self.cache_name, self.cache)
 
 class SystemInstall(object):
-    def __init__(self):
+    def __init__(self, config=None):
+        self.config = config
         if cmds.has_command('pkexec'):
             self._root_command_prefix_args = ['pkexec']
         elif cmds.has_command('sudo'):
@@ -192,11 +414,11 @@ class SystemInstall(object):
         raise NotImplementedError()
 
     @classmethod
-    def find_best(cls):
+    def find_best(cls, config=None):
         global _classes
         for possible_cls in _classes:
             if possible_cls.detect():
-                return possible_cls()
+                return possible_cls(config)
 
 # PackageKit dbus interface contains bitfield constants which
 # aren't introspectable
@@ -208,8 +430,8 @@ PK_TRANSACTION_FLAG_ENUM_ONLY_TRUSTED = 1 << 1
 
 # NOTE: This class is unfinished
 class PKSystemInstall(SystemInstall):
-    def __init__(self):
-        SystemInstall.__init__(self)
+    def __init__(self, config=None):
+        SystemInstall.__init__(self, config)
         self._loop = None
         self._sysbus = None
         self._pkdbus = None
@@ -323,8 +545,8 @@ class PKSystemInstall(SystemInstall):
         return cmds.has_command('pkcon')
 
 class YumSystemInstall(SystemInstall):
-    def __init__(self):
-        SystemInstall.__init__(self)
+    def __init__(self, config=None):
+        SystemInstall.__init__(self, config)
 
     def install(self, uninstalled):
         uninstalled_pkgconfigs, uninstalled_filenames = get_uninstalled_pkgconfigs_and_filenames(uninstalled)
@@ -349,27 +571,67 @@ class YumSystemInstall(SystemInstall):
 
 
 class AptSystemInstall(SystemInstall):
-    def __init__(self):
-        SystemInstall.__init__(self)
+    # directories whose mtime changes when the apt-file index is updated
+    index_dirs = ['/var/lib/apt/lists', '/var/cache/apt/apt-file']
 
-    def _get_package_for(self, filename):
-        proc = subprocess.Popen(['apt-file', 'search', filename],
-                                stdout=subprocess.PIPE, close_fds=True)
-        stdout = proc.communicate()[0]
-        if proc.returncode != 0:
-            return None
-        for line in StringIO(stdout):
-            parts = line.split(':', 1)
-            if len(parts) != 2:
-                continue
-            name = parts[0]
-            path = parts[1]
-            # No idea why the LSB has forks of the pkg-config files
-            if path.find('/lsb3') != -1:
-                continue
-            
-            # otherwise for now, just take the first match
-            return name
+    def __init__(self, config=None):
+        SystemInstall.__init__(self, config)
+
+    def _get_index_timestamp(self):
+        timestamp = []
+        for dirname in self.index_dirs:
+            try:
+                timestamp.append(os.stat(dirname).st_mtime)
+            except OSError:
+                timestamp.append(None)
+        return timestamp
+
+    def _get_packages_for(self, filenames):
+        """Returns a dictionary mapping each of filenames to the package
+        providing it, or None, using a single apt-file search."""
+        cache = {}
+        if self.config is not None:
+            cache = _load_cache(self.config, 'apt-file.cache')
+        if cache.get('timestamp') != self._get_index_timestamp():
+            cache['timestamp'] = self._get_index_timestamp()
+            cache['providers'] = {}
+        providers = cache['providers']
+
+        patterns = [x for x in filenames if x not in providers]
+        if patterns:
+            proc = subprocess.Popen(['apt-file', 'search', '-f', '-'],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, close_fds=True)
+            stdout, stderr = proc.communicate(
+                    ''.join([x + '\n' for x in patterns]))
+            # apt-file exits with 1 when nothing matches at all, anything
+            # else is an error and nothing is remembered of this search
+            if proc.returncode not in (0, 1) or \
+                    (proc.returncode == 1 and stderr.strip()):
+                logging.warning(_('apt-file failed: %s') % stderr.strip())
+                return dict([(x, providers.get(x)) for x in filenames])
+            found = {}
+            for line in StringIO(stdout):
+                parts = line.split(':', 1)
+                if len(parts) != 2:
+                    continue
+                name = parts[0]
+                path = parts[1].strip()
+                # No idea why the LSB has forks of the pkg-config files
+                if path.find('/lsb3') != -1:
+                    continue
+
+                # otherwise for now, just take the first match
+                for pattern in patterns:
+                    if pattern in path and pattern not in found:
+                        found[pattern] = name
+            for pattern in patterns:
+                providers[pattern] = found.get(pattern)
+            cache['modified'] = True
+            if self.config is not None:
+                _save_cache(self.config, 'apt-file.cache', cache)
+        return dict([(x, providers[x]) for x in filenames])
 
     def install(self, uninstalled):
         uninstalled_pkgconfigs, uninstalled_filenames = get_uninstalled_pkgconfigs_and_filenames(uninstalled)
@@ -377,10 +639,13 @@ class AptSystemInstall(SystemInstall):
         native_packages = []
         pkgconfigs = [(modname, '/%s.pc' % pkg) for modname, pkg in
                       uninstalled_pkgconfigs]
+        providers = self._get_packages_for([filename for modname, filename in
+                                            pkgconfigs + uninstalled_filenames])
         for modname, filename in pkgconfigs + uninstalled_filenames:
-            native_pkg = self._get_package_for(filename)
+            native_pkg = providers[filename]
             if native_pkg:
-                native_packages.append(native_pkg)
+                if native_pkg not in native_packages:
+                    native_packages.append(native_pkg)
             else:
                 logging.info(_('No native package found for %(id)s '
                                '(%(filename)s)') % {'id'       : modname,
@@ -76,6 +76,82 @@ should be run."""
         """Returns the command required to execute the trigger script."""
         return ['/bin/sh', self._file]
 
+    def get_pattern(self):
+        """Returns a regular expression source matching the same paths as
+the trigger, or None if its expressions can not be merged with others
+(capturing groups or inline flags)."""
+        patterns = []
+        for r in self._rematches:
+            if r.groups or r.flags:
+                return None
+            patterns.append(r.pattern)
+        for literal in self._literal_matches:
+            patterns.append(re.escape(literal))
+        return '|'.join(patterns)
+
+
+class TriggerMatcher(object):
+    """Matches install manifests against a set of triggers.
+
+The expressions of all the triggers are merged into a single regular
+expression, with one named group per trigger, so each path of a manifest
+is only searched once."""
+
+    def __init__(self, triggers):
+        self.triggers = triggers
+        self._has_executable = {}
+        self._regexps = {}
+
+    def is_available(self, trig):
+        executable = trig._executable
+        if executable is None:
+            return True
+        if not executable in self._has_executable:
+            self._has_executable[executable] = cmds.has_command(executable)
+        return self._has_executable[executable]
+
+    def _get_regexp(self, triggers):
+        key = tuple([id(trig) for trig in triggers])
+        if not key in self._regexps:
+            groups = {}
+            patterns = []
+            for i, trig in enumerate(triggers):
+                groups['t%d' % i] = trig
+                patterns.append('(?P<t%d>%s)' % (i, trig.get_pattern()))
+            self._regexps[key] = (re.compile('|'.join(patterns)), groups)
+        return self._regexps[key]
+
+    def matches(self, files_list):
+        """Returns the set of triggers to run after installing
+@files_list."""
+        result = set()
+        merged = []
+        for trig in self.triggers:
+            if not self.is_available(trig):
+                continue
+            if trig.get_pattern() is None:
+                if trig.matches(files_list):
+                    result.add(trig)
+            else:
+                merged.append(trig)
+
+        for path in files_list:
+            if not merged:
+                break
+            # a path may match several triggers, search again without the
+            # trigger found until no remaining one matches
+            while merged:
+                regexp, groups = self._get_regexp(merged)
+                match = regexp.search(path)
+                if match is None:
+                    break
+                for name, value in match.groupdict().items():
+                    if value is not None:
+                        break
+                result.add(groups[name])
+                merged.remove(groups[name])
+        return result
+
 def load_all(dirpath):
     if not os.path.isdir(dirpath):
         return []
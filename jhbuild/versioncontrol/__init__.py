@@ -22,12 +22,28 @@ __all__ = [
     'Branch',
     'register_repo_type',
     'get_repo_type',
+    'cached_tree_id',
     ]
 
 __metaclass__ = type
 
-from jhbuild.errors import FatalError, BuildStateError
+from jhbuild.errors import FatalError, BuildStateError, CommandError
+import jhbuild.utils.fileutils as fileutils
 import os
+import logging
+
+def cached_tree_id(tree_id):
+    """Decorator remembering the result of a Branch.tree_id() method until
+    the branch is checked out again, or invalidate_tree_id() is called."""
+    def cached(self):
+        try:
+            return self._tree_id
+        except AttributeError:
+            self._tree_id = tree_id(self)
+            return self._tree_id
+    cached.__name__ = tree_id.__name__
+    cached.__doc__ = tree_id.__doc__
+    return cached
 
 class Repository:
     """An abstract class representing a collection of modules."""
@@ -130,6 +146,7 @@ class Branch:
 
         May raise CommandError or BuildStateError if a problem occurrs.
         """
+        self.invalidate_tree_id()
         if self.checkout_mode in ('clobber', 'export'):
             self._wipedir(buildscript, self.srcdir)
             if self.checkout_mode == 'export':
@@ -164,9 +181,14 @@ class Branch:
         """A string identifier for the state of the working tree."""
         raise NotImplementedError
 
+    def invalidate_tree_id(self):
+        """Forget the identifier remembered by a cached tree_id()."""
+        self.__dict__.pop('_tree_id', None)
+
     def _wipedir(self, buildscript, dir):
         if dir and dir != os.sep and os.path.exists(dir):
-            buildscript.execute(['rm', '-rf', dir])
+            fileutils.remove_tree_async(dir,
+                    os.path.join(self.config.top_builddir, 'trash'))
 
     def _export(self, buildscript):
         raise NotImplementedError
@@ -177,9 +199,13 @@ class Branch:
              module = self.checkoutdir
          fromdir = os.path.join(copydir, os.path.basename(module))
          todir = os.path.join(self.config.checkoutroot, os.path.basename(module))
-         if os.path.exists(todir):
-             self._wipedir(buildscript, self.srcdir)
-         buildscript.execute(['cp', '-R', fromdir, todir])
+         logging.info(_('Synchronizing %(src)r into %(dest)r') %
+                      {'src': fromdir, 'dest': todir})
+         try:
+             fileutils.sync_tree(fromdir, todir)
+         except (IOError, OSError), e:
+             raise CommandError(_('Failed to copy %(src)r: %(err)s') %
+                                {'src': fromdir, 'err': e})
 
     def to_sxml(self):
         """Return an sxml representation of this checkout."""
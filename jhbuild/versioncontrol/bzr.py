@@ -27,7 +27,8 @@ import logging
 
 from jhbuild.errors import FatalError, CommandError
 from jhbuild.utils.cmds import get_output
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 from jhbuild.utils.sxml import sxml
 
@@ -218,6 +219,7 @@ Remove it or change your dvcs_mirror_dir settings.""") % self.srcdir)
             raise CommandError(_('%s not found') % 'bzr')
         Branch.checkout(self, buildscript)
 
+    @cached_tree_id
     def tree_id(self):
         if not os.path.exists(self.srcdir):
             return None
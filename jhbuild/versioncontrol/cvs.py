@@ -34,7 +34,8 @@ except ImportError:
 import git
 
 from jhbuild.errors import BuildStateError, CommandError
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 from jhbuild.utils.sxml import sxml
 
@@ -304,6 +305,7 @@ class CVSBranch(Branch):
             raise CommandError(_('%s not found') % 'cvs')
         Branch.checkout(self, buildscript)
 
+    @cached_tree_id
     def tree_id(self):
         if not os.path.exists(self.srcdir):
             return None
@@ -29,7 +29,8 @@ except ImportError:
     import md5 as hashlib
 
 from jhbuild.errors import FatalError, CommandError
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 
 class DarcsRepository(Repository):
@@ -111,6 +112,7 @@ class DarcsBranch(Branch):
         Branch.checkout(self, buildscript)
         self._fix_permissions()
 
+    @cached_tree_id
     def tree_id(self):
         # XXX: check with some darcs expert if there is not a command to get
         # this
@@ -27,7 +27,8 @@ import urlparse
 from subprocess import Popen, PIPE
 
 from jhbuild.errors import FatalError, CommandError
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 
 class FossilRepository(Repository):
@@ -117,6 +118,7 @@ class FossilBranch(Branch):
         infos = infos.stdout.read().strip()
         return re.search(r"checkout: +(\w+)", infos).group(1)
 
+    @cached_tree_id
     def tree_id(self):
         if not os.path.exists(self.srcdir):
             return None
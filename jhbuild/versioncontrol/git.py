@@ -22,20 +22,23 @@ __all__ = []
 __metaclass__ = type
 
 import os
+import bisect
 import stat
 import urlparse
-import subprocess
 import re
 import urllib
 import sys
 import logging
+import threading
 
 from jhbuild.errors import FatalError, CommandError
 from jhbuild.utils.cmds import get_output, check_version
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 import jhbuild.versioncontrol.svn
 from jhbuild.commands.sanitycheck import inpath
 from jhbuild.utils.sxml import sxml
+import jhbuild.utils.fileutils as fileutils
 
 # Make sure that the urlparse module considers git:// and git+ssh://
 # schemes to be netloc aware and set to allow relative URIs.
@@ -65,6 +68,242 @@ def get_git_mirror_directory(mirror_root, checkoutdir, module):
     else:
         return mirror_dir + '.git'
 
+# values of the partial_clone option, and the matching git object filters
+partial_clone_filters = {
+    'blobless': 'blob:none',
+    'treeless': 'tree:0',
+}
+
+# the first git versions cloning with these filters
+partial_clone_git_versions = {
+    'blobless': '2.19',
+    'treeless': '2.20',
+}
+
+# the first git version with several promisor remotes, which the checkouts
+# of partial mirrors need to fetch the missing objects from upstream
+partial_mirror_git_version = '2.25'
+
+def get_git_shared_store(mirror_root):
+    """Return the bare repository holding the objects shared by the mirrors."""
+    return os.path.join(mirror_root, '.jhbuild-objects.git')
+
+def get_git_alternates(git_dir):
+    """Return the object directories the repository at git_dir borrows
+    objects from, as real paths since git resolves the symbolic links of
+    the paths it writes there."""
+    objects_dir = os.path.join(git_dir, 'objects')
+    alternates = os.path.join(objects_dir, 'info', 'alternates')
+    if not os.path.exists(alternates):
+        return []
+    # relative paths are relative to the objects directory
+    return [os.path.realpath(os.path.join(objects_dir, x.strip()))
+            for x in open(alternates) if x.strip() and not x.startswith('#')]
+
+# results of the git version checks, git is not upgraded during a run
+_git_version_checks = {}
+
+def get_url_host(url):
+    """Return the host serving the repository at url, '' if it is local."""
+    netloc = urlparse.urlparse(url)[1]
+    if netloc:
+        return netloc.split('@')[-1]
+    # scp-like syntax, [user@]host:path
+    match = re.match(r'(?:[^@/]+@)?([^:/]+):', url)
+    if match:
+        return match.group(1)
+    return ''
+
+def check_remote_heads(branches):
+    """Mark the git branches whose upstream head did not change.
+
+    The heads are listed with one 'git ls-remote' per repository.  The
+    repositories of a host are queried one after the other, different
+    hosts are queried concurrently.  The marked branches skip their next
+    update.
+    """
+    by_host = {}
+    for branch in branches:
+        # git-svn and git-cvs branches do not update from origin
+        if branch.__class__ is not GitBranch:
+            continue
+        query = branch.get_remote_head_query()
+        if query:
+            by_host.setdefault(get_url_host(query[0]), []).append(
+                    (branch, query))
+
+    extra_env = get_git_extra_env()
+    # do not wait for passwords typed in another thread
+    extra_env['GIT_TERMINAL_PROMPT'] = '0'
+    results = []
+    errors = []
+    def list_remote_heads(queries):
+        # the branches whose heads could not be listed are fetched as usual
+        for branch, (url, refs) in queries:
+            try:
+                output = get_output(['git', 'ls-remote', url] + refs,
+                        extra_env=extra_env, get_stderr=False)
+            except CommandError:
+                continue
+            except Exception, e:
+                errors.append((url, e))
+                continue
+            heads = {}
+            for line in output.splitlines():
+                if '\t' in line:
+                    commit, ref = line.split('\t', 1)
+                    heads[ref] = commit
+            results.append((branch, heads))
+
+    threads = [threading.Thread(target=list_remote_heads, args=(queries,))
+               for queries in by_host.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for url, e in errors:
+        logging.warning(_('could not list the heads of %(url)s: %(error)s')
+                        % {'url': url, 'error': e})
+
+    for branch, heads in results:
+        branch.set_remote_heads(heads)
+
+def parse_status(output):
+    """Return the commit of HEAD, the current branch and whether tracked
+    files were changed, from the output of 'git status --porcelain=v2
+    --branch'.  The commit is None in a repository without commits, and
+    the branch is None if HEAD is detached."""
+    oid = None
+    head = None
+    dirty = False
+    for line in output.splitlines():
+        if line.startswith('# branch.oid '):
+            oid = line.split(' ', 2)[2]
+            if oid == '(initial)':
+                oid = None
+        elif line.startswith('# branch.head '):
+            head = line.split(' ', 2)[2]
+            if head == '(detached)':
+                head = None
+        elif not line.startswith('#'):
+            dirty = True
+    return oid, head, dirty
+
+class GitDateIndex(object):
+    """Index of the first parent history of a branch by commit date.
+
+    The index file lists the commit time and id of each commit in the
+    history, oldest first, so that the commit to use for a sticky date is
+    found by a binary search rather than by walking the history.  New
+    commits are appended to it as they are fetched, and it is rebuilt if
+    the history was rewritten.  The index is only a cache: it is rebuilt
+    if it cannot be read, and left out if it cannot be written.
+    """
+
+    def __init__(self, checkoutdir, ref='master'):
+        self.checkoutdir = checkoutdir
+        self.ref = ref
+        self.filename = None
+
+    def get_filename(self):
+        if self.filename is None:
+            # .git is a file pointing elsewhere in worktrees and submodules
+            git_dir = self.git(['rev-parse', '--git-dir']).strip()
+            self.filename = os.path.join(self.checkoutdir, git_dir,
+                    'jhbuild-date-index-' + self.ref.replace('/', '-'))
+        return self.filename
+
+    def git(self, args):
+        return get_output(['git'] + args, cwd=self.checkoutdir,
+                extra_env=get_git_extra_env(), get_stderr=False)
+
+    def get_timestamp(self, date):
+        """Convert a date, as understood by git, into a timestamp."""
+        output = self.git(['rev-parse', '--until=%s' % date]).strip()
+        return int(output.split('=', 1)[1])
+
+    def read(self):
+        times, commits = [], []
+        try:
+            fp = open(self.get_filename())
+            try:
+                for line in fp:
+                    timestamp, commit = line.split()
+                    times.append(int(timestamp))
+                    commits.append(commit)
+            finally:
+                fp.close()
+        except (EnvironmentError, ValueError):
+            # missing, or truncated by an interrupted write
+            return [], []
+        return times, commits
+
+    def update(self):
+        """Bring the index up to date with the branch and return it."""
+        times, commits = self.read()
+        tip = self.git(['rev-parse', '--verify', '%s^{commit}' % self.ref]
+                ).strip()
+        if commits and commits[-1] == tip:
+            return times, commits
+
+        if commits:
+            try:
+                output = self.git(['log', '--first-parent',
+                        '--format=%ct %H %P', '%s..%s' % (commits[-1], tip)])
+            except CommandError:
+                output = ''
+            lines = [x.split() for x in output.splitlines()]
+            # the new commits must follow the indexed ones, otherwise the
+            # history was rewritten
+            if lines and lines[-1][2:3] == [commits[-1]]:
+                lines.reverse()
+                try:
+                    fp = open(self.get_filename(), 'a')
+                    for line in lines:
+                        fp.write('%s %s\n' % (line[0], line[1]))
+                    fp.close()
+                except EnvironmentError, e:
+                    logging.debug('failed to write %s: %s'
+                                  % (self.get_filename(), e))
+                for line in lines:
+                    times.append(int(line[0]))
+                    commits.append(line[1])
+                return times, commits
+
+        lines = [x.split() for x in self.git(['log', '--first-parent',
+                '--format=%ct %H', tip]).splitlines()]
+        lines.reverse()
+        try:
+            writer = fileutils.SafeWriter(self.get_filename())
+            for timestamp, commit in lines:
+                writer.fp.write('%s %s\n' % (timestamp, commit))
+            writer.commit()
+        except EnvironmentError, e:
+            logging.debug('failed to write %s: %s' % (self.get_filename(), e))
+        return [int(x[0]) for x in lines], [x[1] for x in lines]
+
+    def invalidate(self):
+        try:
+            fileutils.ensure_unlinked(self.get_filename())
+        except EnvironmentError, e:
+            logging.debug('failed to remove %s: %s' % (self.get_filename(), e))
+
+    def lookup(self, date):
+        """Return the newest commit of the branch that is not newer than
+        date, like 'git log --first-parent --until=date' would, or None."""
+        timestamp = self.get_timestamp(date)
+        times, commits = self.update()
+        # commit times are not monotonic, search the lowest time among each
+        # commit and the newer ones instead, which never decreases
+        minimums = times[:]
+        for i in range(len(minimums) - 2, -1, -1):
+            minimums[i] = min(minimums[i], minimums[i + 1])
+        i = bisect.bisect_right(minimums, timestamp)
+        if i == 0:
+            return None
+        return commits[i - 1]
+
 class GitUnknownBranchNameError(Exception):
     pass
 
@@ -121,9 +360,10 @@ class GitRepository(Repository):
 
         if mirror_module:
             return GitBranch(self, mirror_module, subdir, checkoutdir,
-                    revision, tag, unmirrored_module=module)
+                    revision, tag, unmirrored_module=module, module_name=name)
         else:
-            return GitBranch(self, module, subdir, checkoutdir, revision, tag)
+            return GitBranch(self, module, subdir, checkoutdir, revision, tag,
+                    module_name=name)
 
     def to_sxml(self):
         return [sxml.repository(type='git', name=self.name, href=self.href)]
@@ -138,12 +378,16 @@ class GitBranch(Branch):
     dirty_branch_suffix = '-dirty'
 
     def __init__(self, repository, module, subdir, checkoutdir=None,
-                 branch=None, tag=None, unmirrored_module=None):
+                 branch=None, tag=None, unmirrored_module=None,
+                 module_name=None):
         Branch.__init__(self, repository, module, checkoutdir)
         self.subdir = subdir
         self.branch = branch
         self.tag = tag
         self.unmirrored_module = unmirrored_module
+        self.module_name = module_name
+        self._state = None
+        self.remote_head_unchanged = False
 
     def get_module_basename(self):
         # prevent basename() from returning empty strings on trailing '/'
@@ -168,6 +412,82 @@ class GitBranch(Branch):
         return self.branch
     branchname = property(branchname)
 
+    def get_partial_clone_filter(self):
+        """Return the object filter to use when cloning, or None."""
+        partial_clone = self.config.module_partial_clone.get(
+                self.module_name, self.config.partial_clone)
+        if not partial_clone:
+            return None
+        version = partial_clone_git_versions[partial_clone]
+        if self.config.dvcs_mirror_dir:
+            version = partial_mirror_git_version
+        if not self.check_version_git(version):
+            logging.warning(_('%(kind)s clones need at least git-%(version)s, '
+                    'ignoring partial_clone') % {'kind': partial_clone,
+                                                 'version': version})
+            return None
+        return partial_clone_filters[partial_clone]
+
+    def execute_git(self, buildscript, cmd, **kwargs):
+        """Run a git command that may change the state of the checkout."""
+        try:
+            buildscript.execute(cmd, **kwargs)
+        finally:
+            self.invalidate_tree_id()
+
+    def get_state(self):
+        """Return a snapshot of the checkout state, read with a single git
+        command, or None if git is too old to provide it this way.
+
+        The snapshot is a dictionary with the following keys: 'inside'
+        tells whether the checkout directory is a git work tree, 'oid' is
+        the commit of HEAD, 'head' the current branch or None if HEAD is
+        detached, 'dirty' tells whether tracked files were changed, and
+        'refs', filled by get_refs(), maps each ref name to the ref it
+        tracks.
+        """
+        if self._state is not None:
+            return self._state
+        if not self.check_version_git('2.11'):
+            # git status --porcelain=v2 is not available
+            return None
+        state = {'inside': False, 'oid': None, 'head': None,
+                 'dirty': True, 'refs': None}
+        git_extra_args = {'cwd': self.get_checkoutdir(),
+                'extra_env': get_git_extra_env(), 'get_stderr': False}
+        if os.path.exists(self.get_checkoutdir()):
+            try:
+                status = get_output(['git', 'status', '--porcelain=v2',
+                        '--branch', '--untracked-files=no',
+                        '--ignore-submodules=all'], **git_extra_args)
+            except CommandError:
+                pass
+            else:
+                state['inside'] = True
+                state['oid'], state['head'], state['dirty'] = \
+                        parse_status(status)
+                if not state['oid']:
+                    state['dirty'] = True
+        self._state = state
+        return state
+
+    def get_refs(self):
+        """Return the refs of the snapshot returned by get_state()."""
+        state = self.get_state()
+        if state['refs'] is None:
+            state['refs'] = {}
+            try:
+                output = get_output(['git', 'for-each-ref',
+                        '--format=%(refname) %(upstream)'],
+                        cwd=self.get_checkoutdir(),
+                        extra_env=get_git_extra_env(), get_stderr=False)
+            except CommandError:
+                output = ''
+            for line in output.splitlines():
+                refname, upstream = (line + ' ').split(' ', 1)
+                state['refs'][refname] = upstream.strip()
+        return state['refs']
+
     def execute_git_predicate(self, predicate):
         """A git command wrapper for the cases, where only the boolean outcome
         is of interest.
@@ -180,24 +500,68 @@ class GitBranch(Branch):
         return True
 
     def is_local_branch(self, branch):
-        is_local_head = self.execute_git_predicate( ['git', 'show-ref', '--quiet',
-                                                     '--verify', 'refs/heads/' + branch])
-        if is_local_head:
-            return True
+        state = self.get_state()
+        if state is not None and state['inside']:
+            refs = self.get_refs()
+            for ref in ('refs/heads/%s', 'refs/%s', 'refs/tags/%s',
+                        'refs/remotes/%s', 'refs/remotes/%s/HEAD'):
+                if ref % branch in refs:
+                    return True
+            # only commit ids and revision expressions are left to check
+            if not (re.match(r'[0-9a-fA-F]{4,40}$', branch) or
+                    re.search(r'[~^@:{]', branch) or branch.endswith('HEAD')):
+                return False
+        else:
+            is_local_head = self.execute_git_predicate( ['git', 'show-ref', '--quiet',
+                                                         '--verify', 'refs/heads/' + branch])
+            if is_local_head:
+                return True
         return self.execute_git_predicate(['git', 'rev-parse', branch])
 
     def is_inside_work_tree(self):
+        state = self.get_state()
+        if state is not None:
+            return state['inside']
         return self.execute_git_predicate(
                 ['git', 'rev-parse', '--is-inside-work-tree'])
 
     def is_tracking_a_remote_branch(self, local_branch):
         if not local_branch:
             return False
+        state = self.get_state()
+        if state is not None and state['inside']:
+            return bool(self.get_refs().get('refs/heads/' + local_branch))
         current_branch_remote_config = 'branch.%s.remote' % local_branch
         return self.execute_git_predicate(
                 ['git', 'config', '--get', current_branch_remote_config])
 
+    def is_shallow(self):
+        return os.path.exists(os.path.join(self.get_checkoutdir(),
+                '.git', 'shallow'))
+
+    def is_single_branch(self):
+        """Whether origin is only fetched for some of its branches."""
+        try:
+            refspecs = get_output(['git', 'config', '--get-all',
+                    'remote.origin.fetch'], cwd=self.get_checkoutdir(),
+                    extra_env=get_git_extra_env()).splitlines()
+        except CommandError:
+            return False
+        return not [x for x in refspecs if '*' in x]
+
+    def get_repository_filter(self, git_dir, remote='origin'):
+        """Return the object filter git_dir was partially cloned with."""
+        try:
+            return get_output(['git', 'config', '--get',
+                    'remote.%s.partialclonefilter' % remote], cwd=git_dir,
+                    extra_env=get_git_extra_env()).strip() or None
+        except CommandError:
+            return None
+
     def is_dirty(self, ignore_submodules=True):
+        state = self.get_state()
+        if ignore_submodules and state is not None and state['inside']:
+            return state['dirty']
         submodule_options = []
         if ignore_submodules:
             if not self.check_version_git('1.5.6'):
@@ -209,14 +573,20 @@ class GitBranch(Branch):
                 + ['HEAD'])
 
     def check_version_git(self, version_spec):
-        return check_version(['git', '--version'], r'git version ([\d.]+)',
-                version_spec, extra_env=get_git_extra_env())
+        if version_spec not in _git_version_checks:
+            _git_version_checks[version_spec] = check_version(
+                    ['git', '--version'], r'git version ([\d.]+)',
+                    version_spec, extra_env=get_git_extra_env())
+        return _git_version_checks[version_spec]
 
     def get_current_branch(self):
         """Returns either a branchname or None if head is detached"""
         if not self.is_inside_work_tree():
             raise CommandError(_('Unexpected: Checkoutdir is not a git '
                     'repository:' + self.get_checkoutdir()))
+        state = self.get_state()
+        if state is not None:
+            return state['head']
         try:
             return os.path.basename(
                     get_output(['git', 'symbolic-ref', '-q', 'HEAD'],
@@ -230,11 +600,33 @@ class GitBranch(Branch):
         """Try to find the given branch first, locally, then remotely, and state
         the availability in the return value."""
         wanted_ref = remote_name + '/' + branch_name
-        if self.execute_git_predicate( ['git', 'show-ref', wanted_ref]):
+        if self.has_remote_ref(wanted_ref):
+            return True
+        git_extra_args = {'cwd': self.get_checkoutdir(),
+                'extra_env': get_git_extra_env()}
+        self.execute_git(buildscript, ['git', 'fetch'], **git_extra_args)
+        if self.has_remote_ref(wanted_ref):
             return True
-        buildscript.execute(['git', 'fetch'], cwd=self.get_checkoutdir(),
-                extra_env=get_git_extra_env())
-        return self.execute_git_predicate( ['git', 'show-ref', wanted_ref])
+        if not self.is_single_branch():
+            return False
+        # single branch and shallow clones only fetch the branch they were
+        # cloned from, start tracking the wanted one as well.
+        self.execute_git(buildscript, ['git', 'remote', 'set-branches', '--add',
+                remote_name, branch_name], **git_extra_args)
+        cmd = ['git', 'fetch']
+        if self.is_shallow():
+            cmd.append('--depth=1')
+        try:
+            self.execute_git(buildscript, cmd + [remote_name], **git_extra_args)
+        except CommandError:
+            return False
+        return self.has_remote_ref(wanted_ref)
+
+    def has_remote_ref(self, ref):
+        state = self.get_state()
+        if state is not None and state['inside']:
+            return 'refs/remotes/' + ref in self.get_refs()
+        return self.execute_git_predicate( ['git', 'show-ref', ref])
 
     def get_branch_switch_destination(self):
         current_branch = self.get_current_branch()
@@ -280,7 +672,7 @@ class GitBranch(Branch):
         if switch_command:
             if self.is_dirty():
                 raise CommandError(_('Refusing to switch a dirty tree.'))
-            buildscript.execute(switch_command, cwd=self.get_checkoutdir(),
+            self.execute_git(buildscript, switch_command, cwd=self.get_checkoutdir(),
                     extra_env=get_git_extra_env())
 
     def rebase_current_branch(self, buildscript):
@@ -295,18 +687,18 @@ class GitBranch(Branch):
         stashed = False
         if self.is_dirty(ignore_submodules=True):
             stashed = True
-            buildscript.execute(['git', 'stash', 'save', 'jhbuild-stash'],
+            self.execute_git(buildscript, ['git', 'stash', 'save', 'jhbuild-stash'],
                     **git_extra_args)
 
-        buildscript.execute(['git', 'rebase', 'origin/' + branch],
+        self.execute_git(buildscript, ['git', 'rebase', 'origin/' + branch],
                             **git_extra_args)
 
         if stashed:
             # git stash pop was introduced in 1.5.5,
             if self.check_version_git('1.5.5'):
-                buildscript.execute(['git', 'stash', 'pop'], **git_extra_args)
+                self.execute_git(buildscript, ['git', 'stash', 'pop'], **git_extra_args)
             else:
-                buildscript.execute(['git', 'stash', 'apply', 'jhbuild-stash'],
+                self.execute_git(buildscript, ['git', 'stash', 'apply', 'jhbuild-stash'],
                         **git_extra_args)
 
     def move_to_sticky_date(self, buildscript):
@@ -314,7 +706,6 @@ class GitBranch(Branch):
             quiet = ['-q']
         else:
             quiet = []
-        commit = self._get_commit_from_date()
         branch = 'jhbuild-date-branch'
         branch_cmd = ['git', 'checkout'] + quiet + [branch]
         git_extra_args = {'cwd': self.get_checkoutdir(),
@@ -322,15 +713,16 @@ class GitBranch(Branch):
         if self.config.sticky_date == 'none':
             current_branch = self.get_current_branch()
             if current_branch and current_branch == branch:
-                buildscript.execute(['git', 'checkout'] + quiet + ['master'],
+                self.execute_git(buildscript, ['git', 'checkout'] + quiet + ['master'],
                         **git_extra_args)
             return
+        commit = self._get_commit_from_date(buildscript)
         try:
-            buildscript.execute(branch_cmd, **git_extra_args)
+            self.execute_git(buildscript, branch_cmd, **git_extra_args)
         except CommandError:
             branch_cmd = ['git', 'checkout'] + quiet + ['-b', branch]
-            buildscript.execute(branch_cmd, **git_extra_args)
-        buildscript.execute(['git', 'reset', '--hard', commit], **git_extra_args)
+            self.execute_git(buildscript, branch_cmd, **git_extra_args)
+        self.execute_git(buildscript, ['git', 'reset', '--hard', commit], **git_extra_args)
 
     def get_remote_branches_list(self):
         return [x.strip() for x in get_output(['git', 'branch', '-r'],
@@ -348,22 +740,67 @@ class GitBranch(Branch):
 
         return True
 
-    def _get_commit_from_date(self):
-        cmd = ['git', 'log', '--max-count=1', '--first-parent',
-                '--until=%s' % self.config.sticky_date, 'master']
-        cmd_desc = ' '.join(cmd)
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                cwd=self.get_checkoutdir(),
-                                env=get_git_extra_env())
-        stdout = proc.communicate()[0]
-        if not stdout.strip():
-            raise CommandError(_('Command %s returned no output') % cmd_desc)
-        for line in stdout.splitlines():
-            if line.startswith('commit '):
-                commit = line.split(None, 1)[1].strip()
-                return commit
-        raise CommandError(_('Command %s did not include commit line: %r')
-                           % (cmd_desc, stdout))
+    def _get_commit_from_date(self, buildscript=None):
+        index = GitDateIndex(self.get_checkoutdir())
+        depth = 64
+        while True:
+            commit = index.lookup(self.config.sticky_date)
+            if commit or not buildscript or not self.is_shallow():
+                break
+            # every commit we have is newer than the sticky date, fetch
+            # more history, a little more each time
+            self.execute_git(buildscript, ['git', 'fetch', '--deepen=%d' % depth,
+                    'origin'], cwd=self.get_checkoutdir(),
+                    extra_env=get_git_extra_env())
+            # the older commits go at the start of the index
+            index.invalidate()
+            depth *= 4
+        if not commit:
+            raise CommandError(_('No commit of %(branch)s is older than '
+                    '%(date)s') % {'branch': 'master',
+                                   'date': self.config.sticky_date})
+        return commit
+
+    def get_remote_head_query(self):
+        """Return the repository and the refs to list to find out whether
+        the checkout is up to date with upstream, or None if it cannot be
+        told this way."""
+        cwd = self.get_checkoutdir()
+        if self.config.sticky_date or not os.path.exists(
+                os.path.join(cwd, '.git')):
+            return None
+        if os.path.exists(os.path.join(cwd, '.gitmodules')):
+            # the submodules may have changed on their own
+            return None
+        url = self.unmirrored_module or self.module
+        if self.tag:
+            return url, ['refs/tags/' + self.tag]
+        if self.branch:
+            return url, ['refs/heads/' + self.branch]
+        return url, ['HEAD']
+
+    def set_remote_heads(self, heads):
+        """Mark the branch as up to date if the upstream head, taken from
+        the ls-remote output in heads, is already checked out."""
+        if self.tag:
+            commit = heads.get('refs/tags/%s^{}' % self.tag,
+                    heads.get('refs/tags/' + self.tag))
+        elif self.branch:
+            commit = heads.get('refs/heads/' + self.branch)
+        else:
+            commit = heads.get('HEAD')
+        if not commit or self.tree_id() != commit:
+            return
+        if not self.tag and self.get_branch_switch_destination():
+            return
+        try:
+            url = get_output(['git', 'config', '--get', 'remote.origin.url'],
+                    cwd=self.get_checkoutdir(),
+                    extra_env=get_git_extra_env()).strip()
+        except CommandError:
+            return
+        if url == self.module:
+            self.remote_head_unchanged = True
 
     def _export(self, buildscript):
         # FIXME: should implement this properly
@@ -372,10 +809,10 @@ class GitBranch(Branch):
     def _update_submodules(self, buildscript):
         if os.path.exists(os.path.join(self.get_checkoutdir(), '.gitmodules')):
             cmd = ['git', 'submodule', 'init']
-            buildscript.execute(cmd, cwd=self.get_checkoutdir(),
+            self.execute_git(buildscript, cmd, cwd=self.get_checkoutdir(),
                     extra_env=get_git_extra_env())
             cmd = ['git', 'submodule', 'update']
-            buildscript.execute(cmd, cwd=self.get_checkoutdir(),
+            self.execute_git(buildscript, cmd, cwd=self.get_checkoutdir(),
                     extra_env=get_git_extra_env())
 
     def update_dvcs_mirror(self, buildscript):
@@ -389,12 +826,84 @@ class GitBranch(Branch):
                 self.checkoutdir, self.unmirrored_module)
 
         if os.path.exists(mirror_dir):
+            partial_filter = self.get_repository_filter(mirror_dir)
+        else:
+            partial_filter = self.get_partial_clone_filter()
+
+        # partial mirrors cannot give away objects they do not have, keep
+        # them out of the shared store.
+        shared_store = None
+        if self.config.dvcs_mirror_alternates and not partial_filter:
+            shared_store = self.update_shared_store(buildscript)
+
+        if os.path.exists(mirror_dir):
+            if shared_store and self.add_alternate(mirror_dir, shared_store):
+                self.keep_unreachable_objects(buildscript, mirror_dir)
             buildscript.execute(['git', 'fetch'], cwd=mirror_dir,
                     extra_env=get_git_extra_env())
         else:
-            buildscript.execute(
-                    ['git', 'clone', '--mirror', self.unmirrored_module,
-                    mirror_dir], extra_env=get_git_extra_env())
+            cmd = ['git', 'clone', '--mirror']
+            if shared_store:
+                cmd.extend(['--reference', shared_store])
+            if partial_filter:
+                cmd.append('--filter=%s' % partial_filter)
+            buildscript.execute(cmd + [self.unmirrored_module, mirror_dir],
+                    extra_env=get_git_extra_env())
+            if shared_store:
+                self.keep_unreachable_objects(buildscript, mirror_dir)
+            if partial_filter:
+                # let the checkouts make partial clones of the mirror
+                for key in ('uploadpack.allowFilter',
+                            'uploadpack.allowAnySHA1InWant'):
+                    buildscript.execute(['git', 'config', key, 'true'],
+                            cwd=mirror_dir, extra_env=get_git_extra_env())
+
+        if shared_store:
+            # copy the new objects to the shared store, so that other mirrors
+            # of the same history can borrow them instead of keeping their
+            # own copy; 'jhbuild repackmirrors' drops the duplicates.
+            name = os.path.basename(mirror_dir)[:-len('.git')]
+            buildscript.execute(['git', 'fetch', '--quiet', mirror_dir,
+                    '+refs/*:refs/mirrors/%s/*' % name], cwd=shared_store,
+                    extra_env=get_git_extra_env())
+
+    def update_shared_store(self, buildscript):
+        shared_store = get_git_shared_store(self.config.dvcs_mirror_dir)
+        if not os.path.exists(shared_store):
+            buildscript.execute(['git', 'init', '--bare', '--quiet',
+                    shared_store], extra_env=get_git_extra_env())
+            # 'jhbuild repackmirrors' packs the store, automatic collections
+            # would only prune it
+            buildscript.execute(['git', 'config', 'gc.auto', '0'],
+                    cwd=shared_store, extra_env=get_git_extra_env())
+            self.keep_unreachable_objects(buildscript, shared_store)
+        return shared_store
+
+    def keep_unreachable_objects(self, buildscript, git_dir):
+        """Never prune the objects of a repository others borrow from.
+
+        Checkouts may still refer to commits that upstream dropped with a
+        forced push or a branch removal, and they would be corrupted if the
+        objects went away.
+        """
+        buildscript.execute(['git', 'config', 'gc.pruneExpire', 'never'],
+                cwd=git_dir, extra_env=get_git_extra_env())
+
+    def add_alternate(self, git_dir, object_store):
+        """Let the repository at git_dir borrow objects from object_store.
+
+        Returns False if it already did."""
+        if os.path.isdir(os.path.join(git_dir, '.git')):
+            git_dir = os.path.join(git_dir, '.git')
+        alternates = os.path.join(git_dir, 'objects', 'info', 'alternates')
+        objects_dir = os.path.join(os.path.realpath(object_store), 'objects')
+        if objects_dir in get_git_alternates(git_dir):
+            return False
+        fileutils.mkdir_with_parents(os.path.dirname(alternates))
+        fp = open(alternates, 'a')
+        fp.write(objects_dir + '\n')
+        fp.close()
+        return True
 
     def _checkout(self, buildscript, copydir=None):
 
@@ -404,10 +913,37 @@ class GitBranch(Branch):
 
         if self.config.shallow_clone:
             extra_opts.append('--depth=1')
+        elif self.config.single_branch_clone:
+            extra_opts.append('--single-branch')
 
         self.update_dvcs_mirror(buildscript)
 
-        cmd = ['git', 'clone'] + extra_opts + [self.module]
+        module = self.module
+        partial_filter = None
+        if self.unmirrored_module and os.path.exists(self.module):
+            partial_filter = self.get_repository_filter(self.module)
+            if (partial_filter and
+                    not self.check_version_git(partial_mirror_git_version)):
+                logging.warning(_('%(mirror)s is a partial mirror, which '
+                        'needs at least git-%(version)s, cloning from '
+                        '%(module)s') % {'mirror': self.module,
+                                         'version': partial_mirror_git_version,
+                                         'module': self.unmirrored_module})
+                module = self.unmirrored_module
+                partial_filter = None
+            elif partial_filter:
+                # git only filters when cloning through a transport
+                module = 'file://' + os.path.abspath(self.module)
+                extra_opts.append('--no-checkout')
+            elif self.config.dvcs_mirror_alternates:
+                # borrow the objects of the mirror rather than copying them
+                extra_opts.extend(['--reference', self.module])
+        else:
+            partial_filter = self.get_partial_clone_filter()
+        if partial_filter:
+            extra_opts.append('--filter=%s' % partial_filter)
+
+        cmd = ['git', 'clone'] + extra_opts + [module]
         if self.checkoutdir:
             cmd.append(self.checkoutdir)
 
@@ -415,27 +951,56 @@ class GitBranch(Branch):
             cmd.extend(['-b', self.branch])
 
         if copydir:
-            buildscript.execute(cmd, cwd=copydir, extra_env=get_git_extra_env())
+            self.execute_git(buildscript, cmd, cwd=copydir, extra_env=get_git_extra_env())
         else:
-            buildscript.execute(cmd, cwd=self.config.checkoutroot,
+            self.execute_git(buildscript, cmd, cwd=self.config.checkoutroot,
                     extra_env=get_git_extra_env())
 
+        if partial_filter and module != self.module:
+            self.set_upstream_promisor(buildscript, partial_filter)
+
         self._update(buildscript, copydir=copydir, update_mirror=False)
 
+    def set_upstream_promisor(self, buildscript, partial_filter):
+        """Fetch the objects left out of a partial mirror from upstream.
+
+        The mirror cannot hand out objects it does not have itself, so the
+        checkout falls back to an 'upstream' remote when origin, the mirror,
+        fails to provide them.
+        """
+        git_extra_args = {'cwd': self.get_checkoutdir(),
+                'extra_env': get_git_extra_env()}
+        for key, value in [
+                ('remote.upstream.url', self.unmirrored_module),
+                ('remote.upstream.promisor', 'true'),
+                ('remote.upstream.partialclonefilter', partial_filter)]:
+            self.execute_git(buildscript, ['git', 'config', key, value],
+                    **git_extra_args)
+        cmd = ['git', 'checkout', '-f']
+        if self.config.quiet_mode:
+            cmd.append('-q')
+        self.execute_git(buildscript, cmd, **git_extra_args)
+
 
     def _update(self, buildscript, copydir=None, update_mirror=True):
         cwd = self.get_checkoutdir()
         git_extra_args = {'cwd': cwd, 'extra_env': get_git_extra_env()}
 
+        if self.remote_head_unchanged:
+            self.remote_head_unchanged = False
+            logging.info(_('%s is up to date with upstream, not updating') %
+                         self.get_module_basename())
+            return
+
         if not os.path.exists(os.path.join(cwd, '.git')):
             if os.path.exists(os.path.join(cwd, '.svn')):
                 raise CommandError(_('Failed to update module as it switched to git (you should check for changes then remove the directory).'))
             raise CommandError(_('Failed to update module (missing .git) (you should check for changes then remove the directory).'))
 
-        buildscript.execute(['git', 'remote', 'set-url', 'origin',
+        self.execute_git(buildscript, ['git', 'remote', 'set-url', 'origin',
                 self.module], **git_extra_args)
 
-        buildscript.execute(['git', 'remote', 'update', 'origin'],
+        self.execute_git(buildscript, ['git', 'remote', 'update', 'origin'],
                 **git_extra_args)
 
         if update_mirror:
@@ -458,15 +1023,28 @@ class GitBranch(Branch):
     def checkout(self, buildscript):
         if not inpath('git', os.environ['PATH'].split(os.pathsep)):
             raise CommandError(_('%s not found') % 'git')
-        Branch.checkout(self, buildscript)
+        # the checkout may have been changed behind our back
+        self._state = None
+        try:
+            Branch.checkout(self, buildscript)
+        finally:
+            self._state = None
 
     def delete_unknown_files(self, buildscript):
         git_extra_args = {'cwd': self.get_checkoutdir(), 'extra_env': get_git_extra_env()}
-        buildscript.execute(['git', 'clean', '-d', '-f', '-x'], **git_extra_args)
+        self.execute_git(buildscript, ['git', 'clean', '-d', '-f', '-x'], **git_extra_args)
 
+    @cached_tree_id
     def tree_id(self):
         if not os.path.exists(self.get_checkoutdir()):
             return None
+        state = self.get_state()
+        if state is not None:
+            if not state['oid']:
+                return None
+            if state['dirty']:
+                return state['oid'] + self.dirty_branch_suffix
+            return state['oid']
         try:
             output = get_output(['git', 'rev-parse', 'HEAD'],
                     cwd = self.get_checkoutdir(), get_stderr=False,
@@ -480,6 +1058,11 @@ class GitBranch(Branch):
             id_suffix = self.dirty_branch_suffix
         return output.strip() + id_suffix
 
+    def invalidate_tree_id(self):
+        Branch.invalidate_tree_id(self)
+        # the snapshot the tree id comes from is outdated as well
+        self._state = None
+
     def to_sxml(self):
         attrs = {}
         if self.branch:
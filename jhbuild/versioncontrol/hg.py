@@ -27,7 +27,8 @@ import urlparse
 from subprocess import Popen, PIPE
 
 from jhbuild.errors import FatalError, CommandError
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 
 class HgRepository(Repository):
@@ -115,6 +116,7 @@ class HgBranch(Branch):
             raise CommandError(str(e))
         return hg.stdout.read().strip()
 
+    @cached_tree_id
     def tree_id(self):
         if not os.path.exists(self.srcdir):
             return None
@@ -25,7 +25,8 @@ import os
 
 from jhbuild.errors import CommandError, FatalError
 from jhbuild.utils.cmds import get_output
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 
 class MonotoneRepository(Repository):
@@ -141,6 +142,8 @@ class MonotoneBranch(Branch):
         if not inpath('mtn', os.environ['PATH'].split(os.pathsep)):
             raise CommandError(_('%s not found') % 'mtn')
 
+        self.invalidate_tree_id()
+
         if not os.path.exists(self.repository.database):
             self._init(buildscript)
 
@@ -157,6 +160,7 @@ class MonotoneBranch(Branch):
         else:
             self._checkout(buildscript)
 
+    @cached_tree_id
     def tree_id(self):
         try:
             output = get_output(['mtn', 'automate', 'get_base_revision_id'],
@@ -25,8 +25,9 @@ import urlparse
 import subprocess
 
 from jhbuild.errors import CommandError, BuildStateError
-from jhbuild.utils.cmds import get_output, check_version
-from jhbuild.versioncontrol import Repository, Branch, register_repo_type
+from jhbuild.utils.cmds import get_output, get_environ, check_version
+from jhbuild.versioncontrol import Repository, Branch, register_repo_type, \
+        cached_tree_id
 from jhbuild.commands.sanitycheck import inpath
 from jhbuild.utils.sxml import sxml
 
@@ -300,9 +301,7 @@ class SubversionBranch(Branch):
     def _check_for_conflicts(self):
         kws = {}
         kws['cwd'] = self.srcdir
-        kws['env'] = os.environ.copy()
-        extra_env = get_svn_extra_env()
-        kws['env'].update(extra_env)
+        kws['env'] = get_environ(get_svn_extra_env())
         try:
             output = subprocess.Popen(['svn', 'info', '-R'],
                     stdout = subprocess.PIPE, **kws).communicate()[0]
@@ -316,6 +315,7 @@ class SubversionBranch(Branch):
             raise CommandError(_('%s not found') % 'svn')
         Branch.checkout(self, buildscript)
 
+    @cached_tree_id
     def tree_id(self):
         if not os.path.exists(self.srcdir):
             return None
@@ -37,6 +37,12 @@ class Config(jhbuild.config.Config):
     build_policy = 'all'
 
     nonetwork = False
+    check_remote_heads = False
+    defer_triggers = False
+    build_events_file = None
+    trace_file = None
+    resource_summary = 0
+    serve_port = None
     nobuild = False
     makeclean = False
     makecheck = False
@@ -108,6 +114,7 @@ class PackageDB:
 
 class BuildScript(jhbuild.frontends.buildscript.BuildScript):
     execute_is_failure = False
+    command_rusage = None
 
     def __init__(self, config, module_list, moduleset):
         self.config = config
@@ -115,13 +122,19 @@ class BuildScript(jhbuild.frontends.buildscript.BuildScript):
         self.moduleset = moduleset
         self.packagedb = moduleset.packagedb
         self.actions = []
+        self._triggers = {}
+        self._deferred_triggers = []
+        self.observers = []
     
     def set_action(self, action, module, module_num=-1, action_target=None):
         self.actions.append('%s:%s' % (module.name, action))
 
     def execute(self, command, hint=None, cwd=None, extra_env=None):
+        self.notify_observers('start_command', command, cwd)
         if self.execute_is_failure:
+            self.notify_observers('end_command', 1, self.command_rusage, 0)
             raise jhbuild.errors.CommandError('Mock command asked to fail')
+        self.notify_observers('end_command', 0, self.command_rusage, 0)
 
     def message(self, msg, module_num = -1):
         pass
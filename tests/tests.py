@@ -23,10 +23,17 @@
 import os
 import shutil
 import logging
+import StringIO
+import json
+import errno
+import socket
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import unittest
+import urllib2
 
 import __builtin__
 __builtin__.__dict__['_'] = lambda x: x
@@ -40,6 +47,7 @@ sys.path.insert(0, SRCDIR)
 
 # Override jhbuild.utils.systeminstall with this module 'tests'
 import jhbuild.utils.systeminstall
+real_systeminstall = jhbuild.utils.systeminstall
 sys.modules['jhbuild.utils.systeminstall'] = sys.modules[__name__]
 sys.modules['jhbuild.utils'].systeminstall = sys.modules[__name__]
 
@@ -47,10 +55,13 @@ from jhbuild.errors import UsageError, CommandError
 from jhbuild.modtypes import Package
 from jhbuild.modtypes.autotools import AutogenModule
 from jhbuild.modtypes.distutils import DistutilsModule
+import jhbuild.commands
 import jhbuild.config
 import jhbuild.frontends.terminal
 import jhbuild.moduleset
 import jhbuild.utils.cmds
+import jhbuild.utils.fileutils
+import jhbuild.utils.trigger
 import jhbuild.versioncontrol.tarball
 
 def uencode(s):
@@ -571,6 +582,157 @@ class TwoModulesTestCase(BuildTestCase):
                  'bar:Building', 'bar:Checking', 'bar:Installing'])
 
 
+class BuildEventsTestCase(BuildTestCase):
+    '''Build observers'''
+
+    def setUp(self):
+        super(BuildEventsTestCase, self).setUp()
+        self.foo_branch = mock.Branch(os.path.join(self.config.buildroot, 'nonexistent-foo'))
+        self.modules = [mock.MockModule('foo', branch=self.foo_branch),
+                        mock.MockModule('bar', branch=self.branch)]
+        self.modules[1].dependencies = ['foo']
+        self.failing_module = None
+        for module in self.modules:
+            module.config = self.config
+            module.do_build = self.make_build_phase(module)
+        self.temp_dir = self.make_temp_dir()
+
+    def make_build_phase(self, module):
+        do_build = module.do_build
+        def build_phase(buildscript):
+            do_build(buildscript)
+            # neither the command line nor the error are UTF-8
+            buildscript.execute(['make', 'NAME=\xe9'], cwd='/src/%s' % module.name)
+            if module.name == self.failing_module:
+                raise CommandError('make: *** \xff Error 1')
+        build_phase.depends = do_build.depends
+        build_phase.error_phases = do_build.error_phases
+        return build_phase
+
+    def build_with_observers(self, observers, **kwargs):
+        self.config.build_targets = ['install']
+        for k in kwargs:
+            setattr(self.config, k, kwargs[k])
+        self.packagedb = mock.PackageDB()
+        self.moduleset = jhbuild.moduleset.ModuleSet(self.config, db=self.packagedb)
+        self.buildscript = mock.BuildScript(self.config, self.modules, self.moduleset)
+        self.triggered = []
+        self.buildscript.run_triggers = self.triggered.append
+        for observer in observers:
+            self.buildscript.add_observer(observer)
+        return self.buildscript.build()
+
+    def test_event_stream(self):
+        '''Writing the build events'''
+        from jhbuild.utils import buildevents
+        filename = os.path.join(self.temp_dir, 'events.json')
+        self.failing_module = 'bar'
+        self.assertEqual(self.build_with_observers(
+                [buildevents.EventStream(filename)], exit_on_error=False), 1)
+        events = [json.loads(x) for x in file(filename)]
+        self.assertEqual([(x['event'], x.get('module'), x.get('phase'))
+                          for x in events
+                          if x['event'] != 'start_command' and
+                             x['event'] != 'end_command'][:3],
+                         [('start_build', None, None),
+                          ('start_module', 'foo', None),
+                          ('start_phase', 'foo', 'checkout')])
+        commands = [x for x in events if x['event'] == 'start_command']
+        self.assertEqual([(x['module'], x['command'], x['cwd'])
+                          for x in commands],
+                         [('foo', ['make', u'NAME=\ufffd'], '/src/foo'),
+                          ('bar', ['make', u'NAME=\ufffd'], '/src/bar')])
+        errors = [x['error'] for x in events
+                  if x['event'] == 'end_phase' and x['error']]
+        self.assertEqual(errors, [u'make: *** \ufffd Error 1'])
+        self.assertEqual(events[-1]['event'], 'end_build')
+        self.assertEqual(events[-1]['failures'], ['bar'])
+
+    def test_trace_file_exit_on_error(self):
+        '''Writing the trace of a build exiting on an error'''
+        from jhbuild.utils import buildevents
+        filename = os.path.join(self.temp_dir, 'trace.json')
+        self.failing_module = 'bar'
+        self.assertRaises(SystemExit, self.build_with_observers,
+                          [buildevents.TraceFile(filename)],
+                          exit_on_error=True, defer_triggers=True)
+        self.assertEqual(self.triggered, [['foo']])
+        trace = json.load(file(filename))
+        spans = dict([((x['cat'], x['name'], x['args'].get('module')), x)
+                      for x in trace['traceEvents'] if x['ph'] == 'X'])
+        self.assertEqual(spans[('build', 'build', None)]['args'],
+                         {'failures': ['bar']})
+        self.assertEqual(spans[('module', 'bar', None)]['args'],
+                         {'failed': True})
+        self.assertEqual(spans[('phase', 'build', 'bar')]['args']['error'],
+                         u'make: *** \ufffd Error 1')
+        self.assertEqual(spans[('command', 'make', None)]['args']['argv'],
+                         ['make', u'NAME=\ufffd'])
+        self.assertEqual(len([x for x in trace['traceEvents']
+                              if x.get('cat') == 'command']), 2)
+
+    def test_trace_file_interrupted(self):
+        '''Writing the trace of an interrupted build'''
+        from jhbuild.utils import buildevents
+        filename = os.path.join(self.temp_dir, 'trace.json')
+        def interrupt(buildscript):
+            raise KeyboardInterrupt()
+        self.modules[1].do_install = interrupt
+        self.assertRaises(KeyboardInterrupt, self.build_with_observers,
+                          [buildevents.TraceFile(filename)],
+                          exit_on_error=False)
+        trace = json.load(file(filename))
+        self.assertEqual(sorted([(x['cat'], x['name'])
+                                 for x in trace['traceEvents']
+                                 if x['ph'] == 'X' and x['cat'] != 'command'
+                                    and x['cat'] != 'phase']),
+                         [('build', 'build'), ('module', 'bar'),
+                          ('module', 'foo')])
+
+    def test_failing_observer(self):
+        '''Detaching an observer that fails'''
+        from jhbuild.utils import buildevents
+        class FullDisk(buildevents.BuildObserver):
+            calls = 0
+            def start_module(self, module):
+                self.calls += 1
+                raise IOError(errno.ENOSPC, 'No space left on device')
+        failing = FullDisk()
+        summary = buildevents.ResourceSummary()
+        self.assertEqual(self.build_with_observers(
+                [failing, summary], exit_on_error=False), 0)
+        self.assertEqual(failing.calls, 1)
+        self.assertEqual(self.buildscript.observers, [summary])
+        # the other observers are still notified
+        self.assertEqual(len(summary.commands), 2)
+
+    def test_resource_summary(self):
+        '''Summarising the resource usage'''
+        from jhbuild.utils import buildevents
+        class rusage:
+            ru_utime = 1.5
+            ru_stime = 0.5
+            ru_maxrss = 2048
+            ru_inblock = 10
+            ru_oublock = 20
+        summary = buildevents.ResourceSummary()
+        mock.BuildScript.command_rusage = rusage
+        try:
+            self.assertEqual(self.build_with_observers(
+                    [summary], exit_on_error=False), 0)
+        finally:
+            mock.BuildScript.command_rusage = None
+        self.assertEqual(sorted([x.name for x in summary.commands]),
+                         ['bar: make NAME=\xe9', 'foo: make NAME=\xe9'])
+        self.assertEqual([(x.utime, x.stime, x.maxrss, x.inblock, x.oublock)
+                          for x in summary.modules.values()],
+                         [(1.5, 0.5, 2048, 10, 20)] * 2)
+        lines = summary.get_summary(1)
+        self.assertEqual(lines[0], 'Longest commands:')
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(lines[2].split()[1:5], ['1.5', '0.5', '2', '10'])
+
+
 class SimpleBranch(object):
 
     def __init__(self, name, dir_path):
@@ -586,6 +748,9 @@ class SimpleBranch(object):
     def tree_id(self):
         return 'made-up-tree-id'
 
+    def invalidate_tree_id(self):
+        pass
+
 
 def restore_environ(env):
     # os.environ.clear() doesn't appear to change underlying environment.
@@ -678,6 +843,1144 @@ class UtilsTest(JhbuildConfigTestCase):
         self.assertTrue(jhbuild.utils.cmds.compare_version('2', '1.2.3.4'))
         self.assertFalse(jhbuild.utils.cmds.compare_version('1.2.3.4', '2'))
 
+    def test_output_splitter(self):
+        splitter = jhbuild.utils.cmds.OutputSplitter()
+        self.assertEqual(splitter.feed('foo'), [])
+        self.assertEqual(splitter.feed('bar\nbaz\n\nqu'),
+                         ['foobar\n', 'baz\n', '\n'])
+        self.assertEqual(splitter.feed('x\r'), [])
+        self.assertEqual(splitter.feed('\n'), ['qux\r\n'])
+        self.assertEqual(splitter.feed('end'), [])
+        self.assertEqual(splitter.flush(), ['end'])
+        self.assertEqual(splitter.flush(), [])
+
+    def test_get_environ(self):
+        os.environ['JHBUILD_TEST'] = 'foo'
+        env = jhbuild.utils.cmds.get_environ({'JHBUILD_TEST_EXTRA': 'bar'})
+        self.assertEqual(env['JHBUILD_TEST'], 'foo')
+        self.assertEqual(env['JHBUILD_TEST_EXTRA'], 'bar')
+        self.assertTrue(
+                jhbuild.utils.cmds.get_environ({'JHBUILD_TEST_EXTRA': 'bar'})
+                is env)
+        self.assertRaises(TypeError, env.update, {'JHBUILD_TEST': 'baz'})
+        os.environ['JHBUILD_TEST'] = 'baz'
+        env = jhbuild.utils.cmds.get_environ({'JHBUILD_TEST_EXTRA': 'bar'})
+        self.assertEqual(env['JHBUILD_TEST'], 'baz')
+
+    def test_trigger_matcher(self):
+        temp_dir = self.make_temp_dir()
+        for name, keys in [('schemas', '# REMatch: ^share/glib-2.0/schemas/'),
+                           ('icons', '# REMatch: ^share/icons/\n'
+                                     '# LiteralMatch: /pixmaps/'),
+                           ('grouped', '# REMatch: ^share/(info|man)/'),
+                           ('missing', '# IfExecutable: jhbuild-no-such-cmd\n'
+                                       '# REMatch: ^share/')]:
+            file(os.path.join(temp_dir, name + '.trigger'), 'w').write(
+                    keys + '\n')
+        matcher = jhbuild.utils.trigger.TriggerMatcher(
+                jhbuild.utils.trigger.load_all(temp_dir))
+        def matches(files_list):
+            return sorted([x.name for x in matcher.matches(files_list)])
+        self.assertEqual(matches([]), [])
+        self.assertEqual(matches(['bin/foo']), [])
+        self.assertEqual(matches(['share/icons/a.png', 'bin/foo']), ['icons'])
+        self.assertEqual(matches(['share/glib-2.0/schemas/a.xml',
+                                  'share/man/foo.1', 'usr/pixmaps/a.png']),
+                         ['grouped', 'icons', 'schemas'])
+
+    def test_logstore(self):
+        import gzip
+        import zlib
+        import jhbuild.utils.logstore
+        temp_dir = self.make_temp_dir()
+        filename = os.path.join(temp_dir, 'foo.html.gz')
+        index_filename = os.path.join(temp_dir, 'foo.idx')
+        def read_index():
+            return [(x['name'], x['filename'], x['lines'], x['commands'])
+                    for x in json.load(file(index_filename))['sections']]
+        def read_partial(name):
+            data = file(os.path.join(temp_dir, name), 'rb').read()
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+        log = jhbuild.utils.logstore.LogStore(filename, index_filename)
+        log.write('<html>\n')
+        log.start_section('configure', os.path.join(temp_dir, 'foo-1.gz'))
+        log.mark_command('./configure')
+        log.write('checking for foo... yes\n' * 100)
+        log.end_section()
+        # the finished sections are indexed while the build goes on
+        self.assertEqual(read_index(),
+                         [(None, 'foo.html.gz', 1, []),
+                          ('configure', 'foo-1.gz', 100, [['./configure', 0]])])
+        log.start_section('build', os.path.join(temp_dir, 'foo-2.gz'))
+        log.mark_command('make')
+        log.write('gcc -c foo.c\n')
+        log.flush()
+        # what was written before a flush can be read at once
+        self.assertEqual(read_partial('foo-2.gz'), 'gcc -c foo.c\n')
+        log.mark_command('make install')
+        log.write('install foo\n')
+        log.end_section()
+        log.write('</html>\n')
+        log.close()
+        log.close()
+
+        self.assertEqual(gzip.open(filename).read(), '<html>\n</html>\n')
+        self.assertEqual(gzip.open(os.path.join(temp_dir, 'foo-1.gz')).read(),
+                         'checking for foo... yes\n' * 100)
+        self.assertEqual(gzip.open(os.path.join(temp_dir, 'foo-2.gz')).read(),
+                         'gcc -c foo.c\ninstall foo\n')
+        self.assertEqual(read_index(),
+                         [(None, 'foo.html.gz', 2, []),
+                          ('configure', 'foo-1.gz', 100, [['./configure', 0]]),
+                          ('build', 'foo-2.gz', 2, [['make', 0],
+                                                    ['make install', 1]])])
+
+class SystemInstallTest(JhbuildConfigTestCase):
+
+    def test_parse_pkgconfig_version(self):
+        temp_dir = self.make_temp_dir()
+        filename = os.path.join(temp_dir, 'foo.pc')
+        for data, version in [
+                ('Name: foo\nVersion: 1.2\n', '1.2'),
+                ('major=1\nminor=2 # not 3\nVersion: ${major}.${minor}\n',
+                 '1.2'),
+                ('# Version: 0.1\nVersion: 1.2 # 0.2\n', '1.2'),
+                ('Description: a long \\\n  description\nVersion: 1.2\n',
+                 '1.2'),
+                ('Description: a long \\\r\nVersion: 1.2\nVersion: 1.3\n',
+                 '1.3'),
+                ('base=1\\\n.2\nVersion: ${base}\\#3\n', '1.2#3'),
+                ('# a comment \\\nVersion: 1.2\n', '1.2'),
+                ('Name: foo\n', '')]:
+            file(filename, 'w').write(data)
+            self.assertEqual(real_systeminstall.parse_pkgconfig_version(
+                    filename), version, data)
+        self.assertEqual(real_systeminstall.parse_pkgconfig_version(
+                os.path.join(temp_dir, 'missing.pc')), None)
+
+    def test_scan_pkgconfig_dir(self):
+        temp_dir = self.make_temp_dir()
+        file(os.path.join(temp_dir, 'foo.pc'), 'w').write('Version: 1.0\n')
+        file(os.path.join(temp_dir, 'foo-uninstalled.pc'), 'w').write(
+                'Version: 2.0\n')
+        file(os.path.join(temp_dir, 'bar.txt'), 'w').write('Version: 2.0\n')
+        cache = {'dirs': {}}
+        scan = real_systeminstall._scan_pkgconfig_dir
+        self.assertEqual(scan(temp_dir, cache), {'foo': '1.0'})
+        self.assertTrue(cache.pop('modified'))
+        self.assertEqual(scan(temp_dir, cache), {'foo': '1.0'})
+        self.assertFalse('modified' in cache)
+        # edited in place, the directory does not change
+        dir_mtime = os.stat(temp_dir).st_mtime
+        file(os.path.join(temp_dir, 'foo.pc'), 'w').write('Version: 1.1\n')
+        os.utime(os.path.join(temp_dir, 'foo.pc'), (0, 0))
+        os.utime(temp_dir, (dir_mtime, dir_mtime))
+        self.assertEqual(scan(temp_dir, cache), {'foo': '1.1'})
+        self.assertEqual(scan(os.path.join(temp_dir, 'missing'), cache), {})
+
+    def test_dependency_resolver(self):
+        temp_dir = self.make_temp_dir()
+        for dirname in ('bin', 'include/foo'):
+            os.makedirs(os.path.join(temp_dir, dirname))
+        file(os.path.join(temp_dir, 'bin', 'foo-tool'), 'w').write('')
+        os.chmod(os.path.join(temp_dir, 'bin', 'foo-tool'), 0755)
+        file(os.path.join(temp_dir, 'bin', 'not-executable'), 'w').write('')
+        file(os.path.join(temp_dir, 'include', 'foo', 'foo.h'), 'w').write('')
+        os.environ['PATH'] = os.path.join(temp_dir, 'bin')
+        os.environ['CPPFLAGS'] = ''
+        for key in ('CFLAGS', 'CXXFLAGS', 'C_INCLUDE_PATH',
+                    'CPLUS_INCLUDE_PATH'):
+            os.environ.pop(key, None)
+        class config:
+            xdg_cache_home = temp_dir
+            makeargs = ''
+            module_autogenargs = {
+                'bar': '--enable-foo -I %s' % os.path.join(temp_dir, 'include')}
+            module_makeargs = {}
+        resolver = real_systeminstall.SystemDependencyResolver(config)
+        self.assertEqual(resolver.check_modules([
+                    ('foo', [('path', 'foo-tool'), ('python2', 'os')]),
+                    ('bar', [('c_include', 'foo/foo.h')]),
+                    ('baz', [('c_include', 'foo/foo.h')]),
+                    ('qux', [('path', 'not-executable')]),
+                    ('quux', [('python2', 'jhbuild_no_such_module')]),
+                    ('corge', [])]),
+                {'foo': True, 'bar': True, 'baz': False, 'qux': False,
+                 'quux': False, 'corge': True})
+        self.assertEqual(real_systeminstall.extract_path_from_cflags(
+                    '-O2 -I/a -I "/b" -isystem /d:/e'),
+                ['/a', '/b', '/d', '/e'])
+
+    def test_resolve_xml(self):
+        temp_dir = self.make_temp_dir()
+        bin_dir = os.path.join(temp_dir, 'bin')
+        os.makedirs(bin_dir)
+        log_filename = os.path.join(temp_dir, 'xmlcatalog.log')
+        filename = os.path.join(bin_dir, 'xmlcatalog')
+        file(filename, 'w').write(
+                '#! /bin/sh\n'
+                'shift\n'
+                'rc=0\n'
+                'for id in "$@"; do\n'
+                '  echo "$id" >> %s\n'
+                '  case "$id" in\n'
+                '    *missing*) echo "No entry for PUBLIC $id"; rc=4;;\n'
+                '    *) echo "file:///usr/share/xml/foo.dtd";;\n'
+                '  esac\n'
+                'done\n'
+                'echo >> %s\n'
+                'exit $rc\n' % (log_filename, log_filename))
+        os.chmod(filename, 0755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.makedirs(os.path.join(temp_dir, 'xml'))
+        catalog = os.path.join(temp_dir, 'xml', 'catalog')
+        file(catalog, 'w').write('')
+        class config:
+            xdg_cache_home = temp_dir
+        def check_modules():
+            resolver = real_systeminstall.SystemDependencyResolver(config)
+            resolver.get_xml_catalog = lambda: catalog
+            return resolver.check_modules([
+                    ('foo', [('xml', '-//FOO//DTD Foo V1//EN')]),
+                    ('bar', [('xml', 'http://example.com/bar.xsl'),
+                             ('xml', '-//FOO//DTD Foo V1//EN')]),
+                    ('baz', [('xml', '-//missing//DTD//EN')])])
+        def get_runs():
+            if not os.path.exists(log_filename):
+                return []
+            return file(log_filename).read().split('\n\n')[:-1]
+
+        expected = {'foo': True, 'bar': True, 'baz': False}
+        self.assertEqual(check_modules(), expected)
+        # a single xmlcatalog run, for the distinct identifiers
+        self.assertEqual(get_runs(), ['-//FOO//DTD Foo V1//EN\n'
+                                      'http://example.com/bar.xsl\n'
+                                      '-//missing//DTD//EN'])
+        # then the results come from the cache, until the catalog changes
+        self.assertEqual(check_modules(), expected)
+        self.assertEqual(len(get_runs()), 1)
+        os.utime(catalog, (0, 0))
+        self.assertEqual(check_modules(), expected)
+        self.assertEqual(len(get_runs()), 2)
+
+    def test_apt_file_providers(self):
+        temp_dir = self.make_temp_dir()
+        bin_dir = os.path.join(temp_dir, 'bin')
+        os.makedirs(bin_dir)
+        log_filename = os.path.join(temp_dir, 'apt-file.log')
+        for name, script in [
+                ('sudo', 'exec "$@"\n'),
+                ('apt-file',
+                 'if [ -n "$APT_FILE_ERROR" ]; then\n'
+                 '  echo "E: The cache is empty." >&2\n'
+                 '  exit 255\n'
+                 'fi\n'
+                 'cat >> %s\n'
+                 'echo "lsb-foo: /usr/lib/lsb3/pkgconfig/foo.pc"\n'
+                 'echo "libfoo-dev: /usr/lib/pkgconfig/foo.pc"\n'
+                 'echo "bar: /usr/bin/bar"\n' % log_filename)]:
+            filename = os.path.join(bin_dir, name)
+            file(filename, 'w').write('#! /bin/sh\n' + script)
+            os.chmod(filename, 0755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        class config:
+            xdg_cache_home = temp_dir
+        installer = real_systeminstall.AptSystemInstall(config)
+        installer.index_dirs = [os.path.join(temp_dir, 'lists')]
+        os.makedirs(installer.index_dirs[0])
+        def get_searches():
+            if not os.path.exists(log_filename):
+                return []
+            searches = file(log_filename).read().split()
+            os.remove(log_filename)
+            return searches
+
+        os.environ['APT_FILE_ERROR'] = '1'
+        self.assertEqual(installer._get_packages_for(['/foo.pc']),
+                         {'/foo.pc': None})
+        del os.environ['APT_FILE_ERROR']
+        self.assertEqual(installer._get_packages_for(['/foo.pc', '/baz.pc']),
+                         {'/foo.pc': 'libfoo-dev', '/baz.pc': None})
+        self.assertEqual(get_searches(), ['/foo.pc', '/baz.pc'])
+        self.assertEqual(installer._get_packages_for(['/baz.pc', '/bin/bar']),
+                         {'/baz.pc': None, '/bin/bar': 'bar'})
+        self.assertEqual(get_searches(), ['/bin/bar'])
+        self.assertEqual(installer._get_packages_for(['/foo.pc']),
+                         {'/foo.pc': 'libfoo-dev'})
+        self.assertEqual(get_searches(), [])
+
+        # the providers are searched again once the index is updated
+        os.utime(installer.index_dirs[0], (0, 0))
+        self.assertEqual(installer._get_packages_for(['/foo.pc']),
+                         {'/foo.pc': 'libfoo-dev'})
+        self.assertEqual(get_searches(), ['/foo.pc'])
+
+class FileUtilsTest(JhbuildConfigTestCase):
+
+    def test_sync_tree(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'src')
+        dest_dir = os.path.join(temp_dir, 'dest')
+        os.makedirs(os.path.join(src_dir, 'sub'))
+        file(os.path.join(src_dir, 'a'), 'w').write('a')
+        file(os.path.join(src_dir, 'sub', 'b'), 'w').write('b')
+        os.symlink('a', os.path.join(src_dir, 'link'))
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        self.assertEqual(file(os.path.join(dest_dir, 'sub', 'b')).read(), 'b')
+        self.assertEqual(os.readlink(os.path.join(dest_dir, 'link')), 'a')
+
+        # build products and removed files go away, changed files come back
+        file(os.path.join(dest_dir, 'sub', 'b.o'), 'w').write('')
+        os.unlink(os.path.join(src_dir, 'a'))
+        file(os.path.join(src_dir, 'sub', 'b'), 'w').write('bb')
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        self.assertEqual(sorted(os.listdir(dest_dir)), ['link', 'sub'])
+        self.assertEqual(os.listdir(os.path.join(dest_dir, 'sub')), ['b'])
+        self.assertEqual(file(os.path.join(dest_dir, 'sub', 'b')).read(), 'bb')
+
+        # a same-size change within the same second is copied, while the
+        # unchanged copies are kept
+        b_path = os.path.join(src_dir, 'sub', 'b')
+        dest_b_path = os.path.join(dest_dir, 'sub', 'b')
+        os.utime(b_path, (1000000000.25, 1000000000.25))
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        dest_b_stat = os.stat(dest_b_path)
+        file(dest_b_path, 'w').write('xx')
+        os.utime(dest_b_path, (dest_b_stat.st_atime, dest_b_stat.st_mtime))
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        self.assertEqual(file(dest_b_path).read(), 'xx')
+        file(b_path, 'w').write('cc')
+        os.utime(b_path, (1000000000.5, 1000000000.5))
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        self.assertEqual(file(dest_b_path).read(), 'cc')
+
+    def test_sync_tree_read_only(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'src')
+        dest_dir = os.path.join(temp_dir, 'dest')
+        os.makedirs(os.path.join(src_dir, 'ro'))
+        file(os.path.join(src_dir, 'ro', 'a'), 'w').write('a')
+        os.chmod(os.path.join(src_dir, 'ro', 'a'), 0444)
+        os.chmod(os.path.join(src_dir, 'ro'), 0555)
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        # read-only files are copied, not linked to the source
+        self.assertNotEqual(os.stat(os.path.join(src_dir, 'ro', 'a')).st_ino,
+                            os.stat(os.path.join(dest_dir, 'ro', 'a')).st_ino)
+        self.assertEqual(
+                stat.S_IMODE(os.stat(os.path.join(dest_dir, 'ro')).st_mode),
+                0555)
+
+        os.chmod(os.path.join(src_dir, 'ro'), 0755)
+        file(os.path.join(src_dir, 'ro', 'b'), 'w').write('b')
+        os.chmod(os.path.join(src_dir, 'ro'), 0555)
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        self.assertEqual(sorted(os.listdir(os.path.join(dest_dir, 'ro'))),
+                         ['a', 'b'])
+
+        os.chmod(os.path.join(src_dir, 'ro'), 0755)
+        shutil.rmtree(os.path.join(src_dir, 'ro'))
+        jhbuild.utils.fileutils.sync_tree(src_dir, dest_dir)
+        self.assertEqual(os.listdir(dest_dir), [])
+
+    def test_sync_tree_clone_unsupported(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'src')
+        os.makedirs(src_dir)
+        for name in ('a', 'b'):
+            file(os.path.join(src_dir, name), 'w').write(name)
+        calls = []
+        class fcntl:
+            @staticmethod
+            def ioctl(fd, request, arg):
+                calls.append(request)
+                raise IOError(errno.EOPNOTSUPP, 'Operation not supported')
+        old_fcntl = jhbuild.utils.fileutils.fcntl
+        jhbuild.utils.fileutils.fcntl = fcntl
+        jhbuild.utils.fileutils._clone_unsupported.clear()
+        try:
+            jhbuild.utils.fileutils.sync_tree(src_dir,
+                                              os.path.join(temp_dir, 'dest'))
+        finally:
+            jhbuild.utils.fileutils.fcntl = old_fcntl
+            jhbuild.utils.fileutils._clone_unsupported.clear()
+        # the failure is remembered for the devices
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(temp_dir, 'dest'))),
+                         ['a', 'b'])
+
+    def test_remove_tree_async(self):
+        temp_dir = self.make_temp_dir()
+        trash_dir = os.path.join(temp_dir, 'trash')
+        tree = os.path.join(temp_dir, 'tree')
+        os.makedirs(os.path.join(tree, 'sub'))
+        file(os.path.join(tree, 'sub', 'a'), 'w').write('a')
+        jhbuild.utils.fileutils.remove_tree_async(tree, trash_dir)
+        self.assertFalse(os.path.exists(tree))
+        jhbuild.utils.fileutils.wait_for_removals()
+        self.assertEqual(os.listdir(trash_dir), [])
+
+    def test_remove_tree_async_leftovers(self):
+        temp_dir = self.make_temp_dir()
+        parent_dir = os.path.join(temp_dir, 'checkout')
+        # left by an interrupted run, when the trash was on another device
+        os.makedirs(os.path.join(parent_dir, '.foo.trash.abc_12', 'foo'))
+        os.makedirs(os.path.join(parent_dir, 'bar'))
+        jhbuild.utils.fileutils.remove_tree_async(
+                os.path.join(parent_dir, 'bar'), os.path.join(temp_dir, 'trash'))
+        jhbuild.utils.fileutils.wait_for_removals()
+        self.assertEqual(os.listdir(parent_dir), [])
+
+    def test_remove_tree_async_error(self):
+        temp_dir = self.make_temp_dir()
+        tree = os.path.join(temp_dir, 'tree')
+        os.makedirs(tree)
+        def rmtree(path):
+            raise UnicodeDecodeError('ascii', '\xe9', 0, 1, 'not ascii')
+        old_rmtree = jhbuild.utils.fileutils.rmtree
+        jhbuild.utils.fileutils.rmtree = rmtree
+        try:
+            jhbuild.utils.fileutils.remove_tree_async(
+                    tree, os.path.join(temp_dir, 'trash'))
+            # the removal fails but is done
+            jhbuild.utils.fileutils.wait_for_removals()
+        finally:
+            jhbuild.utils.fileutils.rmtree = old_rmtree
+        # and the worker is still there for the next ones
+        tree = os.path.join(temp_dir, 'other')
+        os.makedirs(tree)
+        jhbuild.utils.fileutils.remove_tree_async(
+                tree, os.path.join(temp_dir, 'trash'))
+        jhbuild.utils.fileutils.wait_for_removals()
+        self.assertEqual([x for x in os.listdir(os.path.join(temp_dir, 'trash'))
+                          if not x.startswith('tree.')], [])
+
+class GitTestCase(JhbuildConfigTestCase):
+    '''Git branches, with local upstream repositories'''
+
+    def setUp(self):
+        super(GitTestCase, self).setUp()
+        self.config = self.make_config()
+        self.temp_dir = self.make_temp_dir()
+        for key in ('AUTHOR', 'COMMITTER'):
+            os.environ['GIT_%s_NAME' % key] = 'JHBuild'
+            os.environ['GIT_%s_EMAIL' % key] = 'jhbuild@example.com'
+
+    def git(self, cwd, *args):
+        return subprocess.Popen(('git',) + args, cwd=cwd,
+                                stdout=subprocess.PIPE).communicate()[0]
+
+    def commit(self, path, data):
+        file(os.path.join(path, 'README'), 'w').write(data)
+        self.git(path, 'add', 'README')
+        self.git(path, 'commit', '-q', '-m', data)
+
+    def make_upstream(self, name):
+        path = os.path.join(self.temp_dir, 'upstream', name)
+        os.makedirs(path)
+        self.git(path, 'init', '-q')
+        self.commit(path, 'first')
+        return path
+
+    def make_git_branch(self, upstream, **kwargs):
+        from jhbuild.versioncontrol.git import GitBranch
+        self.git(self.config.checkoutroot, 'clone', '-q', upstream)
+        repository = jhbuild.versioncontrol.Repository(self.config, 'git')
+        return GitBranch(repository, upstream, '', **kwargs)
+
+    def test_parse_status(self):
+        from jhbuild.versioncontrol.git import parse_status
+        self.assertEqual(parse_status(
+                '# branch.oid 0123456789abcdef0123456789abcdef01234567\n'
+                '# branch.head master\n'
+                '# branch.upstream origin/master\n'
+                '# branch.ab +0 -0\n'),
+                ('0123456789abcdef0123456789abcdef01234567', 'master', False))
+        self.assertEqual(parse_status(
+                '# branch.oid 0123456789abcdef0123456789abcdef01234567\n'
+                '# branch.head (detached)\n'
+                '1 .M N... 100644 100644 100644 '
+                '0123456789abcdef0123456789abcdef01234567 '
+                '0123456789abcdef0123456789abcdef01234567 README\n'),
+                ('0123456789abcdef0123456789abcdef01234567', None, True))
+        self.assertEqual(parse_status(
+                '# branch.oid (initial)\n# branch.head master\n'),
+                (None, 'master', False))
+
+    def test_tree_id_after_phase(self):
+        from jhbuild.modtypes import Package
+        branch = self.make_git_branch(self.make_upstream('foo'))
+        tree_id = branch.tree_id()
+        self.assertEqual(len(tree_id), 40)
+        module = Package('foo', branch=branch)
+        def do_build(buildscript):
+            # a build command changing a tracked file
+            file(os.path.join(branch.srcdir, 'README'), 'w').write('changed')
+        module.do_build = do_build
+        self.assertEqual(module.run_phase(None, 'build'), (None, None))
+        self.assertEqual(branch.tree_id(), tree_id + '-dirty')
+        self.assertTrue(branch.is_dirty())
+
+    def test_check_remote_heads(self):
+        from jhbuild.versioncontrol import git
+        foo_upstream = self.make_upstream('foo')
+        bar_upstream = self.make_upstream('bar')
+        foo = self.make_git_branch(foo_upstream)
+        bar = self.make_git_branch(bar_upstream)
+        self.commit(bar_upstream, 'second')
+        git.check_remote_heads([foo, bar, None])
+        self.assertTrue(foo.remote_head_unchanged)
+        self.assertFalse(bar.remote_head_unchanged)
+
+    def test_check_remote_heads_error(self):
+        from jhbuild.versioncontrol import git
+        foo = self.make_git_branch(self.make_upstream('foo'))
+        bar = self.make_git_branch(self.make_upstream('bar'))
+        old_get_output = git.get_output
+        def get_output(args, **kwargs):
+            if args[1] == 'ls-remote' and args[2].endswith('foo'):
+                raise OSError('ls-remote failed')
+            return old_get_output(args, **kwargs)
+        git.get_output = get_output
+        try:
+            git.check_remote_heads([foo, bar])
+        finally:
+            git.get_output = old_get_output
+        # foo is fetched, the other branches of the host are still checked
+        self.assertFalse(foo.remote_head_unchanged)
+        self.assertTrue(bar.remote_head_unchanged)
+
+    def test_partial_clone_filter(self):
+        from jhbuild.versioncontrol import git
+        upstream = self.make_upstream('foo')
+        self.git(upstream, 'config', 'uploadpack.allowFilter', 'true')
+        repository = jhbuild.versioncontrol.Repository(self.config, 'git')
+        def get_filter(module_name):
+            branch = git.GitBranch(repository, upstream, '',
+                                   module_name=module_name)
+            return branch.get_partial_clone_filter()
+        self.assertEqual(get_filter('foo'), None)
+        self.config.partial_clone = 'treeless'
+        self.config.module_partial_clone = {'bar': 'blobless'}
+        self.assertEqual(get_filter('foo'), 'tree:0')
+        self.assertEqual(get_filter('bar'), 'blob:none')
+
+        old_version_checks = git._git_version_checks.copy()
+        git._git_version_checks.update({'2.19': True, '2.20': False,
+                                        '2.25': False})
+        try:
+            # tree:0 came with git 2.20
+            self.assertEqual(get_filter('foo'), None)
+            self.assertEqual(get_filter('bar'), 'blob:none')
+            # partial mirrors need several promisor remotes
+            self.config.dvcs_mirror_dir = os.path.join(self.temp_dir, 'mirrors')
+            self.assertEqual(get_filter('bar'), None)
+            git._git_version_checks['2.25'] = True
+            self.assertEqual(get_filter('bar'), 'blob:none')
+        finally:
+            self.config.dvcs_mirror_dir = None
+            git._git_version_checks.clear()
+            git._git_version_checks.update(old_version_checks)
+
+        for name, object_filter in git.partial_clone_filters.items():
+            self.git(self.config.checkoutroot, 'clone', '-q',
+                     '--filter=%s' % object_filter, 'file://' + upstream, name)
+            branch = git.GitBranch(repository, upstream, '', checkoutdir=name)
+            self.assertEqual(branch.get_repository_filter(branch.srcdir),
+                             object_filter)
+
+    def test_partial_mirror_checkout(self):
+        from jhbuild.versioncontrol import git
+        upstream = self.make_upstream('foo')
+        self.git(upstream, 'config', 'uploadpack.allowFilter', 'true')
+        mirror_root = os.path.join(self.temp_dir, 'mirrors')
+        os.makedirs(mirror_root)
+        self.git(mirror_root, 'clone', '-q', '--mirror', '--filter=blob:none',
+                 'file://' + upstream, 'foo.git')
+        self.config.dvcs_mirror_dir = mirror_root
+        self.config.quiet_mode = False
+        self.config.nonetwork = True
+        repository = jhbuild.versioncontrol.Repository(self.config, 'git')
+        branch = git.GitBranch(repository, os.path.join(mirror_root, 'foo.git'),
+                               '', checkoutdir='foo', unmirrored_module=upstream)
+        branch._update = lambda buildscript, **kwargs: None
+        class buildscript:
+            def __init__(self):
+                self.commands = []
+            def execute(self, command, hint=None, cwd=None, extra_env=None):
+                self.commands.append(command)
+
+        old_version_checks = git._git_version_checks.copy()
+        git._git_version_checks['2.25'] = False
+        try:
+            # too old for the partial mirror, the checkout comes from upstream
+            script = buildscript()
+            branch._checkout(script)
+            self.assertEqual(script.commands, [['git', 'clone', upstream, 'foo']])
+
+            git._git_version_checks['2.25'] = True
+            script = buildscript()
+            branch._checkout(script)
+            self.assertEqual(script.commands[0],
+                    ['git', 'clone', '--no-checkout', '--filter=blob:none',
+                     'file://' + os.path.join(mirror_root, 'foo.git'), 'foo'])
+            self.assertTrue(['git', 'config', 'remote.upstream.promisor',
+                             'true'] in script.commands)
+        finally:
+            git._git_version_checks.clear()
+            git._git_version_checks.update(old_version_checks)
+            self.config.dvcs_mirror_dir = None
+            self.config.nonetwork = False
+
+    def test_date_index(self):
+        from jhbuild.versioncontrol.git import GitDateIndex
+        upstream = self.make_upstream('foo')
+        # commit times are not monotonic
+        for date in ('2020-01-10', '2020-01-05', '2020-01-20'):
+            os.environ['GIT_COMMITTER_DATE'] = date + 'T12:00:00Z'
+            self.commit(upstream, date)
+        del os.environ['GIT_COMMITTER_DATE']
+        self.git(upstream, 'branch', '-M', 'master')
+        # .git is a file in a worktree
+        worktree = os.path.join(self.temp_dir, 'worktree')
+        self.git(upstream, 'worktree', 'add', '-q', '--detach', worktree)
+
+        def get_subject(commit):
+            if commit is None:
+                return None
+            return self.git(upstream, 'log', '-1', '--format=%s',
+                            commit).strip()
+        for checkoutdir in (upstream, worktree):
+            index = GitDateIndex(checkoutdir)
+            self.assertEqual(get_subject(index.lookup('2020-01-01')), None)
+            self.assertEqual(get_subject(index.lookup('2020-01-07')),
+                             '2020-01-05')
+            self.assertEqual(get_subject(index.lookup('2020-01-15')),
+                             '2020-01-05')
+            self.assertEqual(get_subject(index.lookup('2020-02-01')),
+                             '2020-01-20')
+            self.assertTrue(os.path.exists(index.get_filename()))
+            self.assertFalse(os.path.isfile(os.path.join(
+                    os.path.dirname(index.get_filename()), '.git')))
+
+        # new commits are appended to the index
+        os.environ['GIT_COMMITTER_DATE'] = '2020-02-10T12:00:00Z'
+        self.commit(upstream, '2020-02-10')
+        del os.environ['GIT_COMMITTER_DATE']
+        index = GitDateIndex(upstream)
+        self.assertEqual(get_subject(index.lookup('2020-02-05')),
+                         '2020-01-20')
+        self.assertEqual(get_subject(index.lookup('2020-02-15')),
+                         '2020-02-10')
+        self.assertEqual(len(file(index.get_filename()).readlines()), 5)
+
+    def test_repackmirrors(self):
+        from jhbuild.commands.repackmirrors import cmd_repackmirrors
+        from jhbuild.versioncontrol.git import get_git_shared_store
+        upstream = self.make_upstream('foo')
+        mirror_root = os.path.join(self.temp_dir, 'mirrors')
+        os.makedirs(mirror_root)
+        # git writes the real path of the shared store in the alternates
+        self.config.dvcs_mirror_dir = os.path.join(self.temp_dir, 'link')
+        os.symlink(mirror_root, self.config.dvcs_mirror_dir)
+        shared_store = get_git_shared_store(mirror_root)
+        self.git(mirror_root, 'clone', '-q', '--mirror', upstream, 'foo.git')
+        self.git(mirror_root, 'clone', '-q', '--mirror', upstream,
+                 os.path.basename(shared_store))
+        mirror_dir = os.path.join(mirror_root, 'foo.git')
+        file(os.path.join(mirror_dir, 'objects', 'info', 'alternates'),
+             'w').write(os.path.join(shared_store, 'objects') + '\n')
+        def count_objects():
+            output = self.git(mirror_dir, 'count-objects', '-v')
+            return dict([x.split(': ') for x in output.splitlines()])
+        self.assertNotEqual(count_objects()['count'], '0')
+
+        class options:
+            foreground = True
+        command = cmd_repackmirrors()
+        self.assertEqual(command.run(self.config, options, []), 0)
+        objects = count_objects()
+        self.assertEqual((objects['count'], objects['packs']), ('0', '0'))
+        self.assertEqual(self.git(mirror_dir, 'log', '--format=%s'),
+                         'first\n')
+
+        # the commits dropped by a forced push upstream are kept
+        old_head = self.git(mirror_dir, 'rev-parse', 'HEAD').strip()
+        self.git(upstream, 'commit', '-q', '--amend', '-m', 'amended')
+        self.git(mirror_dir, 'fetch', '-q')
+        self.git(shared_store, 'fetch', '-q')
+        self.assertEqual(command.run(self.config, options, []), 0)
+        self.assertEqual(subprocess.call(['git', 'cat-file', '-e', old_head],
+                                         cwd=mirror_dir), 0)
+
+        # a failure of git is reported
+        shutil.rmtree(os.path.join(shared_store, 'objects'))
+        os.makedirs(os.path.join(shared_store, 'objects'))
+        self.assertEqual(command.run(self.config, options, []), 1)
+
+
+class StatusServerTest(unittest.TestCase):
+
+    def setUp(self):
+        from jhbuild.utils.statusserver import StatusServer
+        self.status = StatusServer(0, [Package('foo'), Package('bar')])
+        self.port = self.status.server.server_address[1]
+
+    def tearDown(self):
+        self.status.close()
+
+    def get(self, path):
+        return urllib2.urlopen('http://localhost:%d%s' % (self.port, path)).read()
+
+    def read_event(self, fp):
+        event = data = None
+        while True:
+            line = fp.readline()
+            self.assertTrue(line, 'connection closed')
+            line = line.rstrip('\r\n')
+            if line.startswith('event: '):
+                event = line[7:]
+            elif line.startswith('data: '):
+                data = json.loads(line[6:])
+            elif not line and event:
+                return event, data
+
+    def test_status(self):
+        self.assertTrue('EventSource' in self.get('/'))
+        self.status.start_module('foo')
+        self.status.start_phase('foo', 'build')
+        # the output of commands is not necessarily UTF-8
+        self.status.command_output(['caf\xe9\n'], False)
+        status = json.loads(self.get('/status'))
+        self.assertEqual(status['current'], 'foo')
+        self.assertEqual([(x['name'], x['state'], x['phase'])
+                          for x in status['modules']],
+                         [('foo', 'running', 'build'), ('bar', 'pending', None)])
+        self.assertEqual(status['tails'], {'foo': [u'caf\ufffd\n']})
+        self.status.end_module('foo', False)
+        self.status.end_build([])
+        status = json.loads(self.get('/status'))
+        self.assertEqual(status['done'], 1)
+        self.assertEqual(status['modules'][0]['state'], 'done')
+        self.assertTrue(status['finished'])
+
+    def test_events(self):
+        sock = socket.create_connection(('localhost', self.port), 10)
+        try:
+            sock.sendall('GET /events HTTP/1.0\r\n\r\n')
+            fp = sock.makefile('rb', 0)
+            event, data = self.read_event(fp)
+            self.assertEqual(event, 'status')
+            self.assertEqual(len(data['modules']), 2)
+            self.status.start_module('foo')
+            event, data = self.read_event(fp)
+            self.assertEqual(event, 'module')
+            self.assertEqual(data['module'],
+                             {'name': 'foo', 'state': 'running', 'phase': None})
+            self.assertEqual(data['current'], 'foo')
+            self.assertEqual(data['tail'], [])
+            self.assertFalse('modules' in data)
+            self.status.command_output(['caf\xe9\n'], False)
+            event, data = self.read_event(fp)
+            self.assertEqual(event, 'output')
+            self.assertEqual(data, {'module': 'foo', 'lines': [u'caf\ufffd\n']})
+        finally:
+            sock.close()
+
+    def test_slow_client(self):
+        self.status.max_pending_events = 2
+        queue = self.status.add_client()
+        for i in range(3):
+            self.status.broadcast('output', i)
+        # the pending events are dropped and the client told to reconnect
+        self.assertFalse(queue in self.status.clients)
+        self.assertEqual(queue.get_nowait(), None)
+        self.assertTrue(queue.empty())
+
+class AutobuildReportTest(JhbuildConfigTestCase):
+
+    def test_report_queue(self):
+        import jhbuild.frontends.autobuild
+        from SimpleXMLRPCServer import SimpleXMLRPCServer
+        calls = []
+        def report(methodname):
+            def func(*args):
+                calls.append((methodname, ) + args)
+                return True
+            return func
+        server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False,
+                                    allow_none=True)
+        server.register_multicall_functions()
+        for methodname in ('start_module', 'end_module'):
+            server.register_function(report(methodname), methodname)
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        spool_filename = os.path.join(self.make_temp_dir(), 'spool')
+
+        # the server is not answering yet, the calls get spooled
+        proxy = jhbuild.frontends.autobuild.ServerProxy(
+                'http://127.0.0.1:1/', allow_none=True)
+        proxy.ITERS = 1
+        reports = jhbuild.frontends.autobuild.ReportQueue(proxy, spool_filename)
+        reports.call('start_module', 1, 'foo')
+        reports.close()
+        self.assertEqual(calls, [])
+        self.assertTrue(os.path.exists(spool_filename))
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            proxy = jhbuild.frontends.autobuild.ServerProxy(url, allow_none=True)
+            reports = jhbuild.frontends.autobuild.ReportQueue(proxy,
+                                                              spool_filename)
+            reports.call('end_module', 1, 'foo', None, False)
+            reports.call('start_module', 1, 'bar')
+            reports.close()
+        finally:
+            server.shutdown()
+            thread.join()
+        self.assertEqual(calls, [('start_module', 1, 'foo'),
+                                 ('end_module', 1, 'foo', None, False),
+                                 ('start_module', 1, 'bar')])
+        self.assertFalse(os.path.exists(spool_filename))
+
+class ConfigCacheTest(JhbuildConfigTestCase):
+
+    def test_config_cache(self):
+        temp_dir = self.make_temp_dir()
+        os.environ['XDG_CACHE_HOME'] = os.path.join(temp_dir, 'cache')
+        rc_filename = os.path.join(temp_dir, 'jhbuildrc')
+        count_filename = os.path.join(temp_dir, 'count')
+        prefix = os.path.join(temp_dir, 'prefix')
+        def write_rc(skip):
+            file(rc_filename, 'w').write(
+                    'prefix = %r\ncheckoutroot = %r\nconfig_cache = True\n'
+                    'skip = %r\nfile(%r, "a").write("x")\n'
+                    'prependpath("JHBUILD_TEST_PATH", "/test")\n'
+                    % (prefix, os.path.join(temp_dir, 'checkout'), skip,
+                       count_filename))
+
+        # as from new processes, started from the same environment
+        os.environ['JHBUILD_TEST_SECRET'] = 'not-in-the-cache'
+        environ = os.environ.copy()
+        write_rc(['foo'])
+        config = jhbuild.config.Config(rc_filename, [])
+        cache_filename = config.get_cache_filename()
+        self.assertEqual(os.stat(cache_filename).st_mode & 0777, 0600)
+        self.assertFalse('not-in-the-cache' in file(cache_filename).read())
+        restore_environ(environ)
+        # shells change these variables on every command
+        os.environ['PWD'] = temp_dir
+        os.environ['SHLVL'] = '42'
+        config = jhbuild.config.Config(rc_filename, [])
+        # the second time comes from the cache
+        self.assertEqual(file(count_filename).read(), 'x')
+        self.assertEqual(config.skip, ['foo'])
+        self.assertEqual(os.environ['PATH'].split(os.pathsep)[0],
+                         os.path.join(prefix, 'bin'))
+        self.assertEqual(os.environ['SHLVL'], '42')
+        self.assertEqual(os.environ['JHBUILD_TEST_SECRET'], 'not-in-the-cache')
+        self.assertEqual(os.environ['JHBUILD_TEST_PATH'], '/test')
+
+        # the environment follows what is installed in the prefix
+        gstplugindir = os.path.join(prefix, 'lib', 'gstreamer-1.0')
+        os.makedirs(gstplugindir)
+        restore_environ(environ)
+        config = jhbuild.config.Config(rc_filename, [])
+        self.assertEqual(file(count_filename).read(), 'x')
+        self.assertEqual(os.environ.get('GST_PLUGIN_PATH_1_0'), gstplugindir)
+
+        write_rc(['quux'])
+        restore_environ(environ)
+        config = jhbuild.config.Config(rc_filename, [])
+        self.assertEqual(file(count_filename).read(), 'xx')
+        self.assertEqual(config.skip, ['quux'])
+
+class CommandsTest(unittest.TestCase):
+
+    def test_lazy_commands(self):
+        for name, (module, doc) in jhbuild.commands._lazy_commands.items():
+            try:
+                command_class = jhbuild.commands.get_command_class(name)
+            except ImportError:
+                # missing optional dependency
+                continue
+            self.assertEqual(command_class.name, name)
+            self.assertEqual(command_class.doc, doc)
+
+    def test_startup_imports(self):
+        # jhbuild run and jhbuild shell are used from scripts, they should
+        # not load the moduleset support
+        script = '\n'.join([
+            'import sys, __builtin__',
+            '__builtin__._ = lambda x: x',
+            '__builtin__.SRCDIR = %r' % SRCDIR,
+            'import jhbuild.main',
+            'jhbuild.commands.get_command_class("run")',
+            'jhbuild.commands.get_command_class("shell")',
+            'print sorted([x for x in sys.modules if x.startswith("jhbuild.")])'])
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=SRCDIR)
+        modules = eval(output)
+        self.assertTrue('jhbuild.commands.base' in modules)
+        self.assertFalse('jhbuild.moduleset' in modules)
+        self.assertFalse('jhbuild.modtypes' in modules)
+
+    def test_print_help(self):
+        # commands missing from the index are listed too
+        entry = jhbuild.commands._lazy_commands.pop('rdepends')
+        old_stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            jhbuild.commands.print_help()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+            jhbuild.commands._lazy_commands['rdepends'] = entry
+        self.assertTrue('\n  rdepends ' in output)
+        self.assertTrue('\n  build ' in output)
+
+    def test_run_lazy_commands(self):
+        # every command is run in a new process, until it loads the
+        # moduleset, so it cannot rely on modules imported by others
+        temp_dir = tempfile.mkdtemp(prefix='unittest-')
+        rc_filename = os.path.join(temp_dir, 'jhbuildrc')
+        file(rc_filename, 'w').write(
+                'prefix = %r\ncheckoutroot = %r\nconfig_cache = False\n'
+                % (os.path.join(temp_dir, 'prefix'),
+                   os.path.join(temp_dir, 'checkout')))
+        script = '\n'.join([
+            'import sys, __builtin__',
+            '__builtin__._ = lambda x: x',
+            '__builtin__.SRCDIR = %r' % os.path.abspath(SRCDIR),
+            'sys.path.insert(0, SRCDIR)',
+            '__builtin__.PKGDATADIR = None',
+            '__builtin__.DATADIR = None',
+            'import jhbuild.main',
+            'from jhbuild.errors import UsageError, FatalError, CommandError',
+            'import jhbuild.utils.httpcache',
+            'def no_network(*args, **kwargs): raise IOError("no network")',
+            'jhbuild.utils.httpcache.load = no_network',
+            'import jhbuild.moduleset as moduleset',
+            'class ModulesetLoaded(Exception): pass',
+            'def load(*args, **kwargs): raise ModulesetLoaded()',
+            'moduleset.load = load',
+            # commands must import jhbuild.moduleset to get it
+            'del sys.modules["jhbuild.moduleset"], jhbuild.moduleset',
+            'class Importer:',
+            '    def find_module(self, fullname, path=None):',
+            '        if fullname == "jhbuild.moduleset": return self',
+            '    def load_module(self, fullname):',
+            '        sys.modules[fullname] = moduleset',
+            '        return moduleset',
+            'sys.meta_path.insert(0, Importer())',
+            'config = jhbuild.config.Config(%r, [])' % rc_filename,
+            'command = sys.argv[1]',
+            'try:',
+            '    command_class = jhbuild.commands.get_command_class(command)',
+            'except ImportError:',
+            '    sys.exit(0)  # missing optional dependency',
+            'try:',
+            '    command_class().execute(config, sys.argv[2:], lambda: None)',
+            'except (ModulesetLoaded, UsageError, FatalError, CommandError):',
+            '    pass'])
+        arguments = {'run': ['true'], 'tinderbox': ['-o', temp_dir]}
+        environ = os.environ.copy()
+        environ['SHELL'] = 'true'
+        try:
+            for name in sorted(jhbuild.commands._lazy_commands):
+                process = subprocess.Popen(
+                        [sys.executable, '-c', script, name] +
+                        arguments.get(name, []),
+                        cwd=temp_dir, env=environ, stdin=file(os.devnull),
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = process.communicate()[0]
+                self.assertEqual(process.returncode, 0,
+                                 '%s failed:\n%s' % (name, output))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_source_scanner(self):
+        from jhbuild.commands.goalreport import SourceScanner, C_EXTENSIONS
+        temp_dir = tempfile.mkdtemp(prefix='unittest-')
+        try:
+            os.makedirs(os.path.join(temp_dir, 'src', '.git'))
+            for filename, data in [
+                    ('src/a.c', '#include <foo/bar.h>\nFooObject *x;\n'),
+                    ('src/a.dead.c', '#include <foo/bar.h>\n'),
+                    ('src/b.h', ' #include <foo/bar.h>\n#include <foo/baz.h>'),
+                    ('src/.git/c.c', '#include <foo/bar.h>\n'),
+                    ('src/d.py', 'import foo\n'),
+                    ('src/e.txt', 'FooObject\n'),
+                    ('src/f.c', '')]:
+                file(os.path.join(temp_dir, filename), 'w').write(data)
+            scanner = SourceScanner()
+            scanner.add('includes', [
+                    (C_EXTENSIONS, '^#include <foo/', r'\.dead\.c:|baz'),
+                    (C_EXTENSIONS, 'FooObject', None)])
+            scanner.add('python', [(('.py',), 'import .*foo', None)])
+            scanner.add('none', [(('.py',), 'bar|baz', None)])
+            scanner.add('optional', [(('.py',), 'imp?ort f', None)])
+            scanner.add('repeated', [(('.py',), 'im*port fo', None)])
+            scanner.add('counted', [(('.py',), 'fo{2}$', None),
+                                    (('.py',), 'im{0,2}port', None)])
+            matches = scanner.scan(os.path.join(temp_dir, 'src'))
+            self.assertEqual(sorted(matches['includes']),
+                             [('a.c', '#include <foo/bar.h>'),
+                              ('a.c', 'FooObject *x;')])
+            self.assertEqual(matches['python'], [('d.py', 'import foo')])
+            self.assertEqual(matches['none'], [])
+            self.assertEqual(matches['optional'], [('d.py', 'import foo')])
+            self.assertEqual(matches['repeated'], [('d.py', 'import foo')])
+            self.assertEqual(matches['counted'], [('d.py', 'import foo'),
+                                                  ('d.py', 'import foo')])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_deprecated_symbols_check(self):
+        from jhbuild.commands import goalreport
+        temp_dir = tempfile.mkdtemp(prefix='unittest-')
+        try:
+            file(os.path.join(temp_dir, 'foo.devhelp2'), 'w').write(
+                '<book xmlns="http://www.devhelp.net/book"><functions>\n'
+                '<keyword name="foo_old ()" deprecated="1.0"/>\n'
+                '<keyword name="enum FooOldEnum" deprecated="1.0"/>\n'
+                '<keyword name="struct FooOld" deprecated="1.0"/>\n'
+                '<keyword name="foo_unused ()" deprecated="1.0"/>\n'
+                '<keyword name="foo_new ()"/>\n'
+                '</functions></book>\n')
+            os.makedirs(os.path.join(temp_dir, 'src'))
+            file(os.path.join(temp_dir, 'src', 'foo.c'), 'w').write(
+                'x = foo_old(1),foo_new();\n'
+                'struct FooOld *y; FooOldEnum z; int foo_unused_not;\n')
+            class config:
+                devhelp_dirname = temp_dir
+                xdg_cache_home = temp_dir
+            class module:
+                name = 'foo'
+                branch = SimpleBranch('foo', os.path.join(temp_dir, 'src'))
+            class FooDeprecatedSymbols(goalreport.DeprecatedSymbolsCheck):
+                devhelp_filenames = ('foo.devhelp2',)
+            FooDeprecatedSymbols.prepare(config)
+            self.assertTrue(os.path.exists(os.path.join(
+                    temp_dir, 'jhbuild', 'devhelp-symbols.cache')))
+            check = FooDeprecatedSymbols(config, module)
+            check.run()
+            self.assertEqual(check.status, 'todo')
+            self.assertEqual(check.result_comment,
+                             'FooOldEnum, foo_old, struct FooOld')
+            self.assertEqual(
+                    goalreport.load_deprecated_symbols(
+                        config, [os.path.join(temp_dir, 'foo.devhelp2')]),
+                    ['foo_old', 'FooOldEnum', 'struct FooOld', 'foo_unused'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_goalreport_cache(self):
+        from jhbuild.commands import goalreport
+        temp_dir = tempfile.mkdtemp(prefix='unittest-')
+        old_environ = os.environ.copy()
+        old_load = jhbuild.moduleset.load
+        runs_filename = os.path.join(temp_dir, 'runs')
+        class GitRepository:
+            pass
+        class Branch(SimpleBranch):
+            repository = GitRepository()
+            def tree_id(self):
+                return self.branchname
+        class Module:
+            type = 'autotools'
+            moduleset_name = 'test'
+            def __init__(self, name):
+                self.name = name
+                srcdir = os.path.join(temp_dir, name)
+                os.makedirs(srcdir)
+                file(os.path.join(srcdir, 'foo.c'), 'w').write('foo();\n')
+                self.branch = Branch('tree-1', srcdir)
+        class ModuleSet:
+            def __init__(self, modules):
+                self.modules = dict([(x.name, x) for x in modules])
+                self.module_list = modules
+            def get_module_list(self, *args):
+                return self.module_list
+            def get_module(self, name):
+                return self.modules[name]
+        class FooCheck(goalreport.GrepCheck):
+            grep = 'foo'
+            def process_matches(self, matches):
+                file(runs_filename, 'a').write(self.module.name + '\n')
+                goalreport.GrepCheck.process_matches(self, matches)
+        class ExcludedCheck(goalreport.Check):
+            def run(self):
+                file(runs_filename, 'a').write(self.module.name + '\n')
+                raise goalreport.ExcludedModuleException()
+        class config:
+            progress_bar = False
+            modules = []
+            skip = []
+        class options:
+            output = os.path.join(temp_dir, 'report.html')
+            cache = 'report.sqlite'
+            bugfile = None
+            falsepositivesfile = None
+            devhelp_dirname = None
+            list_all_modules = False
+        def run_report():
+            if os.path.exists(runs_filename):
+                os.remove(runs_filename)
+            command = goalreport.cmd_goalreport()
+            command.checks = [FooCheck, ExcludedCheck]
+            command.run(config, options, [])
+            if not os.path.exists(runs_filename):
+                return []
+            return sorted(file(runs_filename).read().split())
+        try:
+            os.environ['XDG_CACHE_HOME'] = temp_dir
+            modules = [Module('foo%d' % i) for i in range(3)]
+            jhbuild.moduleset.load = lambda config: ModuleSet(modules)
+            for jobs in (1, 2):
+                config.jobs = jobs
+                cache_filename = os.path.join(temp_dir, 'jhbuild',
+                                              options.cache)
+                if os.path.exists(cache_filename):
+                    os.remove(cache_filename)
+                for module in modules:
+                    module.branch.branchname = 'tree-1'
+                self.assertEqual(run_report(), ['foo0', 'foo0', 'foo1',
+                                                'foo1', 'foo2', 'foo2'])
+                report = file(options.output).read()
+                self.assertEqual(run_report(), [])
+                self.assertEqual(file(options.output).read(), report)
+                modules[1].branch.branchname = 'tree-2'
+                self.assertEqual(run_report(), ['foo1', 'foo1'])
+                self.assertEqual(file(options.output).read(), report)
+                results = goalreport.ResultStore(cache_filename).get_results()
+                self.assertEqual(results['foo1']['FooCheck'],
+                                 ('tree-2', ['todo', 'low', 1]))
+                self.assertEqual(results['foo1']['ExcludedCheck'],
+                                 ('tree-2', None))
+        finally:
+            jhbuild.moduleset.load = old_load
+            restore_environ(old_environ)
+            shutil.rmtree(temp_dir)
+
+    def test_goalreport_invalid_cache(self):
+        from jhbuild.commands import goalreport
+        temp_dir = tempfile.mkdtemp(prefix='unittest-')
+        try:
+            filename = os.path.join(temp_dir, 'report.sqlite')
+            file(filename, 'w').write('not a database' * 100)
+            store = goalreport.ResultStore(filename)
+            store.set_result('foo', 'FooCheck', 'tree-1', ['ok', 'low', None])
+            store.commit()
+            store.close()
+            self.assertEqual(file(filename + '.old').read(),
+                             'not a database' * 100)
+            self.assertEqual(goalreport.ResultStore(filename).get_results(),
+                             {'foo': {'FooCheck': ('tree-1',
+                                                   ['ok', 'low', None])}})
+        finally:
+            shutil.rmtree(temp_dir)
+
 def get_installed_pkgconfigs(config):
     ''' overload jhbuild.utils.get_installed_pkgconfigs'''
     return {'syspkgalpha'   : '2',